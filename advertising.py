@@ -0,0 +1,169 @@
+from micropython import const
+import struct
+import decoder
+
+# AD structure types
+_ADV_TYPE_NAME_SHORT      = const(0x08)
+_ADV_TYPE_NAME_COMPLETE   = const(0x09)
+_ADV_TYPE_SERVICE_DATA_16 = const(0x16)
+
+# 16-bit service UUIDs carrying sensor data
+_UUID_ENVIRONMENTAL_SENSING = const(0x181A)     # ATC / pvvx custom firmware
+_UUID_XIAOMI_MIBEACON       = const(0xFE95)     # Xiaomi MiBeacon
+
+# ATC / pvvx frame lengths (service data payload, UUID excluded)
+_ATC_FRAME_LEN  = const(13)
+_PVVX_FRAME_LEN = const(15)
+
+# MiBeacon frame control flags
+_MIBEACON_ENCRYPTED       = const(1 << 3)
+_MIBEACON_MAC_INCLUDED    = const(1 << 4)
+_MIBEACON_CAP_INCLUDED    = const(1 << 5)
+_MIBEACON_OBJECT_INCLUDED = const(1 << 6)
+_MIBEACON_CAP_IO          = const(1 << 5)
+
+# MiBeacon object types
+_OBJ_TEMPERATURE          = const(0x1004)
+_OBJ_HUMIDITY             = const(0x1006)
+_OBJ_BATTERY              = const(0x100A)
+_OBJ_TEMPERATURE_HUMIDITY = const(0x100D)
+
+
+def service_data(adv_data, uuid):
+    # Return the service data payload (UUID excluded) advertised for the
+    # given 16-bit UUID, or None if it is not present.
+    i = 0
+    n = len(adv_data)
+    while i + 1 < n:
+        length = adv_data[i]
+        if length == 0 or i + 1 + length > n:
+            break
+        if adv_data[i + 1] == _ADV_TYPE_SERVICE_DATA_16 and length >= 3:
+            if adv_data[i + 2] | (adv_data[i + 3] << 8) == uuid:
+                return memoryview(adv_data)[i + 4:i + 1 + length]
+        i += 1 + length
+    return None
+
+
+def _starts_with(adv_data, offset, length, prefix):
+    if length < len(prefix):
+        return False
+    for i in range(len(prefix)):
+        if adv_data[offset + i] != prefix[i]:
+            return False
+    return True
+
+
+def is_sensor(adv_data, name_prefixes):
+    # True if the advertisement (or scan response) carries sensor service data (0x181A, 0xFE95)
+    # or a local name starting with one of name_prefixes (bytes). Doesn't allocate: called from bt_irq.
+    i = 0
+    n = len(adv_data)
+    while i + 1 < n:
+        length = adv_data[i]
+        if length == 0 or i + 1 + length > n:
+            break
+        ad_type = adv_data[i + 1]
+        if ad_type == _ADV_TYPE_SERVICE_DATA_16 and length >= 3:
+            uuid = adv_data[i + 2] | (adv_data[i + 3] << 8)
+            if uuid == _UUID_ENVIRONMENTAL_SENSING or uuid == _UUID_XIAOMI_MIBEACON:
+                return True
+        elif ad_type == _ADV_TYPE_NAME_COMPLETE or ad_type == _ADV_TYPE_NAME_SHORT:
+            for prefix in name_prefixes:
+                if _starts_with(adv_data, i + 2, length - 1, prefix):
+                    return True
+        i += 1 + length
+    return False
+
+
+# Frame layouts (service data payload, after the MAC address)
+_ATC_VALUES  = '>hBBH'      # temperature (0.1 C), humidity (%), battery (%), battery voltage (mV)
+_PVVX_VALUES = '<hHH'       # temperature (0.01 C), humidity (0.01 %), battery voltage (mV)
+
+
+def decode_atc(payload, reading):
+    # ATC1441 custom firmware:
+    #   MAC (6, big endian), temperature (int16 BE, 0.1 C), humidity (uint8, %),
+    #   battery (uint8, %), battery voltage (uint16 BE, mV), frame counter (uint8)
+    temperature, humidity, level, millivolts = struct.unpack_from(_ATC_VALUES, payload, 6)
+    reading.temperature = temperature / 10
+    reading.humidity = humidity
+    # The battery level is computed from the voltage, as for the other sensors
+    reading.set_voltage(millivolts)
+    return reading
+
+
+def decode_pvvx(payload, reading):
+    # pvvx custom firmware:
+    #   MAC (6, little endian), temperature (int16 LE, 0.01 C),
+    #   humidity (uint16 LE, 0.01 %), battery voltage (uint16 LE, mV),
+    #   battery (uint8, %), frame counter (uint8), flags (uint8)
+    temperature, humidity, millivolts = struct.unpack_from(_PVVX_VALUES, payload, 6)
+    reading.temperature = temperature / 100
+    reading.humidity = humidity / 100
+    reading.set_voltage(millivolts)
+    return reading
+
+
+def decode_mibeacon(payload, reading):
+    # Xiaomi MiBeacon (unencrypted objects only):
+    #   frame control (uint16 LE), product id (uint16 LE), frame counter (uint8),
+    #   [MAC (6)], [capability (1) [+ IO capability (2)]], object type (uint16 LE),
+    #   object length (uint8), object data
+    if len(payload) < 5:
+        return None
+    frame_control = payload[0] | (payload[1] << 8)
+    if frame_control & _MIBEACON_ENCRYPTED or not frame_control & _MIBEACON_OBJECT_INCLUDED:
+        return None
+    i = 5
+    if frame_control & _MIBEACON_MAC_INCLUDED:
+        i += 6
+    if frame_control & _MIBEACON_CAP_INCLUDED:
+        if i < len(payload) and payload[i] & _MIBEACON_CAP_IO:
+            i += 2
+        i += 1
+    if i + 3 > len(payload):
+        return None
+    obj_type = payload[i] | (payload[i + 1] << 8)
+    obj_len = payload[i + 2]
+    i += 3
+    if i + obj_len > len(payload):
+        return None
+
+    if obj_type == _OBJ_TEMPERATURE and obj_len == 2:
+        reading.temperature = struct.unpack_from('<h', payload, i)[0] / 10
+    elif obj_type == _OBJ_HUMIDITY and obj_len == 2:
+        reading.humidity = struct.unpack_from('<H', payload, i)[0] / 10
+    elif obj_type == _OBJ_BATTERY and obj_len == 1:
+        reading.battery_level = payload[i]
+    elif obj_type == _OBJ_TEMPERATURE_HUMIDITY and obj_len == 4:
+        temperature, humidity = struct.unpack_from('<hH', payload, i)
+        reading.temperature = temperature / 10
+        reading.humidity = humidity / 10
+    else:
+        return None
+    return reading
+
+
+def decode(adv_data, reading=None):
+    # Decode an advertisement payload into reading (a decoder.Reading, reused if given).
+    # Fields which are not carried by the frame are None.
+    # Returns None if the advertisement does not carry sensor data.
+    payload = service_data(adv_data, _UUID_ENVIRONMENTAL_SENSING)
+    if payload is None:
+        payload = service_data(adv_data, _UUID_XIAOMI_MIBEACON)
+        if payload is None:
+            return None
+        if reading is None:
+            reading = decoder.Reading()
+        reading.clear()
+        return decode_mibeacon(payload, reading)
+
+    if reading is None:
+        reading = decoder.Reading()
+    reading.clear()
+    if len(payload) == _ATC_FRAME_LEN:
+        return decode_atc(payload, reading)
+    if len(payload) >= _PVVX_FRAME_LEN:
+        return decode_pvvx(payload, reading)
+    return None
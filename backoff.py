@@ -0,0 +1,27 @@
+try:
+    import urandom as random
+except ImportError:
+    import random
+
+
+class Backoff:
+    # Delays between the attempts to restore a connection: initial seconds after the first failure,
+    # doubled on every consecutive failure up to maximum, give or take jitter (a fraction of the delay)
+    # so that hubs cut off together don't all reconnect at the same time.
+    def __init__(self, initial, maximum, jitter=0.2):
+        self.initial = max(initial, 1)
+        self.maximum = max(self.initial, maximum)
+        self.jitter = jitter
+        self.failures = 0
+
+    def failure(self):
+        # Returns the delay before the next attempt (seconds)
+        delay = min(self.initial << min(self.failures, 16), self.maximum)
+        self.failures += 1
+        spread = int(delay * self.jitter)
+        if spread > 0:
+            delay = delay - spread + random.getrandbits(16) % (2 * spread + 1)
+        return delay
+
+    def reset(self):
+        self.failures = 0
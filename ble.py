@@ -3,8 +3,23 @@ from micropython import const
 import utime as time
 from binascii import unhexlify
 import array
+import struct
 import micropython
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 import utils
+import advertising
+import candidates
+import decoder
+import payload
+import records
+import registry
+import irqlog
+import cache
+import stats
+from registry import DEVICE_NAME_PLACEHOLDER
 import logging, logger
 logger.initLogging()
 
@@ -27,353 +42,976 @@ _IRQ_GATTC_NOTIFY                    = const(1 << 13)
 _IRQ_GATTC_INDICATE                  = const(1 << 14)
 _ARRAYSIZE = const(20)
 
-DEVICE_NAME_PLACEHOLDER = 'DEVICE_NAME_PLACEHOLDER'
+# Connection states
+_STATE_IDLE          = const(0)
+_STATE_SCANNING      = const(1)
+_STATE_CONNECTING    = const(2)
+_STATE_CONNECTED     = const(3)
+_STATE_DISCONNECTING = const(4)
+
+# Default GATT handles of the LYWSD03MMC (stock firmware)
+_NAME_HANDLE   = const(0x0003)
+_NOTIFY_HANDLE = const(0x0038)
+_ENERGY_HANDLE = const(0x0046)
+
+# Characteristics looked up by discovery
+_NAME_UUID   = UUID(0x2A00)
+_DATA_UUID   = UUID('ebe0ccc1-7a0a-4b0c-8a1a-6ff2997da3a6')    # temperature, humidity, voltage (notify)
+_ENERGY_UUID = UUID('ebe0ccd8-7a0a-4b0c-8a1a-6ff2997da3a6')    # connection interval (energy saving)
+_CCCD_UUID   = UUID(0x2902)     # client characteristic configuration (enables the notifications)
+_CCCD_RANGE  = const(3)         # descriptors searched after the value handle of the data characteristic
+_TIME_UUID    = UUID('ebe0ccb7-7a0a-4b0c-8a1a-6ff2997da3a6')   # sensor clock (time of the history records)
+_INDEX_UUID   = UUID('ebe0ccba-7a0a-4b0c-8a1a-6ff2997da3a6')   # index of the first history record to send
+_HISTORY_UUID = UUID('ebe0ccbc-7a0a-4b0c-8a1a-6ff2997da3a6')   # history records (notify, read: last record)
+_DISCOVERY_TIMEOUT_MS = const(5000)
+_DISCOVERY_QUIET_MS   = const(500)
+
+# History handles of a device (Connection.history)
+_HISTORY_TIME    = const(0)
+_HISTORY_INDEX   = const(1)
+_HISTORY_RECORDS = const(2)
+_HISTORY_CCCD    = const(3)
+_RECORDS_QUIET_MS = const(2000)  # a backfill is over when no record arrived for this long
+
+_TIMEOUT_MS = const(60000)
+_EVENT_RING_SIZE = const(32)
+
+
+class Connection:
+    # State of a connection to a peripheral.
+    # Ble keeps a fixed pool of them, looked up by conn_handle from bt_irq.
+    def __init__(self):
+        self.slot = -1
+        self.type = 0
+        self.address = None
+        self.conn_handle = -1
+        self.connected = False
+        self.state = _STATE_IDLE
+        self.write_status = -1
+        # Set by bt_irq to wake up the coroutine waiting for the corresponding event.
+        # On ESP32 the BLE IRQ handler is run by the scheduler, so it is safe to set them there.
+        self.connect_event = asyncio.Event()
+        self.disconnect_event = asyncio.Event()
+        self.read_event = asyncio.Event()
+        self.write_event = asyncio.Event()
+        self.notify_event = asyncio.Event()
+        self.discover_event = asyncio.Event()
+        # Data received by bt_irq (copied into these buffers, with its length)
+        self.notify_data = bytearray(30)
+        self.notify_mv = memoryview(self.notify_data)
+        self.notify_len = 0
+        self.char_data = bytearray(30)
+        self.char_mv = memoryview(self.char_data)
+        self.char_len = 0
+        self.reading = decoder.Reading()
+        # GATT handles used for this device (see registry.HANDLE_*), filled by _resolve_handles
+        # or by a discovery (bt_irq)
+        self.handles = array.array('H', [0] * 3)
+        self.cccd = 0
+        # History characteristics (see _HISTORY_*), and the buffer their notifications go to
+        # during a backfill (value handle records_handle)
+        self.history = array.array('H', [0] * 4)
+        self.records = None
+        self.records_handle = 0
 
 
 class Ble:
-    def __init__(self):
+    def __init__(self, capacity=_ARRAYSIZE, max_connections=1, cache_file=None, handle_file=None):
         logging.info("Initializing BLE...")
         self.bt = BLE()
         self.bt.irq(handler=self.bt_irq)
         logging.info('Waiting to set BLE active...')
         self.bt.active(True)
 
-        self.addresses = []
-        for i in range (_ARRAYSIZE):
-            self.addresses.append((-1, -1, b'AAAAAA', DEVICE_NAME_PLACEHOLDER, 0))
-        self.device_index = 0
-        self.type = 0
-        self.address = bytearray(6)
-        self.name = 0
-        self.last_read = 0
-        self.conn_handle = 0
-        self.connected = False
-        self.read_flag = False
-        self.write_flag = False
-        self.write_status = -1
-        self.notify_flag = False
-        self.scan_complete = False
-        self.notify_data = bytearray(30)
-        self.char_data = bytearray(30)
-        self.temperature = 0
-        self.humidity = 0
-        self.battery_voltage = 0
-        self.battery_level = 0
-
+        self.addresses = registry.DeviceRegistry(capacity)
+        # Devices seen by a discovery scan which may be sensors, added to the registry after the scan
+        # by decreasing RSSI (see set_scan_filter)
+        self.candidates = candidates.CandidateTable(2 * capacity)
+        self.active_scan = True
+        self.cache_file = cache_file
+        self.cache_dirty = False
+        # GATT handles of each model, found by discovery: {model: array('H', [name, notify, energy saving])}
+        self.handle_table = {}
+        self.handle_file = handle_file
+        self.handles_dirty = False
+        # Backfill of the history stored by the sensors (see set_backfill)
+        self.record_marks = None
+        self.records_file = None
+        self.on_records = None
+        # History handles of each model (all 0 if it has no history): {model: array('H', [time, index, records, CCCD])}
+        self.history_table = {}
+        self.state = _STATE_IDLE
+        self.scan_event = asyncio.Event()
+        self.connections = [Connection() for i in range(max_connections)]
+        # Only one connection can be pending at a time
+        self.connect_lock = asyncio.Lock()
+        # Time spent trying to connect to a sensor before giving up a reading
+        self.connect_timeout_ms = _TIMEOUT_MS
+        self._connecting = None
+        self.passive = False
+        self.on_advertisement = None
+        # bt_irq only records the events here, they are logged (and advertisements decoded)
+        # later in the main context by _drain_events
+        self.events = irqlog.EventRing(_EVENT_RING_SIZE)
+        self._drain_ref = self._drain_events   # bound method allocated once, outside the IRQ
+        self._drain_scheduled = False
+        self._dropped = 0
+        self._adv_reading = decoder.Reading()
+        # Per-device latencies, retries and timeouts (published on the stats topic)
+        self.stats = stats.Stats(capacity)
+
+
+    async def _wait(self, event, timeout_ms=_TIMEOUT_MS):
+        # Returns false on timeout
+        try:
+            await asyncio.wait_for(event.wait(), timeout_ms / 1000)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
-    def setup(self, scan_for_devices=True, devices_list=[]):
-        self.device_index = 0
 
+    def _acquire(self, slot):
+        # Returns a free connection for the device in the given registry slot, or None
+        for conn in self.connections:
+            if conn.slot < 0:
+                conn.slot = slot
+                conn.type = self.addresses.types[slot]
+                conn.address = self.addresses.mac(slot)
+                conn.conn_handle = -1
+                conn.connected = False
+                conn.state = _STATE_IDLE
+                return conn
+        return None
+
+
+    def _release(self, conn):
+        conn.slot = -1
+
+
+    def _find(self, conn_handle):
+        # Called from bt_irq: must not allocate
+        for conn in self.connections:
+            if conn.slot >= 0 and conn.conn_handle == conn_handle:
+                return conn
+        return None
+
+
+    def load_cache(self):
+        # Returns the number of sensors loaded from the device cache
+        if self.handle_file is not None:
+            cache.load_handles(self.handle_table, self.handle_file)
+        if self.record_marks is not None and self.records_file is not None:
+            self.record_marks.load(self.records_file)
+        if self.cache_file is None:
+            return 0
+        return cache.load(self.addresses, self.cache_file)
+
+
+    def save_cache(self):
+        if self.cache_file is not None and self.cache_dirty:
+            cache.save(self.addresses, self.cache_file)
+        self.cache_dirty = False
+        if self.handle_file is not None and self.handles_dirty:
+            cache.save_handles(self.handle_table, self.handle_file)
+        self.handles_dirty = False
+        if self.record_marks is not None and self.records_file is not None and self.record_marks.dirty:
+            self.record_marks.save(self.addresses, self.records_file)
+
+
+    def set_backfill(self, marks, max_records=48, on_records=None, filename=None):
+        # After a gap in the readings of a sensor (see records.HighWaterMarks.due), the history records
+        # it stored since the last ones published (at most max_records) are read on the same connection
+        # and handed over to on_records(slot, records), records being decoder.record() tuples
+        # with the time converted to the hub clock. The marks are saved to filename.
+        self.record_marks = marks
+        self.records_file = filename
+        self.on_records = on_records
+        for conn in self.connections:
+            conn.records = records.RecordBuffer(max_records)
+
+
+    def set_scan_filter(self, min_rssi=-90, ouis=(candidates.OUI_XIAOMI,), plausible=True, active=True):
+        # Devices kept by the discovery scans: see candidates.CandidateTable.
+        # With an active scan the devices send their name in the scan response.
+        self.candidates = candidates.CandidateTable(self.candidates.capacity, min_rssi, ouis, plausible)
+        self.active_scan = active
+
+
+    def _add_candidates(self):
+        # Adds the candidates of the last scan to the registry, best RSSI first
+        ranked = self.candidates.ranked()
+        logging.info('Scan: {} candidates, {} devices ignored', len(ranked), self.candidates.rejected)
+        for mac, addr_type, rssi in ranked:
+            slot = self.addresses.find(mac)
+            if slot < 0:
+                slot = self.addresses.add(mac, addr_type)
+                if slot < 0:
+                    logging.warning('Device registry full: {} ignored (RSSI {})', utils.decode_mac(mac), rssi)
+                    continue
+            self.stats.record_rssi(slot, rssi)
+        self.candidates.clear()
+
+
+    async def setup(self, scan_for_devices=True, devices_list=[], duration_ms=60000, interval_us=30000, window_us=30000):
+        # Returns the number of new devices found
         # Load devices list (if not empty)
         if devices_list:
             logging.info('Loading device list...')
             for (mac_address, device_name) in devices_list:
-                self.addresses[self.device_index] = (self.device_index, 0, utils.encode_mac(mac_address), device_name, 0)
-                self.device_index += 1
+                slot = self.addresses.add(utils.encode_mac(mac_address), 0, device_name)
+                if slot < 0:
+                    utils.log_error_to_file('ERROR: setup - device list exceeds registry capacity')
+                    break
+                self.addresses.names[slot] = device_name
 
+        known = len(self.addresses)
         if scan_for_devices:
             # Start device scan
-            self.scan_devices()
+            self.candidates.clear()
+            await self.scan_devices(duration_ms, interval_us, window_us)
+            self._add_candidates()
 
         # Perform a scan to identify all the devices
-        self.identify_devices()
+        # (only the ones not already identified, e.g. loaded from the device cache)
+        await self.identify_devices()
+        self.save_cache()
+        return len(self.addresses) - known
 
 
-    def scan_devices(self):
-        self.scan_complete = False
+    async def scan_devices(self, duration_ms=60000, interval_us=30000, window_us=30000):
+        self.scan_event.clear()
         logging.info('Starting scan...')
         # Run a scan operation lasting for the specified duration (in milliseconds).
         # Use interval_us and window_us to optionally configure the duty cycle.
         # The scanner will run for window_us microseconds every interval_us microseconds for a total of duration_ms milliseconds.
         # The default interval and window are 1.28 seconds and 11.25 milliseconds respectively (background scanning).
         #
-        # Scan for 60s (at 100% duty cycle)
-        duration_ms = 60000 # milliseconds
-        interval_us = 30000 # microseconds
-        window_us   = 30000 # microseconds
+        # Scan for 60s (at 100% duty cycle) by default.
+        # Plausible sensors are recorded by bt_irq in self.candidates as soon as they are seen.
         try:
-            self.bt.gap_scan(duration_ms, interval_us, window_us)
+            self.bt.gap_scan(duration_ms, interval_us, window_us, self.active_scan)
         except Exception as e:
             utils.log_error_to_file('ERROR: scan - ' + str(e))
-            
-        while not self.scan_complete:
-            pass
+            return False
+        self.state = _STATE_SCANNING
+
+        if not await self._wait(self.scan_event, duration_ms + _TIMEOUT_MS):
+            utils.log_error_to_file('ERROR: scan - timeout')
+            self.state = _STATE_IDLE
+            return False
+        return True
+
+
+    def start_passive_scan(self, interval_us=1280000, window_us=11250):
+        # Listen to the advertisements broadcast by the sensors, without connecting to them.
+        # Sensor data (ATC/pvvx custom firmware or unencrypted Xiaomi MiBeacon) is decoded
+        # in bt_irq and handed over to self.on_advertisement(address, reading).
+        #
+        # Scan indefinitely (duration_ms = 0) with a low duty cycle (background scanning)
+        self.passive = True
+        logging.info('Starting passive scan...')
+        try:
+            self.bt.gap_scan(0, interval_us, window_us, False)
+        except Exception as e:
+            utils.log_error_to_file('ERROR: passive scan - ' + str(e))
+            self.passive = False
+        return self.passive
+
+
+    def stop_passive_scan(self):
+        logging.info('Stopping passive scan...')
+        self.passive = False
+        try:
+            self.bt.gap_scan(None)
+        except Exception as e:
+            utils.log_error_to_file('ERROR: stop passive scan - ' + str(e))
+
+
+    def _drain_events(self, _):
+        self._drain_scheduled = False
+        self.events.drain(self._handle_event)
+        if self.events.dropped != self._dropped:
+            logging.warning('{} BLE events dropped', self.events.dropped - self._dropped)
+            self._dropped = self.events.dropped
+
 
+    def _handle_event(self, event, conn_handle, value, addr_type, addr, rssi, data):
+        if event == _IRQ_SCAN_RESULT:
+            self.stats.record_rssi(self.addresses.find(addr), rssi)
+        if event == _IRQ_SCAN_RESULT and self.passive:
+            reading = advertising.decode(data, self._adv_reading)
+            if reading is not None and self.on_advertisement is not None:
+                self.on_advertisement(bytes(addr), reading.values())
+        elif event == _IRQ_SCAN_COMPLETE:
+            logging.info('Scan complete')
+        elif __debug__:
+            if logging.isEnabledFor(logging.DEBUG):
+                self._log_event(event, conn_handle, value, addr_type, addr, rssi)
+
+
+    def _log_event(self, event, conn_handle, value, addr_type, addr, rssi):
+        if event == _IRQ_SCAN_RESULT:
+            logging.debug('Address type: {} - Address: {} - RSSI: {}', addr_type, utils.decode_mac(addr), rssi)
+        elif event == _IRQ_PERIPHERAL_CONNECT:
+            logging.debug('Peripheral connected.')
+            logging.debug('Connection handle: {} - Address type: {} - Address: {}', conn_handle, addr_type, utils.decode_mac(addr))
+        elif event == _IRQ_PERIPHERAL_DISCONNECT:
+            logging.debug('Peripheral disconnected.')
+            logging.debug('Connection handle: {} - Address type: {} - Address: {}', conn_handle, addr_type, utils.decode_mac(addr))
+        elif event == _IRQ_CENTRAL_CONNECT:
+            logging.debug('A central has connected to this peripheral.')
+            logging.debug('Connection handle: {} - Address type: {} - Address: {}', conn_handle, addr_type, utils.decode_mac(addr))
+        elif event == _IRQ_CENTRAL_DISCONNECT:
+            logging.debug('A central has disconnected from this peripheral.')
+            logging.debug('Connection handle: {} - Address type: {} - Address: {}', conn_handle, addr_type, utils.decode_mac(addr))
+        elif event == _IRQ_GATTS_WRITE:
+            logging.debug('A central has written to this characteristic or descriptor.')
+            logging.debug('Connection handle: {} - Attribute handle: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_SERVICE_RESULT:
+            logging.debug('Called for each service found by gattc_discover_services().')
+            logging.debug('Connection handle: {} - Start handle: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
+            logging.debug('Called for each characteristic found by gattc_discover_services().')
+            logging.debug('Connection handle: {} - Value handle: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
+            logging.debug('Called for each descriptor found by gattc_discover_descriptors().')
+            logging.debug('Connection handle: {} - Dsc handle: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_READ_RESULT:
+            logging.debug('A gattc_read() has completed.')
+            logging.debug('Connection handle: {} - Value handle: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_WRITE_STATUS:
+            logging.debug('A gattc_write() has completed - status.')
+            logging.debug('Connection handle: {} - Status: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_NOTIFY:
+            logging.debug('A peripheral has sent a notify request.')
+            logging.debug('Connection handle: {} - Value handle: {}', conn_handle, value)
+        elif event == _IRQ_GATTC_INDICATE:
+            logging.debug('A peripheral has sent an indicate request.')
+            logging.debug('Connection handle: {} - Value handle: {}', conn_handle, value)
+
+
+    def _record_event(self, event, conn_handle=0, value=0, addr_type=0, addr=None, rssi=0, data=None):
+        # Called from bt_irq: must not allocate
+        self.events.record(event, conn_handle, value, addr_type, addr, rssi, data)
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            try:
+                micropython.schedule(self._drain_ref, None)
+            except RuntimeError:
+                # Schedule queue full: the records are drained on the next event
+                self._drain_scheduled = False
 
-    def identify_devices(self):
+
+    async def identify_devices(self):
         logging.info('Starting identify...')
         for i in range(len(self.addresses)):
-            self.device_index, self.type, self.address, self.name, self.last_read = self.addresses[i]
-            if self.type >= 0:
-                if self.name == DEVICE_NAME_PLACEHOLDER:
-                    self.get_name(i)
-                    logging.debug('Name: {}', self.name)
-                    if self.name != DEVICE_NAME_PLACEHOLDER:
-                        self.addresses[i] = (self.device_index, self.type, self.address, self.name, self.last_read)
-                    time.sleep(1)
-            else:
-                self.addresses = self.addresses[:i]            # truncate self.addresses
-                break
+            if self.addresses.names[i] == DEVICE_NAME_PLACEHOLDER:
+                name = await self.get_name(i)
+                logging.debug('Name: {}', name)
+                if name is not None:
+                    self.addresses.names[i] = name
+                    self.cache_dirty = True
 
 
-    def get_name(self, i):
+    async def get_name(self, slot):
         print('--------------------------------------------------')
-        logging.debug('Type: {} - Address: {}', self.type, utils.decode_mac(self.address))
-        if self.connect():
-            time.sleep(1)
-            if self.read_data(0x0003):
+        conn = self._acquire(slot)
+        if conn is None:
+            return None
+        name = None
+        try:
+            logging.debug('Type: {} - Address: {}', conn.type, utils.decode_mac(conn.address))
+            if await self.connect(conn):
+                name_handle = self.addresses.handle(slot, registry.HANDLE_NAME) or _NAME_HANDLE
+                discovered = None
+                if not await self.read_data(conn, name_handle):
+                    # Not the usual layout: look the name characteristic up
+                    discovered = await self.discover_handles(conn)
+                    name_handle = conn.handles[registry.HANDLE_NAME]
+                    if not name_handle or not await self.read_data(conn, name_handle):
+                        name_handle = 0
+                if name_handle:
+                    try:
+                        name = bytes(conn.char_mv[:conn.char_len]).decode("utf-8")
+                        end = name.find('\x00')
+                        if end >= 0:
+                            name = name[:end]  # drop trailing zeroes
+                        logging.debug('Name: {} - Length: {}', name, len(name))
+                        self.addresses.set_handle(slot, registry.HANDLE_NAME, name_handle)
+                    except Exception as e:
+                        name = None
+                        utils.log_error_to_file('ERROR: setup ' + utils.decode_mac(conn.address) + ' - ' + str(e))
+
+                if name is not None and registry.is_sensor(name) and registry.model(name) not in self.handle_table:
+                    # First device of this model: resolve its handles now that it is connected,
+                    # the next devices of the same model won't need a discovery
+                    if discovered is None:
+                        discovered = await self.discover_handles(conn)
+                    if discovered:
+                        self._remember_model(registry.model(name), conn.handles)
+
+                await self.disconnect(conn)
+        finally:
+            self._release(conn)
+        return name
+
+
+    async def discover_handles(self, conn):
+        # Look the characteristics of the connected device up by UUID (results in conn.handles).
+        # Returns True if the data characteristic was found.
+        for i in range(len(conn.handles)):
+            conn.handles[i] = 0
+        for i in range(len(conn.history)):
+            conn.history[i] = 0
+        conn.discover_event.clear()
+        logging.info('Discovering characteristics...')
+        try:
+            self.bt.gattc_discover_characteristics(conn.conn_handle, 1, 0xffff)
+        except Exception as e:
+            utils.log_error_to_file('ERROR: discover ' + utils.decode_mac(conn.address) + ' - ' + str(e))
+            return False
+        # There is no "discovery done" event: the discovery is over once the results stop coming
+        timeout = _DISCOVERY_TIMEOUT_MS
+        while await self._wait(conn.discover_event, timeout):
+            conn.discover_event.clear()
+            timeout = _DISCOVERY_QUIET_MS
+        # bt_irq stored the value handle of the data characteristic:
+        # notifications are enabled by writing to its CCCD, found among the next descriptors
+        value_handle = conn.handles[registry.HANDLE_NOTIFY]
+        found = value_handle != 0
+        if found:
+            conn.handles[registry.HANDLE_NOTIFY] = await self._discover_cccd(conn, value_handle)
+        logging.debug('Handles found - Name: {} - Notify: {} - Energy saving: {}', conn.handles[0], conn.handles[1], conn.handles[2])
+        return found
+
+
+    async def _discover_cccd(self, conn, value_handle):
+        # Returns the CCCD of a characteristic, found among the descriptors after its value handle
+        conn.cccd = 0
+        conn.discover_event.clear()
+        try:
+            self.bt.gattc_discover_descriptors(conn.conn_handle, value_handle + 1, value_handle + _CCCD_RANGE)
+            timeout = _DISCOVERY_TIMEOUT_MS
+            while await self._wait(conn.discover_event, timeout):
+                conn.discover_event.clear()
+                timeout = _DISCOVERY_QUIET_MS
+        except Exception as e:
+            utils.log_error_to_file('ERROR: discover ' + utils.decode_mac(conn.address) + ' - ' + str(e))
+        # Usually the handle right after the value
+        return conn.cccd or value_handle + 1
+
+
+    def _remember_model(self, model, handles):
+        known = self.handle_table.get(model)
+        if known is None:
+            self.handle_table[model] = array.array('H', handles)
+            self.handles_dirty = True
+            return
+        for i in range(len(handles)):
+            if known[i] != handles[i]:
+                known[i] = handles[i]
+                self.handles_dirty = True
+
+
+    async def _resolve_handles(self, conn):
+        # Handles of the device, from (in this order) the registry (verified by a previous reading),
+        # the handle table of its model, a discovery, or the LYWSD03MMC defaults
+        devices = self.addresses
+        slot = conn.slot
+        if devices.handle(slot, registry.HANDLE_NOTIFY):
+            for i in range(len(conn.handles)):
+                conn.handles[i] = devices.handle(slot, i)
+            return
+        known = self.handle_table.get(registry.model(devices.names[slot]))
+        if known is not None:
+            for i in range(len(conn.handles)):
+                conn.handles[i] = known[i]
+            return
+        if await self.discover_handles(conn):
+            return
+        conn.handles[registry.HANDLE_NAME] = _NAME_HANDLE
+        conn.handles[registry.HANDLE_NOTIFY] = _NOTIFY_HANDLE
+        conn.handles[registry.HANDLE_ENERGY] = _ENERGY_HANDLE
+
+
+    def _remember_handles(self, conn):
+        # The handles have worked: save them for the device and for its model
+        devices = self.addresses
+        slot = conn.slot
+        for i in range(len(conn.handles)):
+            if conn.handles[i] and devices.handle(slot, i) != conn.handles[i]:
+                devices.set_handle(slot, i, conn.handles[i])
+                self.cache_dirty = True
+        self._remember_model(registry.model(devices.names[slot]), conn.handles)
+
+
+    def _forget_handles(self, conn):
+        # The handles didn't work: the next reading will look them up again
+        devices = self.addresses
+        for i in range(len(conn.handles)):
+            devices.set_handle(conn.slot, i, 0)
+        self.cache_dirty = True
+        model = registry.model(devices.names[conn.slot])
+        known = self.handle_table.get(model)
+        if known is not None and known[registry.HANDLE_NOTIFY] == conn.handles[registry.HANDLE_NOTIFY]:
+            del self.handle_table[model]
+            self.handles_dirty = True
+
+
+    async def connect(self, conn, mswait=2000, timeout_ms=_TIMEOUT_MS):
+        # Connect to the device at conn.address.
+        # The lock is only held during an attempt: the other connections can go ahead in between.
+        count = 0
+        start = time.ticks_ms()
+        while not conn.connected and count < timeout_ms:
+            async with self.connect_lock:
+                logging.info('Trying to connect to {}...', utils.decode_mac(conn.address))
+                conn.connect_event.clear()
+                self._connecting = conn
                 try:
-                    self.name = self.char_data.decode("utf-8")
-                    self.name = self.name[:self.name.find('\x00')]  # drop trailing zeroes
-                    logging.debug('Name: {} - Length: {}', self.name, len(self.name))
+                    self.bt.gap_connect(conn.type, conn.address)
+                    conn.state = _STATE_CONNECTING
                 except Exception as e:
-                    utils.log_error_to_file('ERROR: setup ' + utils.decode_mac(self.address) + ' - ' + str(e))
-
-            self.disconnect()
-
-
-    def connect(self, mswait=2000, type=0):
-        # Connect to the device at self.address
-        count = 0
-        while not self.connected and count < 60000:
-            logging.info('Trying to connect to {}...', utils.decode_mac(self.address))
-            try:
-                self.bt.gap_connect(type, self.address)
-            except Exception as e:
-                utils.log_error_to_file('ERROR: connect to ' + utils.decode_mac(self.address) + ' - ' + str(e))
-            now = time.ticks_ms()
-            while time.ticks_diff(time.ticks_ms(), now) < mswait:
-                if self.connected:
-                    break
+                    utils.log_error_to_file('ERROR: connect to ' + utils.decode_mac(conn.address) + ' - ' + str(e))
+                if await self._wait(conn.connect_event, mswait):
+                    self.stats.record_stage(conn.slot, stats.STAGE_CONNECT, start)
+                else:
+                    self.stats.count(conn.slot, stats.COUNT_TIMEOUTS)
+                    # Cancel the pending connection before trying again
+                    try:
+                        self.bt.gap_connect(None)
+                    except Exception:
+                        pass
+                    conn.state = _STATE_IDLE
+                self._connecting = None
             count += mswait
-        return self.connected
+        return conn.connected
 
 
-    def disconnect(self):
+    async def disconnect(self, conn):
         logging.info('Disconnecting...')
+        if not conn.connected:
+            return True
+        conn.disconnect_event.clear()
         try:
-            conn = self.bt.gap_disconnect(self.conn_handle)
+            self.bt.gap_disconnect(conn.conn_handle)
+            conn.state = _STATE_DISCONNECTING
         except Exception as e:
-            utils.log_error_to_file('ERROR: disconnect from ' + utils.decode_mac(self.address) + ' - ' + str(e))
+            utils.log_error_to_file('ERROR: disconnect from ' + utils.decode_mac(conn.address) + ' - ' + str(e))
 
         # Returns false on timeout
-        timer = 0
-        while self.connected:
-            # print('.', end='')
-            time.sleep(1)
-            timer += 1
-            if timer > 60:
-                return False
-        return True
+        return await self._wait(conn.disconnect_event)
 
 
-    def read_data(self, value_handle):
-        self.read_flag = False
+    async def read_data(self, conn, value_handle):
+        conn.read_event.clear()
 
         logging.info('Reading data...')
         try:
-            self.bt.gattc_read(self.conn_handle, value_handle)
+            self.bt.gattc_read(conn.conn_handle, value_handle)
         except Exception as e:
-            utils.log_error_to_file('ERROR: read from ' + utils.decode_mac(self.address) + ' - ' + str(e))
+            utils.log_error_to_file('ERROR: read from ' + utils.decode_mac(conn.address) + ' - ' + str(e))
             return False
 
         # Returns false on timeout
-        timer = 0
-        while not self.read_flag:
-            # print('.', end='')
-            time.sleep(1)
-            timer += 1
-            if timer > 60:
-                return False
+        if not await self._wait(conn.read_event):
+            self.stats.count(conn.slot, stats.COUNT_TIMEOUTS)
+            return False
         return True
 
 
-    def write_data(self, value_handle, data):
-        self.write_flag = False
-        self.write_status = -1
+    async def write_data(self, conn, value_handle, data):
+        conn.write_event.clear()
+        conn.write_status = -1
 
-        # Checking for connection before write
-        self.connect()
+        # Checking for connection before write (reconnected within the same timeout as a reading)
+        if not await self.connect(conn, timeout_ms=self.connect_timeout_ms):
+            return False
         logging.debug('Writing data...')
+        start = time.ticks_ms()
         try:
-            self.bt.gattc_write(self.conn_handle, value_handle, data, 1)
+            self.bt.gattc_write(conn.conn_handle, value_handle, data, 1)
         except Exception as e:
-            utils.log_error_to_file('ERROR: write to ' + utils.decode_mac(self.address) + ' - ' + str(e))
+            utils.log_error_to_file('ERROR: write to ' + utils.decode_mac(conn.address) + ' - ' + str(e))
             return False
 
         # Returns false on timeout
-        timer = 0
-        while not self.write_flag:
-            # print('.', end='')
-            time.sleep(1)
-            timer += 1
-            if timer > 60:
-                return False
-        return self.write_status == 0
+        if not await self._wait(conn.write_event):
+            self.stats.count(conn.slot, stats.COUNT_TIMEOUTS)
+            return False
+        self.stats.record_stage(conn.slot, stats.STAGE_WRITE, start)
+        return conn.write_status == 0
+
 
+    async def read_devices(self, slots, on_reading, concurrency=1):
+        # Read the devices in the given registry slots, up to <concurrency> at a time
+        # (bounded by the size of the connection pool).
+        # on_reading(slot, reading) is called for each successful reading.
+        pending = list(slots)
 
-    def get_reading(self):
-        self.connect()
+        async def worker():
+            while pending:
+                slot = pending.pop(0)
+                reading = await self.get_reading(slot)
+                if reading is not None:
+                    on_reading(slot, reading)
+
+        workers = min(concurrency, len(self.connections), len(pending))
+        await asyncio.gather(*[worker() for i in range(workers)])
+        self.save_cache()
+
+
+    async def get_reading(self, slot):
+        # Returns a (temperature, humidity, battery_level, battery_voltage) tuple, or None on failure
+        conn = self._acquire(slot)
+        if conn is None:
+            return None
+        try:
+            reading = await self._get_reading(conn)
+            self.stats.count(slot, stats.COUNT_FAILURES if reading is None else stats.COUNT_READS)
+            return reading
+        finally:
+            self._release(conn)
+
+
+    async def _subscribe(self, conn):
+        # Enable the notifications of the connected device (and energy saving). Returns false on failure.
+        await self._resolve_handles(conn)
 
         # Enable notifications of Temperature, Humidity and Battery voltage
         logging.info('Enabling notifications for data readings...')
-        self.notify_flag = False
+        conn.notify_event.clear()
         data = b'\x01\x00'
-        value_handle = 0x0038
+        value_handle = conn.handles[registry.HANDLE_NOTIFY]
         retry = 1
-        while not self.write_data(value_handle, data):
+        while not await self.write_data(conn, value_handle, data):
             logging.warning('Write failed ({}/3)', retry)
             if retry < 3:
                 retry += 1
+                self.stats.count(conn.slot, stats.COUNT_RETRIES)
             else:
-                self.disconnect()
+                self._forget_handles(conn)
                 return False
         logging.debug('Write successful')
 
-        # Enable energy saving
-        logging.info('Enabling energy saving...')
-        data = b'\xf4\x01\x00'
-        value_handle = 0x0046
-        if self.write_data(value_handle, data):
-            logging.debug('Write successful')
-        else:
-            logging.warning('Write failed')
+        # Enable energy saving (if the device has the characteristic)
+        energy_handle = conn.handles[registry.HANDLE_ENERGY]
+        if energy_handle:
+            logging.info('Enabling energy saving...')
+            data = b'\xf4\x01\x00'
+            if await self.write_data(conn, energy_handle, data):
+                logging.debug('Write successful')
+            else:
+                logging.warning('Write failed')
+        return True
+
+
+    def _decode(self, conn):
+        # Returns the (temperature, humidity, battery_level, battery_voltage) tuple of the last notification,
+        # or None if it is malformed
+        logging.info('Data received from {}!', utils.decode_mac(conn.address))
+        if decoder.notification(conn.notify_data, conn.reading, conn.notify_len) is None:
+            utils.log_error_to_file('ERROR: notification from ' + utils.decode_mac(conn.address) + ' - ' + str(conn.notify_len) + ' bytes')
+            return None
+        self.addresses.last_read[conn.slot] = int(time.time())
+        return conn.reading.values()
+
+
+    async def _get_reading(self, conn):
+        if not await self.connect(conn, timeout_ms=self.connect_timeout_ms):
+            return None
+
+        notify_start = time.ticks_ms()
+        if not await self._subscribe(conn):
+            await self.disconnect(conn)
+            return None
 
         # Wait for a notification
         logging.info('Waiting for a notification...')
-        timer = 0
-        while not self.notify_flag:
-            # print('.', end='')
-            time.sleep(1)
-            timer += 1
-            if timer > 60:
-                self.disconnect()
+        if not await self._wait(conn.notify_event):
+            self.stats.count(conn.slot, stats.COUNT_TIMEOUTS)
+            await self.disconnect(conn)
+            return None
+        if not conn.connected:
+            # Woken up by a disconnection
+            return None
+        self.stats.record_stage(conn.slot, stats.STAGE_NOTIFY, notify_start)
+
+        previous = self.addresses.last_read[conn.slot]
+        reading = self._decode(conn)
+        if reading is not None and self.record_marks is not None \
+                and self.record_marks.due(conn.slot, int(time.time()), previous):
+            await self.fetch_records(conn)
+        await self.disconnect(conn)
+        self._remember_handles(conn)
+        return reading
+
+
+    async def _history_handles(self, conn):
+        # Handles of the history characteristics (conn.history), looked up once per model.
+        # Returns false if the device has no history (custom firmware).
+        model = registry.model(self.addresses.names[conn.slot])
+        known = self.history_table.get(model)
+        if known is None:
+            # The discovery also resolves the handles used for the readings: keep the ones which worked
+            handles = array.array('H', conn.handles)
+            found = await self.discover_handles(conn)
+            for i in range(len(handles)):
+                conn.handles[i] = handles[i]
+            if not found:
+                # Incomplete discovery: tried again on the next backfill
                 return False
-
-        logging.info('Data received!')
-        self.temperature = int.from_bytes(self.notify_data[0:2], 'little') / 100
-        self.humidity = int.from_bytes(self.notify_data[2:3], 'little')
-        self.battery_voltage = int.from_bytes(self.notify_data[3:5], 'little') / 1000
-        self.battery_level = min(int(round((self.battery_voltage - 2.1), 2) * 100), 100) # 3.1 or above --> 100% 2.1 --> 0 %
-        self.disconnect()
-
-        self.last_read = time.time()
-        self.addresses[self.device_index] = (self.device_index, self.type, self.address, self.name, self.last_read)
-        return True
+            if conn.history[_HISTORY_RECORDS]:
+                conn.history[_HISTORY_CCCD] = await self._discover_cccd(conn, conn.history[_HISTORY_RECORDS])
+            known = array.array('H', conn.history)
+            self.history_table[model] = known
+        for i in range(len(known)):
+            conn.history[i] = known[i]
+        return known[_HISTORY_INDEX] != 0 and known[_HISTORY_RECORDS] != 0
+
+
+    async def fetch_records(self, conn):
+        # Backfill: read the history records stored by the connected sensor after the last one published
+        # (its high-water mark) and hand them over to self.on_records. The sensor streams them as
+        # notifications of the history characteristic, from the index written to the index characteristic.
+        slot = conn.slot
+        marks = self.record_marks
+        now = int(time.time())
+        marks.fetched[slot] = now
+        if not await self._history_handles(conn):
+            return 0
+
+        # The record times follow the sensor clock (set by the Xiaomi app, it drifts or restarts from 0
+        # after a battery change): shifted by its offset to the hub clock
+        offset = -payload.EPOCH_OFFSET
+        if conn.history[_HISTORY_TIME] and await self.read_data(conn, conn.history[_HISTORY_TIME]):
+            clock = decoder.device_time(conn.char_data, conn.char_len)
+            if clock:
+                offset = now - clock
+
+        # Reading the history characteristic returns the last record
+        if not await self.read_data(conn, conn.history[_HISTORY_RECORDS]):
+            return 0
+        last = decoder.record(conn.char_data, 0, conn.char_len)
+        if last is None:
+            return 0
+        latest = last[0]
+        mark = marks.mark(self.addresses, slot)
+        if mark > latest:
+            logging.warning('History of {} restarted', utils.decode_mac(conn.address))
+            marks.reset(slot)
+            mark = -1
+        if mark == latest:
+            return 0
+        first = max(mark + 1, latest - conn.records.capacity + 1, 0)
+        logging.info('Fetching records {} to {} from {}...', first, latest, utils.decode_mac(conn.address))
+
+        conn.records.clear()
+        conn.records_handle = conn.history[_HISTORY_RECORDS]
+        try:
+            if not await self.write_data(conn, conn.history[_HISTORY_INDEX], struct.pack('<I', first)):
+                logging.warning('Write failed')
+                return 0
+            conn.notify_event.clear()
+            if not await self.write_data(conn, conn.history[_HISTORY_CCCD], b'\x01\x00'):
+                logging.warning('Write failed')
+                return 0
+            # bt_irq also sets notify_event for the readings and on a disconnection
+            while conn.connected and conn.records.last < latest and await self._wait(conn.notify_event, _RECORDS_QUIET_MS):
+                conn.notify_event.clear()
+        finally:
+            conn.records_handle = 0
+
+        fetched = [(index, timestamp + offset, t_min, t_max, h_min, h_max)
+                   for index, timestamp, t_min, t_max, h_min, h_max in conn.records.records()
+                   if first <= index <= latest]
+        fetched.sort()
+        if conn.records.dropped:
+            logging.warning('{} records dropped', conn.records.dropped)
+        logging.info('{} records received from {}', len(fetched), utils.decode_mac(conn.address))
+        if fetched and self.on_records is not None:
+            self.on_records(slot, fetched)
+        return len(fetched)
+
+
+    async def stream(self, slot, on_reading, retry_ms=30000, timeout_ms=300000):
+        # Keep-alive mode: stay connected to the device in the given registry slot and call
+        # on_reading(slot, reading) for every notification it sends, until cancelled.
+        # The device is reconnected (every <retry_ms> ms until it works) when the connection drops,
+        # or when no notification has arrived for <timeout_ms> ms.
+        conn = self._acquire(slot)
+        if conn is None:
+            utils.log_error_to_file('ERROR: stream - no free connection')
+            return
+        try:
+            while True:
+                if not await self.connect(conn, timeout_ms=self.connect_timeout_ms) or not await self._subscribe(conn):
+                    self.stats.count(slot, stats.COUNT_FAILURES)
+                    await self.disconnect(conn)
+                    await asyncio.sleep(retry_ms / 1000)
+                    continue
+                self._remember_handles(conn)
+                logging.info('Streaming from {}', utils.decode_mac(conn.address))
+                # bt_irq also sets notify_event on a disconnection
+                while await self._wait(conn.notify_event, timeout_ms):
+                    conn.notify_event.clear()
+                    if not conn.connected:
+                        break
+                    reading = self._decode(conn)
+                    if reading is not None:
+                        self.stats.count(slot, stats.COUNT_READS)
+                        on_reading(slot, reading)
+                if conn.connected:
+                    self.stats.count(slot, stats.COUNT_TIMEOUTS)
+                    await self.disconnect(conn)
+                logging.warning('Stream from {} interrupted, reconnecting...', utils.decode_mac(conn.address))
+        finally:
+            if conn.connected:
+                try:
+                    self.bt.gap_disconnect(conn.conn_handle)
+                except Exception:
+                    pass
+            self._release(conn)
 
 
     def address_already_present(self, address_to_check):
-        for (device_index, type, address, name, last_read) in self.addresses:
-            if address == address_to_check:
-                return True
-        return False
+        return self.addresses.find(address_to_check) >= 0
 
 
     # Bluetooth Interrupt Handler
+    # Runs hundreds of times per scan: it must not allocate memory nor log directly,
+    # events are recorded with _record_event and logged later by _drain_events.
     def bt_irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
             # A single scan result.
             addr_type, addr, connectable, rssi, adv_data = data
-            if addr_type == 0:
-                logging.debug('Address type: {} - Address: {}', addr_type, utils.decode_mac(addr))
-                if not self.address_already_present(bytes(addr)):
-                    self.addresses[self.device_index] = (self.device_index, addr_type, bytes(addr), DEVICE_NAME_PLACEHOLDER, 0)
-                    self.device_index += 1
-                
+            if self.passive:
+                self._record_event(event, 0, 0, addr_type, addr, rssi, adv_data)
+            elif addr_type == 0:
+                if self.addresses.find(addr) < 0:
+                    self.candidates.offer(addr, addr_type, rssi, adv_data)
+                self._record_event(event, 0, 0, addr_type, addr, rssi)
+
         elif event == _IRQ_SCAN_COMPLETE:
             # Scan duration finished or manually stopped.
-            logging.info('Scan complete')
-            self.scan_complete = True
-            
+            self.passive = False
+            self.state = _STATE_IDLE
+            self.scan_event.set()
+            self._record_event(event)
+
         elif event == _IRQ_PERIPHERAL_CONNECT:
-            logging.debug('Peripheral connected.')
-            self.conn_handle, _, _, = data
-            self.connected = True
-            
-        if event == _IRQ_CENTRAL_CONNECT:
+            # A successful gap_connect().
+            conn_handle, addr_type, addr = data
+            conn = self._connecting
+            if conn is not None:
+                conn.conn_handle = conn_handle
+                conn.connected = True
+                conn.state = _STATE_CONNECTED
+                conn.connect_event.set()
+            self._record_event(event, conn_handle, 0, addr_type, addr)
+
+        elif event == _IRQ_CENTRAL_CONNECT:
             # A central has connected to this peripheral.
-            self.conn_handle, addr_type, addr = data
-            logging.debug('A central has connected to this peripheral.')
-            logging.debug('Connection handle: {} - Address type: {} - Address: {}', self.conn_handle, addr_type, addr)
+            conn_handle, addr_type, addr = data
+            self._record_event(event, conn_handle, 0, addr_type, addr)
 
         elif event == _IRQ_CENTRAL_DISCONNECT:
             # A central has disconnected from this peripheral.
-            self.conn_handle, addr_type, addr = data
-            logging.debug('A central has disconnected from this peripheral.')
-            logging.debug('Connection handle: {} - Address type: {} - Address: {}', self.conn_handle, addr_type, addr)
+            conn_handle, addr_type, addr = data
+            self._record_event(event, conn_handle, 0, addr_type, addr)
 
         elif event == _IRQ_GATTS_WRITE:
             # A central has written to this characteristic or descriptor.
-            self.conn_handle, attr_handle = data
-            logging.debug('A central has written to this characteristic or descriptor.')
-            logging.debug('Connection handle: {} - Attribute handle: {}', self.conn_handle, attr_handle)
+            conn_handle, attr_handle = data
+            self._record_event(event, conn_handle, attr_handle)
 
         elif event == _IRQ_GATTS_READ_REQUEST:
             # A central has issued a read. Note: this is a hard IRQ.
             # Return None to deny the read.
             # Note: This event is not supported on ESP32.
-            self.conn_handle, attr_handle = data
-            
+            conn_handle, attr_handle = data
+
         elif event == _IRQ_PERIPHERAL_DISCONNECT:
             # Connected peripheral has disconnected.
-            self.conn_handle, addr_type, addr = data
-            logging.debug('Peripheral disconnected.')
-            logging.debug('Connection handle: {} - Address type: {} - Address: {}', self.conn_handle, addr_type, utils.decode_mac(addr))
-            self.connected = False
-            # print('Set connect flag', self.connected)
-            
+            conn_handle, addr_type, addr = data
+            conn = self._find(conn_handle)
+            if conn is not None:
+                conn.connected = False
+                conn.state = _STATE_IDLE
+                conn.disconnect_event.set()
+                # Wakes up a stream() waiting for the next notification
+                conn.notify_event.set()
+            self._record_event(event, conn_handle, 0, addr_type, addr)
+
         elif event == _IRQ_GATTC_SERVICE_RESULT:
             # Called for each service found by gattc_discover_services().
-            self.conn_handle, start_handle, end_handle, uuid = data
-            logging.debug('Called for each service found by gattc_discover_services().')
-            logging.debug('Connection handle: {} - Start handle: {} - End handle: {} - UUID: {}', self.conn_handle, start_handle, end_handle, uuid)
+            conn_handle, start_handle, end_handle, uuid = data
+            self._record_event(event, conn_handle, start_handle)
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
             # Called for each characteristic found by gattc_discover_services().
-            self.conn_handle, def_handle, value_handle, properties, uuid = data
-            logging.debug('Called for each characteristic found by gattc_discover_services().')
-            logging.debug('Connection handle: {} - Def handle: {} - Value handle: {} - Properties: {} - UUID: {}', self.conn_handle, def_handle, value_handle, properties, uuid)
-            # print('Value handle {:02x}'.format(value_handle))
-            # characteristics[self.index] = value_handle
-            # self.index += 1
-            
+            conn_handle, def_handle, value_handle, properties, uuid = data
+            conn = self._find(conn_handle)
+            if conn is not None:
+                if uuid == _DATA_UUID:
+                    # Replaced by the handle of its CCCD by discover_handles
+                    conn.handles[registry.HANDLE_NOTIFY] = value_handle
+                elif uuid == _ENERGY_UUID:
+                    conn.handles[registry.HANDLE_ENERGY] = value_handle
+                elif uuid == _NAME_UUID:
+                    conn.handles[registry.HANDLE_NAME] = value_handle
+                elif uuid == _HISTORY_UUID:
+                    conn.history[_HISTORY_RECORDS] = value_handle
+                elif uuid == _INDEX_UUID:
+                    conn.history[_HISTORY_INDEX] = value_handle
+                elif uuid == _TIME_UUID:
+                    conn.history[_HISTORY_TIME] = value_handle
+                conn.discover_event.set()
+            self._record_event(event, conn_handle, value_handle)
+
         elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
             # Called for each descriptor found by gattc_discover_descriptors().
             conn_handle, dsc_handle, uuid = data
-            logging.debug('Called for each descriptor found by gattc_discover_descriptors().')
-            logging.debug('Connection handle: {} - Dsc handle: {} - UUID: {}', conn_handle, dsc_handle, uuid)
+            conn = self._find(conn_handle)
+            if conn is not None:
+                if uuid == _CCCD_UUID and (conn.cccd == 0 or dsc_handle < conn.cccd):
+                    conn.cccd = dsc_handle
+                conn.discover_event.set()
+            self._record_event(event, conn_handle, dsc_handle)
 
         elif event == _IRQ_GATTC_READ_RESULT:
             # A gattc_read() has completed.
             conn_handle, value_handle, char_data = data
-            logging.debug('A gattc_read() has completed.')
-            logging.debug('Connection handle: {} - Value handle: {} - Char data: {}', conn_handle, value_handle, char_data)
-
-            for b in range(len(char_data)):
-                self.char_data[b] = char_data[b]
-                
-            self.read_flag = True
+            conn = self._find(conn_handle)
+            if conn is not None:
+                conn.char_len = decoder.copy(conn.char_mv, char_data)
+                conn.read_event.set()
+            self._record_event(event, conn_handle, value_handle)
 
         elif event == _IRQ_GATTC_WRITE_STATUS:
             # A gattc_write() has completed.
-            self.conn_handle, value_handle, status = data
-            logging.debug('A gattc_write() has completed - status.')
-            logging.debug('Connection handle: {} - Value handle: {} - Status: {}', self.conn_handle, value_handle, status)
-            self.write_flag = True
-            self.write_status = status
-            
+            conn_handle, value_handle, status = data
+            conn = self._find(conn_handle)
+            if conn is not None:
+                conn.write_status = status
+                conn.write_event.set()
+            self._record_event(event, conn_handle, status)
+
         elif event == _IRQ_GATTC_NOTIFY:
             # A peripheral has sent a notify request.
-            self.conn_handle, value_handle, notify_data = data
-            logging.debug('A peripheral has sent a notify request.')
-            logging.debug('Connection handle: {} - Value handle: {} - Notify data: {}', self.conn_handle, value_handle, notify_data)
-            for b in range(len(notify_data)):
-                self.notify_data[b] = notify_data[b]
-            
-            self.notify_flag = True
-            
+            conn_handle, value_handle, notify_data = data
+            conn = self._find(conn_handle)
+            if conn is not None:
+                if conn.records_handle and value_handle == conn.records_handle:
+                    # Backfill in progress
+                    conn.records.append(notify_data)
+                else:
+                    conn.notify_len = decoder.copy(conn.notify_mv, notify_data)
+                conn.notify_event.set()
+            self._record_event(event, conn_handle, value_handle)
+
         elif event == _IRQ_GATTC_INDICATE:
-            # A peripheral has sent an indicate request.
-            self.conn_handle, value_handle, self.notify_data = data
-            logging.debug('A peripheral has sent an indicate request.')
-            logging.debug('Connection handle: {} - Value handle: {} - Notify data: {}', self.conn_handle, value_handle, self.notify_data)
+            # A peripheral has sent an indicate request. Only notifications are enabled: the payload
+            # is dropped, so that it can't overwrite a notification not decoded yet.
+            conn_handle, value_handle, notify_data = data
+            self._record_event(event, conn_handle, value_handle)
@@ -0,0 +1,145 @@
+from micropython import const
+import array
+import struct
+import uos
+import registry
+from registry import DEVICE_NAME_PLACEHOLDER
+import utils
+import logging, logger
+logger.initLogging()
+
+# File layout:
+#   header: magic (4), version (uint8), number of records (uint16)
+#   record: MAC (6), address type (uint8), flags (uint8),
+#           name/notify/energy saving handles (3 x uint16), name length (uint8), name
+_MAGIC = b'LYWC'
+_VERSION = const(2)
+_HEADER = '<4sBH'
+_RECORD = '<6sBBHHHB'
+
+# Record flags
+FLAG_NOT_SENSOR = const(1 << 0)     # negative cache: identified, but not a sensor
+
+
+def save(devices, filename):
+    # Save the identified devices (name known) of the registry to filename.
+    # Returns the number of records written.
+    slots = [i for i in range(len(devices)) if devices.names[i] != DEVICE_NAME_PLACEHOLDER]
+    tmp = filename + '.tmp'
+    try:
+        f = open(tmp, 'wb')
+        try:
+            f.write(struct.pack(_HEADER, _MAGIC, _VERSION, len(slots)))
+            for i in slots:
+                name = devices.names[i].encode()
+                flags = 0 if registry.is_sensor(devices.names[i]) else FLAG_NOT_SENSOR
+                f.write(struct.pack(_RECORD, bytes(devices.mac(i)), devices.types[i], flags,
+                                    devices.handle(i, registry.HANDLE_NAME),
+                                    devices.handle(i, registry.HANDLE_NOTIFY),
+                                    devices.handle(i, registry.HANDLE_ENERGY),
+                                    len(name)))
+                f.write(name)
+        finally:
+            f.close()
+        try:
+            uos.remove(filename)
+        except OSError:
+            pass
+        uos.rename(tmp, filename)
+    except Exception as e:
+        utils.log_error_to_file('ERROR: save device cache - ' + str(e))
+        return 0
+    logging.info('Device cache saved ({} devices)', len(slots))
+    return len(slots)
+
+
+def load(devices, filename):
+    # Load the devices stored in filename into the registry.
+    # Returns the number of sensors loaded (devices flagged as FLAG_NOT_SENSOR excluded).
+    try:
+        f = open(filename, 'rb')
+    except OSError:
+        logging.info('No device cache found')
+        return 0
+
+    sensors = 0
+    try:
+        magic, version, count = struct.unpack(_HEADER, f.read(struct.calcsize(_HEADER)))
+        if magic != _MAGIC or version != _VERSION:
+            logging.warning('Device cache ignored (unknown format)')
+            return 0
+        record_size = struct.calcsize(_RECORD)
+        for _ in range(count):
+            mac, type, flags, name_handle, notify_handle, energy_handle, name_len = struct.unpack(_RECORD, f.read(record_size))
+            name = f.read(name_len).decode()
+            slot = devices.add(mac, type, name)
+            if slot < 0:
+                logging.warning('Device cache exceeds registry capacity')
+                break
+            devices.names[slot] = name
+            devices.set_handle(slot, registry.HANDLE_NAME, name_handle)
+            devices.set_handle(slot, registry.HANDLE_NOTIFY, notify_handle)
+            devices.set_handle(slot, registry.HANDLE_ENERGY, energy_handle)
+            if not flags & FLAG_NOT_SENSOR:
+                sensors += 1
+    except Exception as e:
+        utils.log_error_to_file('ERROR: load device cache - ' + str(e))
+    finally:
+        f.close()
+    logging.info('Device cache loaded ({} sensors)', sensors)
+    return sensors
+
+
+# GATT handles of each model:
+#   header: magic (4), version (uint8), number of records (uint16)
+#   record: name/notify/energy saving handles (3 x uint16), model length (uint8), model
+_HANDLES_MAGIC = b'LYWG'
+_HANDLES_RECORD = '<HHHB'
+
+
+def save_handles(table, filename):
+    # Save a {model: array('H', [name, notify, energy saving])} table to filename
+    tmp = filename + '.tmp'
+    try:
+        f = open(tmp, 'wb')
+        try:
+            f.write(struct.pack(_HEADER, _HANDLES_MAGIC, _VERSION, len(table)))
+            for model, handles in table.items():
+                name = model.encode()
+                f.write(struct.pack(_HANDLES_RECORD, handles[0], handles[1], handles[2], len(name)))
+                f.write(name)
+        finally:
+            f.close()
+        try:
+            uos.remove(filename)
+        except OSError:
+            pass
+        uos.rename(tmp, filename)
+    except Exception as e:
+        utils.log_error_to_file('ERROR: save GATT handles - ' + str(e))
+        return False
+    logging.info('GATT handles saved ({} models)', len(table))
+    return True
+
+
+def load_handles(table, filename):
+    # Load the table saved by save_handles() into table. Returns the number of models loaded.
+    try:
+        f = open(filename, 'rb')
+    except OSError:
+        return 0
+
+    try:
+        magic, version, count = struct.unpack(_HEADER, f.read(struct.calcsize(_HEADER)))
+        if magic != _HANDLES_MAGIC or version != _VERSION:
+            logging.warning('GATT handles ignored (unknown format)')
+            return 0
+        record_size = struct.calcsize(_HANDLES_RECORD)
+        for _ in range(count):
+            name_handle, notify_handle, energy_handle, name_len = struct.unpack(_HANDLES_RECORD, f.read(record_size))
+            table[f.read(name_len).decode()] = array.array('H', (name_handle, notify_handle, energy_handle))
+    except Exception as e:
+        utils.log_error_to_file('ERROR: load GATT handles - ' + str(e))
+    finally:
+        f.close()
+    return len(table)
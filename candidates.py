@@ -0,0 +1,92 @@
+from micropython import const
+import array
+import advertising
+import registry
+
+_MAC_LEN = const(6)
+_NO_RSSI = const(-128)
+
+# MAC address prefix of the Xiaomi thermometers
+OUI_XIAOMI = b'\xa4\xc1\x38'
+
+
+class CandidateTable:
+    # Devices seen during a discovery scan which may be sensors, ranked by RSSI.
+    # offer() is called from bt_irq for every scan result: it filters them and doesn't allocate.
+    # A device is a candidate if it is heard at min_rssi or better and either
+    # - its MAC address starts with one of ouis (3-byte prefixes, e.g. A4:C1:38 for the Xiaomi sensors),
+    # - it advertises sensor service data (ATC/pvvx 0x181A, MiBeacon 0xFE95),
+    # - or its advertised name is the one of a sensor model (registry.SENSOR_MODELS).
+    # With plausible=False every device heard at min_rssi is a candidate (no filtering).
+    # When the table is full, a new candidate replaces the weakest one if it is heard better.
+    def __init__(self, capacity, min_rssi=-90, ouis=(OUI_XIAOMI,), plausible=True):
+        self.capacity = capacity
+        self.min_rssi = min_rssi
+        self.ouis = [bytes(oui) for oui in ouis]
+        self.plausible = plausible
+        self.names = [model.encode() for model in registry.SENSOR_MODELS]
+        self.macs = bytearray(_MAC_LEN * capacity)
+        self.types = array.array('b', [0] * capacity)
+        self.rssi = array.array('b', [_NO_RSSI] * capacity)
+        self.count = 0
+        self.rejected = 0       # scan results filtered out
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+        self.rejected = 0
+
+    def _find(self, mac):
+        macs = self.macs
+        for slot in range(self.count):
+            offset = slot * _MAC_LEN
+            i = 0
+            while i < _MAC_LEN and macs[offset + i] == mac[i]:
+                i += 1
+            if i == _MAC_LEN:
+                return slot
+        return -1
+
+    def _oui(self, mac):
+        for oui in self.ouis:
+            if mac[0] == oui[0] and mac[1] == oui[1] and mac[2] == oui[2]:
+                return True
+        return False
+
+    def offer(self, mac, addr_type, rssi, adv_data):
+        # Returns true if the device is (now) a candidate
+        slot = self._find(mac)
+        if slot >= 0:
+            if rssi > self.rssi[slot]:
+                self.rssi[slot] = rssi
+            return True
+        if rssi < self.min_rssi or (self.plausible and not self._oui(mac)
+                                    and not advertising.is_sensor(adv_data, self.names)):
+            self.rejected += 1
+            return False
+        if self.count < self.capacity:
+            slot = self.count
+            self.count += 1
+        else:
+            # Full: replace the weakest candidate
+            slot = 0
+            for i in range(1, self.count):
+                if self.rssi[i] < self.rssi[slot]:
+                    slot = i
+            if self.rssi[slot] >= rssi:
+                self.rejected += 1
+                return False
+        offset = slot * _MAC_LEN
+        for i in range(_MAC_LEN):
+            self.macs[offset + i] = mac[i]
+        self.types[slot] = addr_type
+        self.rssi[slot] = rssi
+        return True
+
+    def ranked(self):
+        # [(mac, addr_type, rssi)] of the candidates, best RSSI first
+        slots = sorted(range(self.count), key=lambda slot: -self.rssi[slot])
+        return [(bytes(self.macs[slot * _MAC_LEN:(slot + 1) * _MAC_LEN]), self.types[slot], self.rssi[slot])
+                for slot in slots]
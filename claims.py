@@ -0,0 +1,144 @@
+from micropython import const
+import array
+import binascii
+try:
+    import ujson as json
+except ImportError:
+    import json
+import logging, logger
+logger.initLogging()
+
+_NO_RSSI = const(-128)
+_MAC_LEN = const(6)
+
+
+class ClaimTable:
+    # Ownership of the sensors shared by several hubs, negotiated over retained MQTT messages:
+    # <prefix>/<mac> holds {"hub": <client_id>, "rssi": <dBm>} of the hub which reads the sensor.
+    # Only the owner reads a sensor (owned()); it renews its claim every lease/3 seconds.
+    #
+    # - a sensor nobody claims, or whose owner didn't renew its claim for lease seconds, is claimed
+    # - a hub which hears a sensor at least margin dB better than its owner takes it over
+    # - when two hubs claim the same sensor, the best announced RSSI wins (then the lowest client_id)
+    # - the owner releases a sensor it can't read (release()), and doesn't claim it back for a lease
+    # Times are local (time of receipt), so the hubs' clocks don't need to agree.
+    def __init__(self, capacity, hub, prefix, lease=900, margin=10, settle=10):
+        self.capacity = capacity
+        self.hub = hub
+        self.prefix = prefix
+        self.lease = lease
+        self.margin = margin
+        self.settle = settle                                # seconds of retained claims received before claiming
+        self.tracked = bytearray(capacity)                  # sensors shared with the other hubs
+        self.owner = [None] * capacity                      # client_id of the owning hub, None if not claimed
+        self.rssi = array.array('b', [_NO_RSSI] * capacity) # RSSI announced by the owner
+        self.seen = array.array('i', [0] * capacity)        # when the claim of another owner was received
+        self.renewed = array.array('i', [0] * capacity)     # when this hub published its claim (0 = due)
+        self.blocked = array.array('i', [0] * capacity)     # this hub doesn't claim the sensor until then
+        self.releasing = bytearray(capacity)                # releases to publish
+        self.started = 0
+
+    def track(self, slot):
+        if 0 <= slot < self.capacity:
+            self.tracked[slot] = 1
+
+    def owned(self, slot, now):
+        # True if this hub reads the sensor: its claim has been published within the lease
+        if not 0 <= slot < self.capacity or not self.tracked[slot]:
+            return True
+        return self.owner[slot] == self.hub and now - self.renewed[slot] <= self.lease
+
+    def owners(self, devices):
+        # {mac in hex: client_id} of the claimed sensors
+        owners = {}
+        for slot in range(min(len(devices), self.capacity)):
+            if self.owner[slot] is not None:
+                owners[binascii.hexlify(devices.mac(slot)).decode()] = self.owner[slot]
+        return owners
+
+    def _wins(self, hub, rssi, slot):
+        # True if the claim of hub (announcing rssi) beats the claim of this hub
+        if rssi != self.rssi[slot]:
+            return rssi > self.rssi[slot]
+        return hub < self.hub
+
+    def receive(self, devices, topic, msg, now):
+        # MQTT callback of the <prefix>/+ subscription. Invalid claims are ignored: they are retained,
+        # so the broker sends them again after every reconnection.
+        try:
+            mac = binascii.unhexlify(topic[len(self.prefix) + 1:])
+        except ValueError:
+            return
+        if len(mac) != _MAC_LEN:
+            return
+        slot = devices.find(mac)
+        if not 0 <= slot < self.capacity:
+            return
+        if not msg:
+            # Released
+            if self.owner[slot] != self.hub:
+                self.owner[slot] = None
+            return
+        try:
+            claim = json.loads(msg)
+            hub = claim['hub'].encode()
+            rssi = claim['rssi']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logging.warning('Invalid claim on {}', topic)
+            return
+        if not isinstance(rssi, int) or isinstance(rssi, bool) or not -128 <= rssi <= 127:
+            logging.warning('Invalid claim on {}', topic)
+            return
+        if hub == self.hub:
+            if self.owner[slot] != self.hub and now >= self.blocked[slot]:
+                # Claim left by the previous run of this hub: renew it
+                self.owner[slot] = self.hub
+                self.renewed[slot] = 0
+            return
+        if self.owner[slot] == self.hub:
+            if not self._wins(hub, rssi, slot):
+                self.renewed[slot] = 0      # published again to settle the conflict
+                return
+            logging.info('{} taken over by {}', topic, hub)
+        self.owner[slot] = hub
+        self.rssi[slot] = rssi
+        self.seen[slot] = now
+
+    def release(self, slot, now):
+        # Gives up a sensor this hub can't read, so that another hub can try
+        if 0 <= slot < self.capacity and self.owner[slot] == self.hub:
+            self.owner[slot] = None
+            self.blocked[slot] = now + self.lease
+            self.releasing[slot] = 1
+
+    def _claim(self, client, devices, slot, now, rssi):
+        self.owner[slot] = self.hub
+        self.rssi[slot] = rssi
+        client.publish(self.prefix + b'/' + binascii.hexlify(devices.mac(slot)),
+                       json.dumps({'hub': self.hub.decode(), 'rssi': rssi}), retain=True)
+        self.renewed[slot] = now
+
+    def publish(self, client, devices, now, rssi):
+        # Claims, renews and releases the tracked sensors. rssi[slot] is the RSSI this hub hears each sensor at.
+        # Raises the client exceptions: what hasn't been sent is retried on the next call.
+        if not self.started:
+            self.started = now
+        settled = now - self.started >= self.settle
+        for slot in range(min(len(devices), self.capacity)):
+            if self.releasing[slot]:
+                client.publish(self.prefix + b'/' + binascii.hexlify(devices.mac(slot)), b'', retain=True)
+                self.releasing[slot] = 0
+            if not self.tracked[slot]:
+                continue
+            owner = self.owner[slot]
+            if owner == self.hub:
+                if now - self.renewed[slot] >= self.lease // 3:
+                    self._claim(client, devices, slot, now, rssi[slot])
+            elif now < self.blocked[slot] or not settled:
+                continue
+            elif owner is None or now - self.seen[slot] > self.lease:
+                logging.info('Claiming {}', binascii.hexlify(devices.mac(slot)))
+                self._claim(client, devices, slot, now, rssi[slot])
+            elif rssi[slot] != _NO_RSSI and rssi[slot] >= self.rssi[slot] + self.margin:
+                logging.info('Taking over {} from {}', binascii.hexlify(devices.mac(slot)), owner)
+                self._claim(client, devices, slot, now, rssi[slot])
@@ -5,10 +5,80 @@ mqtt_port = 1883
 mqtt_user = 'mqtt_user'
 mqtt_password = 'mqtt_password'
 topic_pub = b'home/espble'
+mqtt_retry_interval = 2 # Seconds before retrying a lost WiFi or broker connection (doubled on every failure)
+mqtt_retry_max = 300 # Seconds (maximum delay between two reconnection attempts)
+mqtt_ping_interval = 30 # Seconds between two pings of the broker, to spot a dead connection early
+mqtt_keepalive = 120 # Seconds (MQTT keep alive: the broker drops the connection of a silent hub after 1.5 times this)
+wifi_connect_timeout = 20 # Seconds spent waiting for a WiFi connection before backing off
+outbox_size = 64 # Readings kept in RAM while the broker is unreachable
+outbox_spill_file = None # e.g. 'outbox.bin': readings which don't fit in RAM are saved here
+outbox_spill_max = 2000 # Readings (17 bytes each) in outbox_spill_file at most; further readings are dropped
+publish_batch_size = 10 # Readings published per batch when replaying
+aggregate_readings = False # Publish each batch as one message on <topic_pub>/<client_id>
+payload_format = 'json' # 'json' or 'cbor' (compact binary, for bandwidth-limited links)
+payload_buffer_size = 2048 # Bytes (aggregate messages need about 130 bytes per reading)
+ha_discovery = True # Announce the sensors to Home Assistant (MQTT discovery, needs payload_format = 'json')
+ha_discovery_prefix = b'homeassistant' # Discovery prefix set in Home Assistant
+ha_offline_failures = 3 # Consecutive failed readings before a sensor is shown as unavailable
 
 scan_for_devices = True
-scan_interval = 21600 # Seconds
+scan_interval = 21600 # Seconds (maximum interval between scans, once no new devices show up)
+scan_min_interval = 300 # Seconds (interval between scans while new devices keep showing up)
+scan_idle_rounds = 3 # Scans without new devices before the interval starts doubling
+scan_duration_ms = 10000 # Milliseconds
+scan_filter = True # Only identify the devices which look like sensors: MAC prefix in scan_ouis, sensor service data or name
+scan_ouis = [b'A4:C1:38'] # MAC address prefixes of the sensors
+scan_min_rssi = -90 # dBm (devices heard weaker than this are ignored)
+scan_active = True # Active scan (the devices send their name in a scan response)
+scan_interval_us = 100000 # Microseconds
+scan_window_us = 30000 # Microseconds (30% duty cycle)
+device_capacity = 20 # Maximum number of devices tracked
+device_cache = 'devices.bin' # Known devices are saved here and loaded at startup (None to disable)
+gatt_cache = 'gatt.bin' # GATT handles of each sensor model, found by discovery (None to disable)
 read_interval = 300 # Seconds
+read_intervals = {} # Per-device read interval in seconds, e.g. {b'A4:C1:38:XX:XX:XX': 60}
+read_retry_interval = 30 # Seconds before retrying a failed reading (doubled on every consecutive failure)
+read_max_backoff = 3600 # Seconds (maximum delay between two attempts to read a failing sensor)
+connect_timeout = 10 # Seconds spent trying to connect to a sensor before its reading is retried later
+keep_alive = [] # Sensors kept connected, their readings are pushed as they arrive: [b'A4:C1:38:XX:XX:XX', ...]
+keep_alive_retry = 30 # Seconds between two attempts to reconnect a keep-alive sensor
+keep_alive_timeout = 300 # Seconds without notifications before a keep-alive sensor is reconnected
+read_jitter = 10 # Percent of the read interval added or removed at random, to spread the readings
+read_fast_interval = 60 # Seconds (minimum read interval while the values keep changing)
+read_change_temperature = 0.3 # Celsius (a change of at least this much halves the read interval)
+read_change_humidity = 2 # Percent (same, for the humidity)
+battery_curve = ((2100, 0), (2500, 10), (2600, 20), (2700, 40), (2800, 60), (2900, 80), (3000, 100)) # (mV, %) points of the battery level, interpolated between them
+publish_deadband_temperature = 0.1 # Celsius (a reading is published only if a value moved by at least its deadband since the last one published, 0 to publish every reading)
+publish_deadband_humidity = 1 # Percent
+publish_deadband_battery = 5 # Percent (battery level)
+publish_heartbeat = 3600 # Seconds (a reading is published at least this often, even if unchanged, 0 to disable)
+publish_smoothing = None # None, 'ewma' or 'median' (smoothing of the temperature and humidity published)
+publish_smoothing_alpha = 0.3 # Weight of the new reading in the moving average ('ewma')
+publish_smoothing_window = 5 # Number of readings of the median ('median')
+hub_claims = False # Several hubs in reach of the same sensors: share them out over MQTT (<topic_pub>/claims/<mac>), each sensor being read by one hub
+claim_lease = 900 # Seconds without renewal after which the sensors of a hub are claimed by the others
+claim_margin = 10 # dB (a hub takes over a sensor it hears at least this much better than its owner)
+claim_release_failures = 5 # Consecutive failed readings before a hub gives up a sensor to the others
+max_concurrent_reads = 3 # Sensors read in parallel (bounded by the BLE stack connection limit)
+ntp_interval = 86400 # Seconds
+log_level = 20 # 10 = DEBUG, 20 = INFO, 30 = WARNING, 40 = ERROR
+log_flush_interval = 60 # Seconds (buffered error log records are written to flash at least this often)
+stats_interval = 300 # Seconds between two reports on <topic_pub>/<client_id>/stats (0 to disable)
+series_length = 48 # Readings kept per device for the aggregates and backfill requests (8 bytes each, 0 to disable)
+aggregate_windows = [3600] # Seconds (min/max/mean/trend published on <topic_pub>/<mac>/aggregate/<window> for each window)
+aggregate_interval = 900 # Seconds between two aggregate publications (0 to disable)
+history_backfill = False # Fill the gaps in the readings with the hourly history stored by the sensors (stock firmware), published on <topic_pub>/<mac>/records
+backfill_gap = 900 # Seconds without a reading of a sensor after which its history is fetched on the next connection
+backfill_interval = 3600 # Seconds (the history is also fetched this often, 0 to only fill gaps)
+backfill_max_records = 48 # Records fetched per backfill (14 bytes each per connection, the sensor stores one per hour)
+backfill_file = 'records.bin' # Index of the last record published for each sensor, to fetch only the new ones after a restart (None to disable)
+
+# Passive mode: decode the sensor advertisements (ATC/pvvx custom firmware or
+# unencrypted Xiaomi MiBeacon) instead of connecting to each sensor
+passive_scan = False
+passive_scan_interval_us = 1280000 # Microseconds
+passive_scan_window_us = 11250 # Microseconds
+
 devices_list = [
     # Add your devices if you want them to be always loaded at startup,
     # without the need to discover them through BLE scan:
@@ -0,0 +1,113 @@
+from micropython import const
+import array
+
+SMOOTHING_NONE   = None
+SMOOTHING_EWMA   = 'ewma'
+SMOOTHING_MEDIAN = 'median'
+
+_NO_VALUE = const(-32768)
+
+
+class PublishFilter:
+    # Decides which readings of each device (registry slot) are published.
+    # A reading is published when one of its values moved away from the last published one
+    # by at least its deadband, or when nothing has been published for heartbeat seconds.
+    #
+    # - temperature (C), humidity (%), battery (%): deadbands, 0 publishes every reading
+    # - heartbeat: seconds, 0 to disable
+    # - smoothing: SMOOTHING_EWMA (the temperature and humidity published are an exponentially
+    #   weighted moving average, alpha being the weight of the new reading) or SMOOTHING_MEDIAN
+    #   (median of the last window readings), to suppress the sensor jitter
+    # Values are stored in fixed arrays (0.01 C, 0.01 %) like the ReadScheduler ones.
+    def __init__(self, capacity, temperature=0, humidity=0, battery=0, heartbeat=0,
+                 smoothing=SMOOTHING_NONE, alpha=0.3, window=5):
+        self.capacity = capacity
+        self.temperature_deadband = int(temperature * 100)
+        self.humidity_deadband = int(humidity * 100)
+        self.battery_deadband = battery
+        self.heartbeat = heartbeat
+        self.smoothing = smoothing
+        self.alpha = alpha
+        self.window = max(window, 1)
+        # Last published values and time (0 = never published)
+        self.temperature = array.array('h', [_NO_VALUE] * capacity)
+        self.humidity = array.array('h', [_NO_VALUE] * capacity)
+        self.battery = array.array('h', [_NO_VALUE] * capacity)
+        self.published = array.array('i', [0] * capacity)
+        if smoothing == SMOOTHING_EWMA:
+            self._temperature = array.array('h', [_NO_VALUE] * capacity)
+            self._humidity = array.array('h', [_NO_VALUE] * capacity)
+        elif smoothing == SMOOTHING_MEDIAN:
+            # Last window values of each device, as a ring (count[slot] values stored, next at count % window)
+            self._temperature = array.array('h', [0] * (capacity * self.window))
+            self._humidity = array.array('h', [0] * (capacity * self.window))
+            self._temperature_count = array.array('I', [0] * capacity)
+            self._humidity_count = array.array('I', [0] * capacity)
+        elif smoothing is not None:
+            raise ValueError('unknown smoothing: ' + str(smoothing))
+
+    def _ewma(self, values, slot, value):
+        last = values[slot]
+        if last != _NO_VALUE:
+            value = int(round(last + self.alpha * (value - last)))
+        values[slot] = value
+        return value
+
+    def _median(self, values, counts, slot, value):
+        offset = slot * self.window
+        values[offset + counts[slot] % self.window] = value
+        counts[slot] += 1
+        n = min(counts[slot], self.window)
+        ring = sorted(values[offset:offset + n])
+        return ring[n // 2] if n % 2 else (ring[n // 2 - 1] + ring[n // 2]) // 2
+
+    def _smooth(self, slot, temperature, humidity):
+        # temperature and humidity in 0.01 units (_NO_VALUE when missing)
+        if self.smoothing == SMOOTHING_EWMA:
+            if temperature != _NO_VALUE:
+                temperature = self._ewma(self._temperature, slot, temperature)
+            if humidity != _NO_VALUE:
+                humidity = self._ewma(self._humidity, slot, humidity)
+        elif self.smoothing == SMOOTHING_MEDIAN:
+            if temperature != _NO_VALUE:
+                temperature = self._median(self._temperature, self._temperature_count, slot, temperature)
+            if humidity != _NO_VALUE:
+                humidity = self._median(self._humidity, self._humidity_count, slot, humidity)
+        return temperature, humidity
+
+    @staticmethod
+    def _changed(last, value, deadband):
+        if value == _NO_VALUE:
+            return False
+        return last == _NO_VALUE or abs(value - last) >= deadband
+
+    def update(self, slot, now, reading):
+        # Returns the (temperature, humidity, battery_level, battery_voltage) tuple to publish
+        # (smoothed), or None if the reading is filtered out
+        if not 0 <= slot < self.capacity:
+            return reading
+        temperature, humidity, battery_level, battery_voltage = reading
+        t = _NO_VALUE if temperature is None else int(round(temperature * 100))
+        h = _NO_VALUE if humidity is None else int(round(humidity * 100))
+        b = _NO_VALUE if battery_level is None else battery_level
+        t, h = self._smooth(slot, t, h)
+
+        if not (self._changed(self.temperature[slot], t, self.temperature_deadband)
+                or self._changed(self.humidity[slot], h, self.humidity_deadband)
+                or self._changed(self.battery[slot], b, self.battery_deadband)
+                or (self.heartbeat and now - self.published[slot] >= self.heartbeat)):
+            return None
+
+        if t != _NO_VALUE:
+            self.temperature[slot] = t
+        if h != _NO_VALUE:
+            self.humidity[slot] = h
+        if b != _NO_VALUE:
+            self.battery[slot] = b
+        self.published[slot] = now
+        if self.smoothing is not None:
+            if t != _NO_VALUE:
+                temperature = t / 100
+            if h != _NO_VALUE:
+                humidity = h / 100
+        return (temperature, humidity, battery_level, battery_voltage)
@@ -0,0 +1,115 @@
+from micropython import const
+import struct
+
+# Battery level of a CR2032 cell, as (millivolts, percent) points by increasing voltage.
+# The level is interpolated linearly between two points (0 % below the first one, 100 % above the last one).
+BATTERY_CURVE = ((2100, 0), (2500, 10), (2600, 20), (2700, 40), (2800, 60), (2900, 80), (3000, 100))
+
+# LYWSD03MMC notification: temperature (int16 LE, 0.01 C), humidity (uint8, %), battery voltage (uint16 LE, mV)
+_NOTIFICATION = '<hBH'
+_NOTIFICATION_LEN = const(5)
+
+_curve = BATTERY_CURVE
+
+
+def set_battery_curve(curve):
+    global _curve
+    _curve = tuple(curve)
+
+
+def battery_level(millivolts):
+    # Battery level (%) of a voltage (mV), from the battery curve
+    curve = _curve
+    if millivolts <= curve[0][0]:
+        return curve[0][1]
+    for i in range(1, len(curve)):
+        v, level = curve[i]
+        if millivolts < v:
+            v0, level0 = curve[i - 1]
+            return level0 + (level - level0) * (millivolts - v0) // (v - v0)
+    return curve[-1][1]
+
+
+class Reading:
+    # Values of a reading, decoded in place (one instance per connection, reused for every reading).
+    # Values not carried by a frame are None.
+    __slots__ = ('temperature', 'humidity', 'battery_level', 'battery_voltage')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.temperature = None         # C
+        self.humidity = None            # %
+        self.battery_level = None       # %
+        self.battery_voltage = None     # V
+
+    def set_voltage(self, millivolts):
+        self.battery_voltage = millivolts / 1000
+        self.battery_level = battery_level(millivolts)
+
+    def values(self):
+        # (temperature, humidity, battery_level, battery_voltage) tuple, handed over to the publish path
+        return (self.temperature, self.humidity, self.battery_level, self.battery_voltage)
+
+
+def copy(buf, data):
+    # Copy data into the start of buf (a memoryview of a preallocated buffer), truncated to its size.
+    # Returns the number of bytes copied. Doesn't allocate (unless data has to be truncated).
+    n = len(data)
+    if n > len(buf):
+        n = len(buf)
+        data = data[:n]
+    buf[:n] = data
+    return n
+
+
+def notification(data, reading, length=-1):
+    # Decode a LYWSD03MMC notification (the first <length> bytes of data) into reading.
+    # Returns reading, or None if it is too short.
+    if length < 0:
+        length = len(data)
+    if length < _NOTIFICATION_LEN:
+        return None
+    temperature, humidity, millivolts = struct.unpack_from(_NOTIFICATION, data, 0)
+    reading.temperature = temperature / 100
+    reading.humidity = humidity
+    reading.set_voltage(millivolts)
+    return reading
+
+
+# LYWSD03MMC history record (stock firmware): the sensor stores one per hour, sends them as notifications
+# of the history characteristic and returns the last one when it is read.
+# Index (uint32 LE), start of the hour (uint32 LE, seconds since 1970 by the sensor clock),
+# maximum temperature (int16 LE, 0.1 C), maximum humidity (uint8, %),
+# minimum temperature (int16 LE, 0.1 C), minimum humidity (uint8, %)
+_RECORD = '<IIhBhB'
+RECORD_LEN = const(14)
+
+
+def record(data, offset=0, length=-1):
+    # Decode the history record at offset in data (of which the first <length> bytes are valid).
+    # Returns an (index, time, temperature_min, temperature_max, humidity_min, humidity_max) tuple,
+    # time being the sensor clock (seconds since 1970), or None if it is too short.
+    if length < 0:
+        length = len(data)
+    if length - offset < RECORD_LEN:
+        return None
+    index, timestamp, t_max, h_max, t_min, h_min = struct.unpack_from(_RECORD, data, offset)
+    return (index, timestamp, t_min / 10, t_max / 10, h_min, h_max)
+
+
+def records(data):
+    # Decode consecutive history records, e.g. the notifications of a backfill captured into one buffer.
+    # A truncated record at the end is left out.
+    return [record(data, offset) for offset in range(0, len(data) - RECORD_LEN + 1, RECORD_LEN)]
+
+
+def device_time(data, length=-1):
+    # Clock of the sensor (time characteristic): seconds since 1970 (uint32 LE, followed by the
+    # time zone offset on some firmware versions), or None if it is too short
+    if length < 0:
+        length = len(data)
+    if length < 4:
+        return None
+    return struct.unpack_from('<I', data, 0)[0]
@@ -0,0 +1,146 @@
+from micropython import const
+import binascii
+try:
+    import ujson as json
+except ImportError:
+    import json
+import registry
+import logging, logger
+logger.initLogging()
+
+# Payloads of the availability topics
+ONLINE  = b'online'
+OFFLINE = b'offline'
+
+# Availability of a device
+_UNKNOWN     = const(0)
+_AVAILABLE   = const(1)
+_UNAVAILABLE = const(2)
+
+# Entities of a sensor: (field, payload key, name, device class, unit)
+_ENTITIES = (
+    (b'temperature', 'temperature', 'Temperature', 'temperature', '°C'),
+    (b'humidity', 'humidity', 'Humidity', 'humidity', '%'),
+    (b'battery', 'batteryLevel', 'Battery', 'battery', '%'),
+    (b'voltage', 'batteryVoltage', 'Battery voltage', 'voltage', 'V'),
+)
+
+
+class Discovery:
+    # Home Assistant MQTT discovery of the sensors of the device registry.
+    # Each sensor is announced with retained <prefix>/sensor/<mac>/<field>/config messages the first time
+    # it is seen, and again only if its name or state topic changes. Availability is published (retained)
+    # on <topic_pub>/<client_id>/status for the hub (see last_will()) and on <state topic>/availability
+    # for each sensor, only when it changes.
+    # Changes are recorded by the update/set_available methods and sent by publish(), which is
+    # called by the MQTT publisher task (when the broker is down they are sent after reconnecting).
+    #
+    # - state_prefix: topic_pub
+    # - node_id: client_id of the hub
+    # - aggregate: readings are published as one message on <topic_pub>/<client_id>, keyed by MAC address
+    # - hub_availability: the entities depend on the availability of the hub too (off when the sensors
+    #   are shared by several hubs: the announcements must then be the same on every hub)
+    def __init__(self, capacity, prefix, state_prefix, node_id, aggregate=False, hub_availability=True):
+        self.capacity = capacity
+        self.prefix = prefix
+        self.state_prefix = state_prefix
+        self.node_id = node_id
+        self.aggregate = aggregate
+        self.hub_availability = hub_availability
+        self.status_topic = state_prefix + b'/' + node_id + b'/status'
+        self.announced = [None] * capacity              # (state topic, name) announced, per slot
+        self.available = bytearray(capacity)            # _UNKNOWN, _AVAILABLE or _UNAVAILABLE
+        self.available_published = bytearray(capacity)
+        self._pending = False
+
+    def _state_topic(self, devices, slot):
+        if self.aggregate:
+            return self.state_prefix + b'/' + self.node_id
+        return devices.topic(slot, self.state_prefix)
+
+    def _announce(self, devices, slot):
+        # Announced: sensors identified by name, or which published a reading (passive mode)
+        return registry.is_sensor(devices.names[slot]) or self.available[slot] == _AVAILABLE
+
+    def update(self, devices):
+        # Call when devices were added or renamed. Returns true if announcements are pending.
+        for slot in range(min(len(devices), self.capacity)):
+            if self._announce(devices, slot) and self.announced[slot] != (self._state_topic(devices, slot), devices.names[slot]):
+                self._pending = True
+        return self._pending
+
+    def set_available(self, slot, available):
+        # Returns true if the availability of the device changed
+        if not 0 <= slot < self.capacity:
+            return False
+        state = _AVAILABLE if available else _UNAVAILABLE
+        if self.available[slot] == state:
+            return False
+        self.available[slot] = state
+        self._pending = True
+        return True
+
+    def pending(self):
+        return self._pending
+
+    def last_will(self, client):
+        # The broker publishes the hub as offline if its connection drops
+        client.set_last_will(self.status_topic, OFFLINE, retain=True)
+
+    def online(self, client):
+        client.publish(self.status_topic, ONLINE, retain=True)
+
+    def config(self, devices, slot, entity):
+        # Discovery payload of an entity (a JSON string)
+        field, key, name, device_class, unit = _ENTITIES[entity]
+        mac = binascii.hexlify(devices.mac(slot)).decode()
+        state_topic = self._state_topic(devices, slot)
+        if self.aggregate:
+            template = "{{% if '{0}' in value_json %}}{{{{ value_json['{0}'].{1} }}}}{{% else %}}{{{{ this.state }}}}{{% endif %}}".format(mac, key)
+        else:
+            template = '{{{{ value_json.{} }}}}'.format(key)
+        model = devices.names[slot]
+        if model == registry.DEVICE_NAME_PLACEHOLDER:
+            model = registry.SENSOR_MODELS[0]
+        availability = [{'topic': (devices.topic(slot, self.state_prefix) + b'/availability').decode()}]
+        if self.hub_availability:
+            availability.insert(0, {'topic': self.status_topic.decode()})
+        return json.dumps({
+            'name': name,
+            'unique_id': mac + '_' + field.decode(),
+            'state_topic': state_topic.decode(),
+            'value_template': template,
+            'device_class': device_class,
+            'unit_of_measurement': unit,
+            'state_class': 'measurement',
+            'availability': availability,
+            'availability_mode': 'all',
+            'device': {
+                'identifiers': [mac],
+                'connections': [['mac', ':'.join(mac[i:i + 2] for i in range(0, 12, 2))]],
+                'name': registry.model(model) + ' ' + mac[6:],
+                'model': registry.model(model),
+            },
+        })
+
+    def publish(self, client, devices):
+        # Send the pending announcements and availability changes.
+        # Raises the client exceptions: what hasn't been sent stays pending.
+        if not self._pending:
+            return
+        for slot in range(min(len(devices), self.capacity)):
+            if self._announce(devices, slot):
+                announced = (self._state_topic(devices, slot), devices.names[slot])
+                if self.announced[slot] != announced:
+                    mac = binascii.hexlify(devices.mac(slot))
+                    logging.info('Announcing {} to Home Assistant', devices.names[slot])
+                    for entity in range(len(_ENTITIES)):
+                        topic = self.prefix + b'/sensor/' + mac + b'/' + _ENTITIES[entity][0] + b'/config'
+                        client.publish(topic, self.config(devices, slot, entity), retain=True)
+                    self.announced[slot] = announced
+            state = self.available[slot]
+            if state != _UNKNOWN and state != self.available_published[slot]:
+                client.publish(devices.topic(slot, self.state_prefix) + b'/availability',
+                               ONLINE if state == _AVAILABLE else OFFLINE, retain=True)
+                self.available_published[slot] = state
+        self._pending = False
@@ -0,0 +1,79 @@
+from micropython import const
+
+# Record layout (fixed size):
+#   0-1   event (uint16 LE)
+#   2-3   connection handle (uint16 LE)
+#   4-5   value (value handle, status, ...) (uint16 LE)
+#   6     address type
+#   7     rssi (int8)
+#   8-13  MAC address
+#   14    data length
+#   15    unused
+#   16-47 data (advertising payload, truncated to 32 bytes)
+_RECORD_SIZE = const(48)
+_DATA_OFFSET = const(16)
+_DATA_SIZE   = const(32)
+
+
+class EventRing:
+    # Preallocated ring buffer of fixed-size event records.
+    # record() doesn't allocate and is meant to be called from an IRQ handler,
+    # drain() hands the records over to a callback in the main context.
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self._buf = bytearray(capacity * _RECORD_SIZE)
+        self._mv = memoryview(self._buf)
+        self._head = 0      # next record to write
+        self._tail = 0      # next record to read
+        self.count = 0
+        self.dropped = 0
+
+    def record(self, event, handle=0, value=0, addr_type=0, addr=None, rssi=0, data=None):
+        # Returns False (and counts a dropped record) if the ring is full
+        if self.count >= self.capacity:
+            self.dropped += 1
+            return False
+        buf = self._buf
+        o = self._head * _RECORD_SIZE
+        buf[o] = event & 0xff
+        buf[o + 1] = (event >> 8) & 0xff
+        buf[o + 2] = handle & 0xff
+        buf[o + 3] = (handle >> 8) & 0xff
+        buf[o + 4] = value & 0xff
+        buf[o + 5] = (value >> 8) & 0xff
+        buf[o + 6] = addr_type
+        buf[o + 7] = rssi & 0xff
+        if addr is not None:
+            for i in range(6):
+                buf[o + 8 + i] = addr[i]
+        else:
+            for i in range(6):
+                buf[o + 8 + i] = 0
+        n = 0
+        if data is not None:
+            n = min(len(data), _DATA_SIZE)
+            for i in range(n):
+                buf[o + _DATA_OFFSET + i] = data[i]
+        buf[o + 14] = n
+        self._head = (self._head + 1) % self.capacity
+        self.count += 1
+        return True
+
+    def drain(self, callback):
+        # Calls callback(event, handle, value, addr_type, addr, rssi, data) for every pending record.
+        # addr and data are memoryviews into the ring: copy them if they need to outlive the callback.
+        while self.count > 0:
+            buf = self._buf
+            o = self._tail * _RECORD_SIZE
+            event = buf[o] | (buf[o + 1] << 8)
+            handle = buf[o + 2] | (buf[o + 3] << 8)
+            value = buf[o + 4] | (buf[o + 5] << 8)
+            rssi = buf[o + 7]
+            if rssi > 127:
+                rssi -= 256
+            try:
+                callback(event, handle, value, buf[o + 6], self._mv[o + 8:o + 14], rssi,
+                         self._mv[o + _DATA_OFFSET:o + _DATA_OFFSET + buf[o + 14]])
+            finally:
+                self._tail = (self._tail + 1) % self.capacity
+                self.count -= 1
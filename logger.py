@@ -1,6 +1,13 @@
 import logging
 
+_initialized = False
+
 def initLogging():
+    # Every module calls this on import: configure the root logger only once
+    global _initialized
+    if _initialized:
+        return
+    _initialized = True
     logging.basicConfig(
         level=logging.DEBUG,
         format='{asctime} {levelname:8} {message}', # 2017-05-25 00:58:28 INFO     An info message
@@ -16,6 +23,15 @@ def initLogging():
 # logging.info('An info message')
 # logging.debug('A debug message')
 
+# CHANGING THE LEVEL AT RUNTIME:
+#
+# logging.getLogger().setLevel(logging.INFO)
+#
+# STRIPPING DEBUG CODE:
+#
+# Code inside "if __debug__:" blocks is removed when compiled with
+# micropython.opt_level(1) (or mpy-cross -O1)
+
 # LOGGING LEVELS:
 #
 # CRITICAL
@@ -1,6 +1,7 @@
 import utime
 import sys
 import uio
+import uos
 
 CRITICAL = 50
 ERROR    = 40
@@ -25,6 +26,11 @@ class Logger:
     def __init__(self, name):
         self.name = name
         self.handlers = None
+        # Handlers format the record synchronously, so one record per logger is reused.
+        # A log call made while the record is in use (e.g. from a callback run by micropython.schedule
+        # in the middle of a handler) gets a record of its own.
+        self._record = None
+        self._busy = False
 
     def _level_str(self, level):
         l = _level_dict.get(level)
@@ -39,14 +45,26 @@ class Logger:
         return level >= (self.level or _level)
 
     def log(self, level, msg, *args):
-        if level >= (self.level or _level):
-            record = LogRecord(
-                self.name, level, None, None, msg, args, None, None, None
-            )
-
-            if self.handlers:
+        if level >= (self.level or _level) and self.handlers:
+            if self._busy:
+                record = LogRecord(self.name, level, None, None, msg, args, None, None, None)
+                for hdlr in self.handlers:
+                    hdlr.emit(record)
+                return
+            record = self._record
+            if record is None:
+                record = self._record = LogRecord(
+                    self.name, level, None, None, msg, args, None, None, None
+                )
+            else:
+                record.reuse(level, msg, args)
+
+            self._busy = True
+            try:
                 for hdlr in self.handlers:
                     hdlr.emit(record)
+            finally:
+                self._busy = False
 
     def debug(self, msg, *args):
         self.log(DEBUG, msg, *args)
@@ -96,20 +114,42 @@ def getLogger(name=None):
     _loggers[name] = l
     return l
 
+# The level is checked before anything else is done.
+# To avoid evaluating expensive arguments too, guard the call with isEnabledFor(), e.g.
+#   if logging.isEnabledFor(logging.DEBUG):
+#       logging.debug('Address: {}', utils.decode_mac(addr))
+# Code inside "if __debug__:" blocks is stripped when compiled with
+# micropython.opt_level(1) or mpy-cross -O1.
+
+def isEnabledFor(level):
+    return level >= (root.level or _level)
+
 def debug(msg, *args):
-    getLogger(None).debug(msg, *args)
+    if DEBUG >= (root.level or _level):
+        root.log(DEBUG, msg, *args)
 
 def info(msg, *args):
-    getLogger(None).info(msg, *args)
+    if INFO >= (root.level or _level):
+        root.log(INFO, msg, *args)
 
 def warning(msg, *args):
-    getLogger(None).warning(msg, *args)
+    if WARNING >= (root.level or _level):
+        root.log(WARNING, msg, *args)
 
 def error(msg, *args):
-    getLogger(None).error(msg, *args)
+    if ERROR >= (root.level or _level):
+        root.log(ERROR, msg, *args)
 
 def critical(msg, *args):
-    getLogger(None).critical(msg, *args)
+    if CRITICAL >= (root.level or _level):
+        root.log(CRITICAL, msg, *args)
+
+def shutdown():
+    # Flush all the handlers (e.g. before a reset)
+    for l in _loggers.values():
+        if l.handlers:
+            for hdlr in l.handlers:
+                hdlr.flush()
 
 def basicConfig(level=INFO, filename=None, stream=None, format=None, datefmt=None, style="%"):
     global _level
@@ -130,6 +170,9 @@ class Handler:
     def setFormatter(self, fmt):
         self.formatter = fmt
 
+    def flush(self):
+        pass
+
 
 class StreamHandler(Handler):
     def __init__(self, stream=None):
@@ -164,11 +207,80 @@ class FileHandler(Handler):
 
         self._f.write(self.formatter.format(record) + self.terminator)
 
+    def flush(self):
+        if self._f is not None:
+            self._f.flush()
+
     def close(self):
         if self._f is not None:
             self._f.close()
 
 
+class RotatingFileHandler(Handler):
+    # Buffers the formatted records in RAM and appends them to filename in blocks,
+    # once buffer_size bytes are pending or flush_interval seconds have passed.
+    # Before filename grows over max_bytes it is renamed to filename.1 (filename.1 to
+    # filename.2, ...), keeping backup_count old files.
+    def __init__(self, filename, max_bytes=16384, backup_count=2, buffer_size=1024, flush_interval=60):
+        super().__init__()
+
+        self.terminator = "\n"
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        self._buffer = []
+        self._pending = 0
+        self._last_flush = utime.time()
+
+    def emit(self, record):
+        line = self.formatter.format(record) + self.terminator
+        self._buffer.append(line)
+        self._pending += len(line)
+        if self._pending >= self.buffer_size or utime.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = utime.time()
+        if not self._buffer:
+            return
+        try:
+            try:
+                size = uos.stat(self.filename)[6]
+            except OSError:
+                size = 0
+            if size and size + self._pending > self.max_bytes:
+                self._rotate()
+            f = open(self.filename, "a")
+            for line in self._buffer:
+                f.write(line)
+            f.close()
+        except Exception as e:
+            sys.stderr.write("RotatingFileHandler: " + str(e) + self.terminator)
+        self._buffer.clear()
+        self._pending = 0
+
+    def _rotate(self):
+        for i in range(self.backup_count, 0, -1):
+            src = self.filename if i == 1 else "%s.%d" % (self.filename, i - 1)
+            dst = "%s.%d" % (self.filename, i)
+            try:
+                uos.remove(dst)
+            except OSError:
+                pass
+            try:
+                uos.rename(src, dst)
+            except OSError:
+                pass
+        if self.backup_count == 0:
+            uos.remove(self.filename)
+
+    def close(self):
+        self.flush()
+
+
 class Formatter:
 
     converter = utime.localtime
@@ -181,24 +293,64 @@ class Formatter:
             raise ValueError("Style must be one of: %, {")
 
         self.style = style
+        self._compile()
+
+    def _compile(self):
+        # Turn the named fields of fmt into positional ones, once:
+        #   "{asctime} {levelname:8} {message}" -> "{} {:8} {}"
+        #   "%(asctime)s %(message)s"           -> "%s %s"
+        # self._fields lists the record attributes to pass, in order.
+        fmt = self.fmt
+        fields = []
+        out = []
+        i = 0
+        n = len(fmt)
+        while i < n:
+            c = fmt[i]
+            if self.style == "{" and c == "{":
+                if i + 1 < n and fmt[i + 1] == "{":
+                    out.append("{{")
+                    i += 2
+                    continue
+                j = fmt.index("}", i)
+                field = fmt[i + 1:j]
+                k = 0
+                while k < len(field) and field[k] not in ":!":
+                    k += 1
+                fields.append(field[:k])
+                out.append("{" + field[k:] + "}")
+                i = j + 1
+            elif self.style == "%" and c == "%" and i + 1 < n and fmt[i + 1] == "(":
+                j = fmt.index(")", i)
+                fields.append(fmt[i + 2:j])
+                out.append("%")
+                i = j + 1
+            elif self.style == "%" and c == "%" and i + 1 < n and fmt[i + 1] == "%":
+                out.append("%%")
+                i += 2
+            else:
+                out.append(c)
+                i += 1
+        self._fmt = "".join(out)
+        self._fields = tuple(fields)
+        self._uses_time = "asctime" in self._fields
 
     def usesTime(self):
-        if self.style == "%":
-            return "%(asctime)" in self.fmt
-        elif self.style == "{":
-            return "{asctime" in self.fmt
+        return self._uses_time
 
     def format(self, record):
-        if self.style == "%":
+        if not record.args:
+            record.message = record.msg
+        elif self.style == "%":
             # The message attribute of the record is computed using msg % args
             record.message = record.msg % record.args
-        elif self.style == "{":
+        else:
             # The message attribute of the record is computed using msg.format(*args)
             record.message = record.msg.format(*record.args)
 
         # If the formatting string contains '(asctime)', formatTime() is called to
         # format the event time.
-        if self.usesTime():
+        if self._uses_time:
             record.asctime = self.formatTime(record, self.datefmt)
 
         # If there is exception information, it is formatted using formatException()
@@ -208,16 +360,12 @@ class Formatter:
             record.exc_text += self.formatException(record.exc_info)
             record.message += "\n" + record.exc_text
 
-        # The record’s attribute dictionary is used as the operand to a string
-        # formatting operation.
+        # The record attributes named in the format string, in order,
+        # are used as the operands of the (precompiled) formatting operation.
+        values = tuple(getattr(record, f) for f in self._fields)
         if self.style == "%":
-            return self.fmt % record.__dict__
-        elif self.style == "{":
-            return self.fmt.format(**record.__dict__)
-        else:
-            raise ValueError(
-                "Style {0} is not supported by logging.".format(self.style)
-            )
+            return self._fmt % values
+        return self._fmt.format(*values)
 
     def formatTime(self, record, datefmt=None):
         # assert datefmt is None  # datefmt is not supported
@@ -235,6 +383,11 @@ root = getLogger()
 
 
 class LogRecord:
+    __slots__ = (
+        "created", "msecs", "name", "levelno", "levelname", "pathname", "lineno",
+        "msg", "args", "exc_info", "exc_text", "func", "sinfo", "message", "asctime",
+    )
+
     def __init__(
             self, name, level, pathname, lineno, msg, args, exc_info, func=None, sinfo=None
     ):
@@ -251,3 +404,12 @@ class LogRecord:
         self.exc_info = exc_info
         self.func = func
         self.sinfo = sinfo
+
+    def reuse(self, level, msg, args):
+        ct = utime.time()
+        self.created = ct
+        self.msecs = (ct - int(ct)) * 1000
+        self.levelno = level
+        self.levelname = _level_dict.get(level, None)
+        self.msg = msg
+        self.args = args
@@ -1 +1,2 @@
-import mqtt.py
+import mqtt
+mqtt.run()
@@ -3,12 +3,32 @@ from umqtt.simple import MQTTClient
 import ubinascii
 import machine
 import micropython
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+try:
+    import ujson as json
+except ImportError:
+    import json
 import network
 import esp
 esp.osdebug(None)
 import gc
 gc.collect()
 import ble, ntptime
+import backoff
+import decoder
+import claims
+import deadband
+import discovery
+import stats
+import scanner
+import series
+import registry
+import outbox
+import records
+import payload
 import uos
 import utils
 import logging, logger
@@ -21,23 +41,24 @@ global wifi_ssid, wifi_password, client_id, mqtt_server, mqtt_port, mqtt_user, m
 
 
 client_id = ubinascii.hexlify(machine.unique_id())
+mqtt_client = None
 
 
-def connect_wifi():
-    station = network.WLAN(network.STA_IF)
+async def connect_wifi(station):
+    # Returns true once connected, false after <wifi_connect_timeout> seconds
+    logging.info('Connecting to WiFi network ({})...', wifi_ssid)
     station.active(True)
-    while not station.isconnected():
-        logging.info('Connecting to WiFi network ({})...', wifi_ssid)
+    try:
         station.connect(wifi_ssid, wifi_password)
-        # Returns false on timeout
-        timer = 0
-        while not station.isconnected():
-            time.sleep(1)
-            timer += 1
-            if timer > 60:
-                logging.warning('Connection failed')
-                break
-    logging.info('Connection successful {}', station.ifconfig())
+    except OSError as e:
+        utils.log_error_to_file('ERROR: connect to WiFi - ' + str(e))
+        return False
+    for i in range(wifi_connect_timeout):
+        if station.isconnected():
+            logging.info('Connection successful {}', station.ifconfig())
+            return True
+        await asyncio.sleep(1)
+    return station.isconnected()
 
 
 def update_time():
@@ -50,119 +71,559 @@ def update_time():
 
 def connect_mqtt():
     #client = MQTTClient(client_id, mqtt_server)
-    client = MQTTClient(client_id, mqtt_server, mqtt_port, mqtt_user, mqtt_password)
+    client = MQTTClient(client_id, mqtt_server, mqtt_port, mqtt_user, mqtt_password, mqtt_keepalive)
+    if ha_enabled:
+        ha.last_will(client)
     client.connect()
     logging.info('Connected to {} MQTT broker', mqtt_server)
+    if ha_enabled:
+        ha.online(client)
+    if hub_claims or history is not None:
+        # Received by the link_keeper task
+        client.set_callback(on_message)
+    if hub_claims:
+        # Retained claims of the other hubs
+        client.subscribe(claims_topic + b'/+')
+    if history is not None:
+        client.subscribe(backfill_topic)
     return client
 
 
-def restart_and_reconnect():
-    logging.error('Failed to connect to MQTT broker. Restarting in 10 seconds...')
-    time.sleep(10)
-    machine.reset()
+# Set while the broker is connected (mqtt_client is not None)
+connected_event = asyncio.Event()
+# Set to wake up the link_keeper task when the connection is lost
+link_event = asyncio.Event()
 
 
-def cleanup():
-    logging.info('Starting cleanup...')
-    dir = uos.listdir()
-    for f in dir:
-        if f.endswith('.log'):
-            logging.info('Found file: {}', f)
+def link_lost(what, e):
+    # Called by the tasks which fail to use the MQTT connection: it is restored by the link_keeper task,
+    # the registry and the queued readings are kept meanwhile
+    global mqtt_client
+    utils.log_error_to_file('ERROR: ' + what + ' - ' + str(e))
+    if mqtt_client is not None:
+        try:
+            mqtt_client.disconnect()
+        except Exception:
+            pass
+        mqtt_client = None
+    connected_event.clear()
+    link_event.set()
+
+
+async def link_keeper():
+    # Keeps WiFi and the broker connected, in the background: after a failure the connection is
+    # retried with an exponential backoff while the readings keep being queued.
+    # The broker is pinged every <mqtt_ping_interval> seconds to spot a dead connection before a publish,
+    # the messages of the subscriptions (if any) are received every second.
+    global mqtt_client
+    poll = 1 if hub_claims or history is not None else mqtt_ping_interval
+    pinged = 0
+    station = network.WLAN(network.STA_IF)
+    wifi_backoff = backoff.Backoff(mqtt_retry_interval, mqtt_retry_max)
+    mqtt_backoff = backoff.Backoff(mqtt_retry_interval, mqtt_retry_max)
+    while True:
+        if not station.isconnected():
+            if mqtt_client is not None:
+                link_lost('WiFi', 'connection lost')
+            if not await connect_wifi(station):
+                delay = wifi_backoff.failure()
+                logging.warning('WiFi connection failed, retrying in {} seconds', delay)
+                await asyncio.sleep(delay)
+                continue
+            wifi_backoff.reset()
+            update_time()
+
+        if mqtt_client is None:
+            link_event.clear()
             try:
-                year = int(f[:4])
-                month = int(f[4:6])
-                mday = int(f[6:8])
-                filedate = time.mktime((year, month, mday, 0, 0, 0, 0, 0))
-                year, month, mday, hour, minute, second, weekday, yearday = time.localtime()
-                two_days_ago = time.mktime((year, month, mday-2, 0, 0, 0, 0, 0))
-                if filedate < two_days_ago:
-                    logging.debug('Removing...')
-                    uos.remove(f)
-                else:
-                    logging.debug('Keeping...')
+                mqtt_client = connect_mqtt()
+            except Exception as e:
+                delay = mqtt_backoff.failure()
+                utils.log_error_to_file('ERROR: connect to MQTT - ' + str(e))
+                logging.info('Retrying in {} seconds, {} readings queued', delay, len(readings))
+                await asyncio.sleep(delay)
+                continue
+            mqtt_backoff.reset()
+            connected_event.set()
+            pinged = time.time()
 
+        try:
+            await asyncio.wait_for(link_event.wait(), poll)
+        except asyncio.TimeoutError:
+            pass
+        if mqtt_client is not None and not link_event.is_set():
+            try:
+                if time.time() - pinged >= mqtt_ping_interval:
+                    mqtt_client.ping()
+                    pinged = time.time()
+                mqtt_client.check_msg()
             except Exception as e:
-                # logging.error('ERROR: cleanup {}', str(e))
+                link_lost('ping MQTT', e)
+
+
+def cleanup():
+    # Error logs are now kept in a fixed ring of files (ble.log, ble.log.1, ...):
+    # only the daily files written by older versions (<YYYYMMDD>ble.log) need to be removed
+    logging.info('Starting cleanup...')
+    for f in uos.listdir():
+        if f.endswith('ble.log') and len(f) == 15 and f[:8].isdigit():
+            logging.info('Removing file: {}', f)
+            try:
+                uos.remove(f)
+            except OSError as e:
                 logging.debug('Skipping...')
-                pass
     logging.info('Cleanup ended')
 
 
-# Start execution
+# Readings waiting to be published, drained by the mqtt_publisher task.
+# They are kept while the broker or WiFi is down and replayed (with their timestamp) afterwards.
+readings = outbox.Outbox(outbox_size, outbox_spill_file, outbox_spill_max)
+outbox_event = asyncio.Event()
 
-connect_wifi()
-update_time()
-cleanup()
+# Serializes the BLE operations of the ble_reader and rescanner tasks
+ble_lock = asyncio.Lock()
 
-try:
-    mqtt_client = connect_mqtt()
-except OSError as e:
-    restart_and_reconnect()
-
-myBLE = ble.Ble()
-myBLE.setup(scan_for_devices, devices_list)
-
-for a in myBLE.addresses:
-    device_index, type, address, name, last_read = a
-    logging.info('Device found - Type: {} - Address: {} - Name: {}', type, utils.decode_mac(address), name)
-
-last_time_update = utils.timestamp('day')
-last_cleanup = utils.timestamp('day')
-last_scan = time.time()
-while True:
-    today = utils.timestamp('day')
-    current_time = time.time()
-
-    # Update the RTC once a day
-    if today != last_time_update:
-        update_time()
-        last_time_update = today
-
-    # Cleanup filesystem once a day
-    if today != last_cleanup:
-        cleanup()
-        last_cleanup = today
-
-    # Re-scan for devices every <scan_interval> seconds
-    if current_time > last_scan + scan_interval:
-        myBLE.setup(scan_for_devices, devices_list)
-        last_scan = current_time
-
-    # Cycle through the captured addresses
-    oldest_read = current_time + read_interval
-    for a in myBLE.addresses:
-        myBLE.device_index, myBLE.type, myBLE.address, myBLE.name, myBLE.last_read = a
-        # if this is a 'LYWSD03MMC'
-        if myBLE.name == 'LYWSD03MMC' and (time.time() - myBLE.last_read >= read_interval):
-            print('--------------------------------------------------')
-            # if we are successful reading the values
-            if myBLE.get_reading():
-                message = '{"temperature": "' + str(myBLE.temperature) + '", '
-                message = message + '"humidity": "' + str(myBLE.humidity) + '", '
-                message = message + '"batteryLevel": "' + str(myBLE.battery_level) + '", '
-                message = message + '"batteryVoltage": "' + str(myBLE.battery_voltage) + '"}'
-                logging.debug('Message: {}', message)
-                topic = topic_pub + '/' + ''.join('{:02x}'.format(b) for b in myBLE.address)
-                logging.debug('Topic: {}', topic)
-                try:
-                    mqtt_client.publish(topic, message)
-                except Exception as e:
-                    utils.log_error_to_file('ERROR: publish to MQTT - ' + str(e))
-                    try:
-                        mqtt_client.disconnect()
-                        mqtt_client = connect_mqtt()
-                    except OSError as e:
-                        restart_and_reconnect()
-
-        if oldest_read > myBLE.last_read:
-            oldest_read = myBLE.last_read
-
-    # Wait for the next cycle
+
+def publish_reading(address, temperature, humidity, battery_level, battery_voltage):
+    readings.put(int(time.time()), bytes(address), (temperature, humidity, battery_level, battery_voltage))
+    outbox_event.set()
+
+
+# Home Assistant discovery (the value templates need JSON payloads)
+ha_enabled = ha_discovery and payload_format != payload.FORMAT_CBOR
+ha = discovery.Discovery(device_capacity, ha_discovery_prefix, topic_pub, client_id, aggregate_readings, not hub_claims)
+
+
+def announce_devices():
+    # Call when devices were added or identified: announces them to Home Assistant
+    if ha_enabled and ha.update(myBLE.addresses):
+        outbox_event.set()
+
+
+def set_available(slot, available):
+    if ha_enabled and ha.set_available(slot, available):
+        if not available:
+            logging.warning('{} is unavailable', utils.decode_mac(myBLE.addresses.mac(slot)))
+        announce_devices()
+
+
+# Drops the readings which didn't change enough since the last published one
+publish_filter = deadband.PublishFilter(device_capacity, publish_deadband_temperature, publish_deadband_humidity,
+                                        publish_deadband_battery, publish_heartbeat, publish_smoothing,
+                                        publish_smoothing_alpha, publish_smoothing_window)
+
+
+def publish_filtered(slot, reading):
+    # Publishes the reading of a registered device (smoothed) unless it is filtered out
+    set_available(slot, True)
+    if history is not None:
+        history.add(slot, time.time(), reading[0], reading[1])
+    reading = publish_filter.update(slot, time.time(), reading)
+    if reading is None:
+        logging.info('Reading of {} unchanged, not published', utils.decode_mac(myBLE.addresses.mac(slot)))
+        myBLE.stats.count(slot, stats.COUNT_FILTERED)
+        return
+    temperature, humidity, battery_level, battery_voltage = reading
+    publish_reading(myBLE.addresses.mac(slot), temperature, humidity, battery_level, battery_voltage)
+
+
+# Payloads are written into this preallocated buffer
+encoder = payload.Encoder(payload_buffer_size)
+
+
+def device_topic(address):
+    devices = myBLE.addresses
+    slot = devices.find(address)
+    if slot < 0:
+        # Not in the registry (full): computed on every publish
+        return topic_pub + b'/' + ubinascii.hexlify(address)
+    return devices.topic(slot, topic_pub)
+
+
+def publish_batch(batch):
+    # Returns the number of entries of the batch which have been published
+    if not batch:
+        # Only discovery or availability messages were pending
+        return 0
+    if aggregate_readings:
+        # One message for the whole batch, keyed by MAC address
+        try:
+            message = encoder.aggregate(payload_format, batch)
+        except ValueError as e:
+            # Doesn't fit in the payload buffer: publish the readings one by one
+            logging.warning('Aggregate message too large ({})', str(e))
+            message = None
+        if message is not None:
+            topic = topic_pub + b'/' + client_id
+            if __debug__:
+                if logging.isEnabledFor(logging.DEBUG):
+                    logging.debug('Topic: {} - Message: {}', topic, bytes(message))
+            mqtt_client.publish(topic, message)
+            return len(batch)
+
+    published = 0
+    for timestamp, address, reading in batch:
+        message = encoder.reading(payload_format, timestamp, reading)
+        topic = device_topic(address)
+        if __debug__:
+            if logging.isEnabledFor(logging.DEBUG):
+                logging.debug('Topic: {} - Message: {}', topic, bytes(message))
+        try:
+            mqtt_client.publish(topic, message)
+        except Exception as e:
+            utils.log_error_to_file('ERROR: publish to MQTT - ' + str(e))
+            break
+        published += 1
+    return published
+
+
+# Last values received through advertisements: {address: [temperature, humidity, battery_level, battery_voltage, last_published]}
+advertised = {}
+
+
+def publish_advertisement(address, reading):
+    # MiBeacon frames only carry one value at a time: merge them with the previous ones
+    values = advertised.get(address)
+    if values is None:
+        values = [None, None, None, None, 0]
+        advertised[address] = values
+    for i in range(4):
+        if reading[i] is not None:
+            values[i] = reading[i]
+
+    if values[0] is None or values[1] is None:
+        return
+    if time.time() - values[4] < read_interval:
+        return
+    logging.info('Advertisement received from {}', utils.decode_mac(address))
+    # Registered to cache its topic
+    slot = myBLE.addresses.add(address)
+    values[4] = time.time()
+    if slot < 0:
+        publish_reading(address, values[0], values[1], values[2], values[3])
+    else:
+        publish_filtered(slot, values[:4])
+
+
+async def mqtt_publisher():
+    while True:
+        if not len(readings) and not (ha_enabled and ha.pending()):
+            await outbox_event.wait()
+            outbox_event.clear()
+
+        if mqtt_client is None:
+            # Reconnected by the link_keeper task
+            await connected_event.wait()
+            continue
+
+        if ha_enabled:
+            try:
+                ha.publish(mqtt_client, myBLE.addresses)
+            except Exception as e:
+                link_lost('publish discovery', e)
+                continue
+
+        batch = readings.peek(publish_batch_size)
+        try:
+            published = publish_batch(batch)
+        except Exception as e:
+            utils.log_error_to_file('ERROR: publish to MQTT - ' + str(e))
+            published = 0
+        readings.commit(published)
+
+        if published < len(batch):
+            # Keep the remaining readings and reconnect
+            link_lost('publish to MQTT', '{} readings not published'.format(len(batch) - published))
+        # Let the other tasks run between two batches
+        await asyncio.sleep(0)
+
+
+# Next reading of each device
+read_scheduler = scanner.ReadScheduler(device_capacity, read_interval, read_retry_interval, read_max_backoff,
+                                       read_jitter / 100, read_fast_interval, read_change_temperature, read_change_humidity)
+# Per-device read intervals, by MAC address
+device_read_intervals = {bytes(utils.encode_mac(mac)): seconds for mac, seconds in read_intervals.items()}
+# Sensors kept connected (keep-alive mode), not polled
+keep_alive_devices = [bytes(utils.encode_mac(mac)) for mac in keep_alive]
+# Set when new devices are scheduled, to wake up the ble_reader task
+reader_event = asyncio.Event()
+
+
+def schedule_devices():
+    # Schedule the sensors not scheduled yet (call after each scan)
+    devices = myBLE.addresses
     now = time.time()
-    if oldest_read < now:
-        delay = read_interval - now + oldest_read
-        if delay > 0:
+    for i in range(len(devices)):
+        if registry.is_sensor(devices.names[i]) and not read_scheduler.scheduled(i) and bytes(devices.mac(i)) not in keep_alive_devices:
+            read_scheduler.set_interval(i, device_read_intervals.get(bytes(devices.mac(i)), read_interval))
+            read_scheduler.add(i, now)
+            sensor_claims.track(i)
+    reader_event.set()
+    announce_devices()
+
+
+def on_reading(slot, reading):
+    read_scheduler.success(slot, time.time(), reading[0], reading[1])
+    publish_filtered(slot, reading)
+
+
+async def ble_reader():
+    while True:
+        due = read_scheduler.pop_due(time.time())
+        if hub_claims:
+            # Sensors read by another hub: checked again later, in case they are released
+            now = time.time()
+            for slot in due:
+                if not sensor_claims.owned(slot, now):
+                    read_scheduler.skip(slot, now, read_retry_interval)
+            due = [slot for slot in due if sensor_claims.owned(slot, now)]
+        if due:
+            print('--------------------------------------------------')
+            start = time.ticks_ms()
+            async with ble_lock:
+                await myBLE.read_devices(due, on_reading, max_concurrent_reads)
+            myBLE.stats.record_cycle(start)
+            # The devices which have not been rescheduled by on_reading have failed
+            now = time.time()
+            for slot in due:
+                if not read_scheduler.scheduled(slot):
+                    read_scheduler.failure(slot, now)
+                    if read_scheduler.failures[slot] >= ha_offline_failures:
+                        set_available(slot, False)
+                    if hub_claims and read_scheduler.failures[slot] >= claim_release_failures:
+                        # Let another hub try
+                        sensor_claims.release(slot, now)
+
+        # Wait for the next reading (or for new devices)
+        delay = read_scheduler.next_due(time.time())
+        if delay:
             print('--------------------------------------------------')
             logging.debug('Waiting for {} seconds...', delay)
-            time.sleep(delay)
+        if delay != 0:
+            reader_event.clear()
+            try:
+                await asyncio.wait_for(reader_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+def on_notification(slot, reading):
+    # Keep-alive mode: every notification goes through the publish filter
+    publish_filtered(slot, reading)
+
+
+async def passive_scanner():
+    # Passive mode: sensors are never connected to, their advertisements are decoded instead
+    myBLE.on_advertisement = publish_advertisement
+    while True:
+        # (Re)start the scan if the BLE stack stopped it
+        if not myBLE.passive:
+            myBLE.start_passive_scan(passive_scan_interval_us, passive_scan_window_us)
+        await asyncio.sleep(1)
+
+
+async def rescanner():
+    # Short, low duty-cycle scans, interleaved with the readings (they share ble_lock).
+    # They are repeated every <scan_min_interval> seconds while new devices show up,
+    # then backed off up to <scan_interval> seconds once the device set is stable.
+    scheduler = scanner.ScanScheduler(scan_min_interval, scan_interval, scan_idle_rounds)
+    while True:
+        await asyncio.sleep(scheduler.interval)
+        async with ble_lock:
+            new_devices = await myBLE.setup(scan_for_devices, devices_list, scan_duration_ms, scan_interval_us, scan_window_us)
+        if new_devices:
+            logging.info('{} new devices found', new_devices)
+        # Also schedules the known devices identified by this pass (their first identification failed)
+        schedule_devices()
+        scheduler.update(new_devices)
+
+
+async def ntp_sync():
+    # Update the RTC every <ntp_interval> seconds
+    while True:
+        await asyncio.sleep(ntp_interval)
+        update_time()
+
+
+async def stats_publisher():
+    # Publish the per-device latencies and failure counters, and the loop statistics,
+    # every <stats_interval> seconds (the counters restart from 0 after each report)
+    topic = topic_pub + b'/' + client_id + b'/stats'
+    while True:
+        await asyncio.sleep(stats_interval)
+        if mqtt_client is None:
+            continue
+        try:
+            mqtt_client.publish(topic, json.dumps(myBLE.stats.report(myBLE.addresses)))
+        except Exception as e:
+            link_lost('publish stats', e)
+
 
+# Sensors shared with the other hubs (multi-hub mode)
+claims_topic = topic_pub + b'/claims'
+sensor_claims = claims.ClaimTable(device_capacity, client_id, claims_topic, claim_lease, claim_margin)
+
+
+# Last readings of each device, aggregated on <topic_pub>/<mac>/aggregate/<window>
+history = series.TimeSeries(device_capacity, series_length) if series_length else None
+backfill_topic = topic_pub + b'/' + client_id + b'/backfill'
+
+
+def on_message(topic, msg):
+    # Called by check_msg: an exception would be taken for a lost connection (and retained messages
+    # are sent again on every reconnection), so a message which can't be handled is only logged
+    try:
+        if topic.startswith(claims_topic):
+            sensor_claims.receive(myBLE.addresses, topic, msg, time.time())
+        elif topic == backfill_topic:
+            backfill(msg)
+    except Exception as e:
+        utils.log_error_to_file('ERROR: message on ' + str(topic) + ' - ' + str(e))
+
+
+def backfill(msg):
+    # Answers a request {"mac": "a4c138xxxxxx", "since": <unix time>} on <topic_pub>/<client_id>/backfill
+    # with the samples kept for the device: {"samples": [[<unix time>, <temperature>, <humidity>], ...]}
+    # on <topic_pub>/<mac>/history
+    try:
+        request = json.loads(msg)
+        mac = ubinascii.unhexlify(request['mac'].replace(':', ''))
+        if len(mac) != 6:
+            raise ValueError('invalid MAC address')
+        since = request.get('since', 0)
+        if not isinstance(since, (int, float)):
+            raise TypeError('invalid since')
+        since -= payload.EPOCH_OFFSET
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        utils.log_error_to_file('ERROR: backfill request ' + str(bytes(msg)[:64]) + ' - ' + str(e))
+        return
+    slot = myBLE.addresses.find(mac)
+    if slot < 0:
+        logging.warning('Backfill request for an unknown device: {}', utils.decode_mac(mac))
+        return
+    samples = [[t + payload.EPOCH_OFFSET, temperature, humidity] for t, temperature, humidity in history.samples(slot, since)]
+    logging.info('Backfill of {}: {} samples', utils.decode_mac(mac), len(samples))
+    mqtt_client.publish(myBLE.addresses.topic(slot, topic_pub) + b'/history', json.dumps({'samples': samples}))
+
+
+# History records stored by the sensors, fetched after a gap in their readings (backfill)
+record_marks = records.HighWaterMarks(device_capacity, backfill_interval, backfill_gap) if history_backfill else None
+
+
+def publish_records(slot, fetched):
+    # Publishes the history records fetched from a sensor on <topic_pub>/<mac>/records, oldest first.
+    # The high-water mark of the sensor only moves past the records published: the others are fetched
+    # again by the next backfill.
+    if mqtt_client is None:
+        logging.warning('Broker not connected: {} records left on the sensor', len(fetched))
+        return
+    topic = myBLE.addresses.topic(slot, topic_pub) + b'/records'
+    for index, timestamp, t_min, t_max, h_min, h_max in fetched:
+        try:
+            mqtt_client.publish(topic, json.dumps({
+                'index': index,
+                'temperature': {'min': t_min, 'max': t_max},
+                'humidity': {'min': h_min, 'max': h_max},
+                'timestamp': utils.format_time(timestamp),
+            }))
+        except Exception as e:
+            link_lost('publish records', e)
+            return
+        record_marks.advance(slot, index)
+
+
+async def aggregate_publisher():
+    # Publishes the min/max/mean/trend of the last readings of each device over each of <aggregate_windows>
+    # (seconds), every <aggregate_interval> seconds
+    while True:
+        await asyncio.sleep(aggregate_interval)
+        if mqtt_client is None:
+            continue
+        devices = myBLE.addresses
+        now = time.time()
+        try:
+            for slot in range(len(devices)):
+                for window in aggregate_windows:
+                    aggregate = history.aggregate(slot, now, window)
+                    if aggregate is None:
+                        continue
+                    aggregate['window'] = window
+                    aggregate['timestamp'] = now + payload.EPOCH_OFFSET
+                    mqtt_client.publish(devices.topic(slot, topic_pub) + b'/aggregate/' + str(window).encode(),
+                                        json.dumps(aggregate))
+                await asyncio.sleep(0)
+        except Exception as e:
+            link_lost('publish aggregates', e)
+
+
+async def claims_keeper():
+    # Multi-hub mode: publishes the claims of this hub (the claims of the other hubs are received
+    # by the link_keeper task)
+    while True:
+        await asyncio.sleep(1)
+        if mqtt_client is None:
+            continue
+        try:
+            sensor_claims.publish(mqtt_client, myBLE.addresses, time.time(), myBLE.stats.rssi)
+        except Exception as e:
+            link_lost('claims', e)
+
+
+async def log_flusher():
+    # Write the buffered log records to flash at least every <log_flush_interval> seconds
+    while True:
+        await asyncio.sleep(log_flush_interval)
+        utils.flush_logs()
+
+
+async def main():
+    tasks = [link_keeper(), mqtt_publisher(), ntp_sync(), log_flusher()]
+    if stats_interval:
+        tasks.append(stats_publisher())
+    if hub_claims and not passive_scan:
+        tasks.append(claims_keeper())
+    if history is not None and aggregate_interval:
+        tasks.append(aggregate_publisher())
+    if passive_scan:
+        tasks.append(passive_scanner())
+    else:
+        # Skip the initial scan if the device cache already knows some sensors:
+        # new devices are discovered by the rescanner task
+        cached = myBLE.load_cache()
+        devices = myBLE.addresses
+        for mac in keep_alive_devices:
+            devices.add(mac)
+        await myBLE.setup(scan_for_devices and not cached, devices_list, scan_duration_ms, scan_interval_us, scan_window_us)
+        for i in range(len(devices)):
+            logging.info('Device found - Type: {} - Address: {} - Name: {}', devices.types[i], utils.decode_mac(devices.mac(i)), devices.names[i])
+        schedule_devices()
+        # Keep-alive sensors: connected once, then they push their readings
+        for mac in keep_alive_devices:
+            slot = devices.find(mac)
+            if slot < 0:
+                continue
+            if devices.names[slot] == registry.DEVICE_NAME_PLACEHOLDER:
+                # Not identified (e.g. out of reach for now): the stream will resolve its handles
+                devices.names[slot] = registry.SENSOR_MODELS[0]
+            tasks.append(myBLE.stream(slot, on_notification, keep_alive_retry * 1000, keep_alive_timeout * 1000))
+        tasks.append(ble_reader())
+        tasks.append(rescanner())
+    await asyncio.gather(*tasks)
+
+
+def run():
+    # WiFi and the broker are connected by the link_keeper task, while the sensors are discovered
+    global myBLE
+    logging.getLogger().setLevel(log_level)
+    cleanup()
+
+    myBLE = ble.Ble(device_capacity, max_concurrent_reads + len(keep_alive_devices), device_cache, gatt_cache)
+    myBLE.connect_timeout_ms = connect_timeout * 1000
+    myBLE.set_scan_filter(scan_min_rssi, [utils.encode_mac(oui) for oui in scan_ouis], scan_filter, scan_active)
+    decoder.set_battery_curve(battery_curve)
+    if record_marks is not None:
+        myBLE.set_backfill(record_marks, backfill_max_records, publish_records, backfill_file)
+    try:
+        asyncio.run(main())
+    finally:
+        utils.flush_logs()
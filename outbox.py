@@ -0,0 +1,170 @@
+from micropython import const
+import struct
+import uos
+import utils
+import logging, logger
+logger.initLogging()
+
+# Spill file layout:
+#   header: magic (4), number of records already published (uint32)
+#   record: time, MAC, temperature (0.01 C), humidity (0.01 %),
+#           battery level (%), battery voltage (mV). Missing values use the _NO_* markers.
+_MAGIC = b'LYWO'
+_HEADER = '<4sI'
+_HEADER_SIZE = const(8)
+_RECORD = '<I6shHBH'
+_RECORD_SIZE = const(17)
+_NO_TEMPERATURE = const(-32768)
+_NO_HUMIDITY    = const(0xffff)
+_NO_LEVEL       = const(0xff)
+_NO_VOLTAGE     = const(0)
+
+
+def _pack(entry):
+    timestamp, address, (temperature, humidity, battery_level, battery_voltage) = entry
+    return struct.pack(_RECORD, timestamp, bytes(address),
+                       _NO_TEMPERATURE if temperature is None else int(round(temperature * 100)),
+                       _NO_HUMIDITY if humidity is None else int(round(humidity * 100)),
+                       _NO_LEVEL if battery_level is None else battery_level,
+                       _NO_VOLTAGE if battery_voltage is None else int(round(battery_voltage * 1000)))
+
+
+def _unpack(data):
+    timestamp, address, temperature, humidity, battery_level, battery_voltage = struct.unpack(_RECORD, data)
+    return (timestamp, address,
+            (None if temperature == _NO_TEMPERATURE else temperature / 100,
+             None if humidity == _NO_HUMIDITY else humidity / 100,
+             None if battery_level == _NO_LEVEL else battery_level,
+             None if battery_voltage == _NO_VOLTAGE else battery_voltage / 1000))
+
+
+class Outbox:
+    # Bounded FIFO of the readings waiting to be published, as
+    # (timestamp, address, (temperature, humidity, battery_level, battery_voltage)) entries.
+    # When the RAM ring is full the oldest entry is moved to spill_file (if set) or dropped.
+    # Spilled entries are older than the ones in RAM, so they are replayed first. The file holds
+    # at most spill_max entries, published or not: it is only deleted once fully replayed.
+    def __init__(self, capacity=64, spill_file=None, spill_max=2000):
+        self.capacity = capacity
+        self.spill_file = spill_file
+        self.spill_max = spill_max
+        self._ring = [None] * capacity
+        self._head = 0          # oldest entry
+        self._count = 0
+        self._spilled = 0       # entries in spill_file not yet published
+        self._published = 0     # entries at the start of spill_file already published
+        self.dropped = 0
+        if spill_file is not None:
+            self._load_spill()
+
+    def __len__(self):
+        return self._spilled + self._count
+
+    def put(self, timestamp, address, reading):
+        if self._count == self.capacity:
+            oldest = self._ring[self._head]
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            if not self._spill(oldest):
+                self.dropped += 1
+        self._ring[(self._head + self._count) % self.capacity] = (timestamp, address, reading)
+        self._count += 1
+
+    def peek(self, n):
+        # Returns up to n of the oldest entries, without removing them
+        entries = []
+        if self._spilled:
+            try:
+                f = open(self.spill_file, 'rb')
+                try:
+                    f.seek(_HEADER_SIZE + self._published * _RECORD_SIZE)
+                    for i in range(min(n, self._spilled)):
+                        entries.append(_unpack(f.read(_RECORD_SIZE)))
+                finally:
+                    f.close()
+            except Exception as e:
+                utils.log_error_to_file('ERROR: read ' + self.spill_file + ' - ' + str(e))
+                self._discard_spill()
+            if entries:
+                return entries
+        for i in range(min(n, self._count)):
+            entries.append(self._ring[(self._head + i) % self.capacity])
+        return entries
+
+    def commit(self, n):
+        # Removes the n oldest entries (once they have been published)
+        if self._spilled:
+            n = min(n, self._spilled)
+            self._spilled -= n
+            self._published += n
+            if not self._spilled:
+                self._discard_spill()
+            else:
+                self._save_published()
+            return
+        n = min(n, self._count)
+        for i in range(n):
+            self._ring[self._head] = None
+            self._head = (self._head + 1) % self.capacity
+        self._count -= n
+
+    def _spill(self, entry):
+        if self.spill_file is None or self._published + self._spilled >= self.spill_max:
+            return False
+        try:
+            new = not (self._published or self._spilled)
+            f = open(self.spill_file, 'wb' if new else 'ab')
+            try:
+                if new:
+                    f.write(struct.pack(_HEADER, _MAGIC, 0))
+                f.write(_pack(entry))
+            finally:
+                f.close()
+        except Exception as e:
+            utils.log_error_to_file('ERROR: write ' + self.spill_file + ' - ' + str(e))
+            return False
+        self._spilled += 1
+        return True
+
+    def _save_published(self):
+        # Rewrites the header, so that a restart resumes the replay after the entries published
+        try:
+            f = open(self.spill_file, 'r+b')
+            try:
+                f.write(struct.pack(_HEADER, _MAGIC, self._published))
+            finally:
+                f.close()
+        except Exception as e:
+            utils.log_error_to_file('ERROR: write ' + self.spill_file + ' - ' + str(e))
+
+    def _load_spill(self):
+        # Resumes the replay of the spill file left by the previous run
+        try:
+            f = open(self.spill_file, 'rb')
+            try:
+                header = f.read(_HEADER_SIZE)
+            finally:
+                f.close()
+            size = uos.stat(self.spill_file)[6]
+        except OSError:
+            return
+        if len(header) < _HEADER_SIZE or header[:4] != _MAGIC:
+            logging.warning('{} ignored (unknown format)', self.spill_file)
+            self._discard_spill()
+            return
+        published = struct.unpack(_HEADER, header)[1]
+        entries = (size - _HEADER_SIZE) // _RECORD_SIZE
+        if published >= entries:
+            self._discard_spill()
+            return
+        self._published = published
+        self._spilled = entries - published
+        logging.info('{} readings waiting in {}', self._spilled, self.spill_file)
+
+    def _discard_spill(self):
+        self._spilled = 0
+        self._published = 0
+        try:
+            uos.remove(self.spill_file)
+        except OSError:
+            pass
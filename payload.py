@@ -0,0 +1,202 @@
+from micropython import const
+import utime as time
+
+# Payload formats
+FORMAT_JSON = 'json'
+FORMAT_CBOR = 'cbor'
+
+# CBOR major types
+_CBOR_UINT  = const(0x00)
+_CBOR_NINT  = const(0x20)
+_CBOR_BYTES = const(0x40)
+_CBOR_MAP   = const(0xa0)
+
+_HEX = b'0123456789abcdef'
+
+# time.time() counts from 2000 on the ESP32 port, CBOR timestamps from 1970
+EPOCH_OFFSET = 946684800 if time.localtime(0)[0] == 2000 else 0
+
+
+class Encoder:
+    # Writes sensor payloads into a preallocated buffer.
+    # getvalue() returns a memoryview of the payload, valid until the next reset().
+    #
+    # JSON: {"temperature": 21.51, "humidity": 45, "batteryLevel": 83, "batteryVoltage": 2.932, "timestamp": "2020-01-01T00:00:00Z"}
+    # CBOR: {"t": <0.01 C>, "h": <0.01 %>, "b": <%>, "v": <mV>, "ts": <seconds since 1970>}, integers only
+    # Missing values are left out.
+    def __init__(self, size=512):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._pos = 0
+
+    def reset(self):
+        self._pos = 0
+
+    def getvalue(self):
+        return self._mv[:self._pos]
+
+    def _byte(self, b):
+        if self._pos >= len(self._buf):
+            raise ValueError('payload buffer full')
+        self._buf[self._pos] = b
+        self._pos += 1
+
+    def raw(self, data):
+        n = len(data)
+        if self._pos + n > len(self._buf):
+            raise ValueError('payload buffer full')
+        self._buf[self._pos:self._pos + n] = data
+        self._pos += n
+
+    def _uint(self, n, width=1):
+        # Decimal digits of n >= 0, zero padded to width
+        d = 1
+        while width > 1 or d * 10 <= n:
+            d *= 10
+            width -= 1
+        while d:
+            self._byte(48 + n // d % 10)
+            d //= 10
+
+    def _fixed(self, n, decimals):
+        # Decimal representation of n / 10**decimals, without trailing zeroes
+        if n < 0:
+            self._byte(45)      # '-'
+            n = -n
+        scale = 10 ** decimals
+        self._uint(n // scale)
+        n %= scale
+        if n:
+            while n % 10 == 0:
+                n //= 10
+                decimals -= 1
+            self._byte(46)      # '.'
+            self._uint(n, decimals)
+
+    def _hex(self, data):
+        for b in data:
+            self._byte(_HEX[b >> 4])
+            self._byte(_HEX[b & 0x0f])
+
+    def _time(self, seconds):
+        yy, mm, dd, hh, MM, ss = time.localtime(seconds)[:6]
+        self._uint(yy, 4)
+        self._byte(45)
+        self._uint(mm, 2)
+        self._byte(45)
+        self._uint(dd, 2)
+        self._byte(84)          # 'T'
+        self._uint(hh, 2)
+        self._byte(58)
+        self._uint(MM, 2)
+        self._byte(58)
+        self._uint(ss, 2)
+        self._byte(90)          # 'Z'
+
+    def json_reading(self, timestamp, reading):
+        temperature, humidity, battery_level, battery_voltage = reading
+        self._byte(123)         # '{'
+        if temperature is not None:
+            self.raw(b'"temperature": ')
+            self._fixed(int(round(temperature * 100)), 2)
+            self.raw(b', ')
+        if humidity is not None:
+            self.raw(b'"humidity": ')
+            self._fixed(int(round(humidity * 100)), 2)
+            self.raw(b', ')
+        if battery_level is not None:
+            self.raw(b'"batteryLevel": ')
+            self._fixed(battery_level, 0)
+            self.raw(b', ')
+        if battery_voltage is not None:
+            self.raw(b'"batteryVoltage": ')
+            self._fixed(int(round(battery_voltage * 1000)), 3)
+            self.raw(b', ')
+        self.raw(b'"timestamp": "')
+        self._time(timestamp)
+        self.raw(b'"}')
+
+    def json_key(self, address):
+        # "<mac>": (aggregate messages)
+        self._byte(34)
+        self._hex(address)
+        self.raw(b'": ')
+
+    def _cbor_head(self, major, n):
+        if n < 24:
+            self._byte(major | n)
+        elif n < 0x100:
+            self._byte(major | 24)
+            self._byte(n)
+        elif n < 0x10000:
+            self._byte(major | 25)
+            self._byte(n >> 8)
+            self._byte(n & 0xff)
+        else:
+            self._byte(major | 26)
+            for shift in (24, 16, 8, 0):
+                self._byte((n >> shift) & 0xff)
+
+    def _cbor_int(self, n):
+        if n < 0:
+            self._cbor_head(_CBOR_NINT, -1 - n)
+        else:
+            self._cbor_head(_CBOR_UINT, n)
+
+    def cbor_map(self, n):
+        self._cbor_head(_CBOR_MAP, n)
+
+    def cbor_key(self, address):
+        # MAC address as a byte string key (aggregate messages)
+        self._cbor_head(_CBOR_BYTES, len(address))
+        self.raw(address)
+
+    def cbor_reading(self, timestamp, reading):
+        temperature, humidity, battery_level, battery_voltage = reading
+        n = 1
+        for value in reading:
+            if value is not None:
+                n += 1
+        self.cbor_map(n)
+        if temperature is not None:
+            self.raw(b'\x61t')
+            self._cbor_int(int(round(temperature * 100)))
+        if humidity is not None:
+            self.raw(b'\x61h')
+            self._cbor_int(int(round(humidity * 100)))
+        if battery_level is not None:
+            self.raw(b'\x61b')
+            self._cbor_int(battery_level)
+        if battery_voltage is not None:
+            self.raw(b'\x61v')
+            self._cbor_int(int(round(battery_voltage * 1000)))
+        self.raw(b'\x62ts')
+        self._cbor_int(timestamp + EPOCH_OFFSET)
+
+    def reading(self, format, timestamp, reading):
+        self.reset()
+        if format == FORMAT_CBOR:
+            self.cbor_reading(timestamp, reading)
+        else:
+            self.json_reading(timestamp, reading)
+        return self.getvalue()
+
+    def aggregate(self, format, batch):
+        # One message for a batch of (timestamp, address, reading) entries, keyed by MAC address
+        self.reset()
+        if format == FORMAT_CBOR:
+            self.cbor_map(len(batch))
+            for timestamp, address, reading in batch:
+                self.cbor_key(address)
+                self.cbor_reading(timestamp, reading)
+        else:
+            self._byte(123)
+            first = True
+            for timestamp, address, reading in batch:
+                if not first:
+                    self.raw(b', ')
+                first = False
+                self.json_key(address)
+                self.json_reading(timestamp, reading)
+            self._byte(125)
+        return self.getvalue()
@@ -0,0 +1,132 @@
+import array
+import struct
+import uos
+import decoder
+import utils
+import logging, logger
+logger.initLogging()
+
+# High-water mark file: MAC (6), index of the last record published (uint32)
+_MARK = '<6sI'
+
+
+class RecordBuffer:
+    # History records received by bt_irq during a backfill, in a preallocated buffer of capacity records.
+    # append() doesn't allocate (unless the notification is longer than a record): it is called
+    # for every notification of the history characteristic.
+    # The records beyond capacity are dropped (and counted).
+    def __init__(self, capacity=48):
+        self.capacity = capacity
+        self.data = bytearray(decoder.RECORD_LEN * capacity)
+        self._mv = memoryview(self.data)
+        self.count = 0
+        self.last = -1          # index of the last record received
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+        self.last = -1
+        self.dropped = 0
+
+    def append(self, data):
+        size = decoder.RECORD_LEN
+        if len(data) < size or self.count >= self.capacity:
+            self.dropped += 1
+            return
+        if len(data) > size:
+            data = data[:size]
+        offset = self.count * size
+        self._mv[offset:offset + size] = data
+        self.count += 1
+        self.last = data[0] | (data[1] << 8) | (data[2] << 16) | (data[3] << 24)
+
+    def records(self):
+        # Decoded records (see decoder.record), in the order received
+        return [decoder.record(self.data, i * decoder.RECORD_LEN) for i in range(self.count)]
+
+
+class HighWaterMarks:
+    # Backfill state of each device (registry slot): index of the last history record published
+    # (-1 if none) and time of the last backfill. The marks are saved by MAC address, so that only
+    # the records stored by the sensors since then are fetched after a restart.
+    def __init__(self, capacity, interval=3600, gap=900):
+        self.capacity = capacity
+        self.interval = interval
+        self.gap = gap
+        self.marks = array.array('i', [-1] * capacity)
+        self.fetched = array.array('i', [0] * capacity)
+        self.saved = {}         # marks loaded from the file, by MAC address, until the device is read
+        self.dirty = False
+
+    def due(self, slot, now, last_read):
+        # True if the history of the device should be fetched, now that it is connected:
+        # first reading since startup, first reading after <gap> seconds without any (the hub or the
+        # sensor was away) or <interval> seconds since the last backfill (0 to only fill gaps)
+        if not 0 <= slot < self.capacity:
+            return False
+        fetched = self.fetched[slot]
+        return (not fetched or now - last_read > self.gap
+                or (self.interval and now - fetched >= self.interval))
+
+    def mark(self, devices, slot):
+        # Index of the last record published for the device, -1 if none
+        if self.marks[slot] < 0 and self.saved:
+            self.marks[slot] = self.saved.pop(bytes(devices.mac(slot)), -1)
+        return self.marks[slot]
+
+    def advance(self, slot, index):
+        self.marks[slot] = index
+        self.dirty = True
+
+    def reset(self, slot):
+        # The sensor memory was cleared (battery change): its records are numbered from 0 again
+        self.marks[slot] = -1
+        self.dirty = True
+
+    def save(self, devices, filename):
+        marks = dict(self.saved)
+        for slot in range(min(len(devices), self.capacity)):
+            if self.marks[slot] >= 0:
+                marks[bytes(devices.mac(slot))] = self.marks[slot]
+        tmp = filename + '.tmp'
+        try:
+            f = open(tmp, 'wb')
+            try:
+                for mac, index in marks.items():
+                    f.write(struct.pack(_MARK, mac, index))
+            finally:
+                f.close()
+            try:
+                uos.remove(filename)
+            except OSError:
+                pass
+            uos.rename(tmp, filename)
+        except Exception as e:
+            utils.log_error_to_file('ERROR: save history marks - ' + str(e))
+            return False
+        self.dirty = False
+        return True
+
+    def load(self, filename):
+        # Returns the number of marks loaded
+        try:
+            f = open(filename, 'rb')
+        except OSError:
+            return 0
+        size = struct.calcsize(_MARK)
+        try:
+            while True:
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                mac, index = struct.unpack(_MARK, data)
+                self.saved[mac] = index
+        except Exception as e:
+            utils.log_error_to_file('ERROR: load history marks - ' + str(e))
+        finally:
+            f.close()
+        logging.info('History marks loaded ({} sensors)', len(self.saved))
+        return len(self.saved)
@@ -0,0 +1,119 @@
+from micropython import const
+import array
+import binascii
+
+_MAC_LEN = const(6)
+
+# GATT handles stored for each device (0 = not known yet)
+HANDLE_NAME   = const(0)
+HANDLE_NOTIFY = const(1)
+HANDLE_ENERGY = const(2)
+_HANDLES      = const(3)
+
+DEVICE_NAME_PLACEHOLDER = 'DEVICE_NAME_PLACEHOLDER'
+
+# Models read by connecting to them (same GATT service as the LYWSD03MMC).
+# Custom firmware names (ATC_XXXXXX) are reduced to their prefix by model().
+SENSOR_MODELS = ('LYWSD03MMC', 'MHO-C401', 'ATC')
+
+
+def model(name):
+    # Model of a device, from its name: e.g. 'ATC_1A2B3C' -> 'ATC'
+    i = name.find('_')
+    if i > 0 and len(name) - i == 7:
+        return name[:i]
+    return name
+
+
+def is_sensor(name):
+    return model(name) in SENSOR_MODELS
+
+
+class DeviceRegistry:
+    # Fixed capacity table of the known devices.
+    # Slot i holds the MAC address macs[6*i:6*i+6], the address type types[i],
+    # the device name names[i], the time of the last reading last_read[i]
+    # the GATT handles handles[3*i:3*i+3] (see HANDLE_*) and the MQTT topic topics[i] (computed once).
+    # Lookups and updates of an existing slot don't allocate, so they can be called from bt_irq.
+    def __init__(self, capacity=20):
+        self.capacity = capacity
+        self.count = 0
+        self.macs = bytearray(_MAC_LEN * capacity)
+        self.types = array.array('i', [-1] * capacity)
+        self.last_read = array.array('i', [0] * capacity)
+        self.names = [DEVICE_NAME_PLACEHOLDER] * capacity
+        self.handles = array.array('H', [0] * (_HANDLES * capacity))
+        self.topics = [None] * capacity
+        # Index from the last 3 bytes of the MAC address (a small int) to the slot.
+        # On a collision the first device keeps the entry and find() falls back to a linear scan.
+        self._index = {}
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _key(mac):
+        return (mac[3] << 16) | (mac[4] << 8) | mac[5]
+
+    def _match(self, slot, mac):
+        offset = slot * _MAC_LEN
+        macs = self.macs
+        for i in range(_MAC_LEN):
+            if macs[offset + i] != mac[i]:
+                return False
+        return True
+
+    def find(self, mac):
+        # Returns the slot of the given MAC address, or -1 if it is not present
+        slot = self._index.get(self._key(mac), -1)
+        if slot >= 0:
+            if self._match(slot, mac):
+                return slot
+            for slot in range(self.count):
+                if self._match(slot, mac):
+                    return slot
+        return -1
+
+    def add(self, mac, type=0, name=DEVICE_NAME_PLACEHOLDER):
+        # Returns the slot of the device (existing or new), or -1 if the registry is full
+        slot = self.find(mac)
+        if slot >= 0:
+            return slot
+        if self.count >= self.capacity:
+            return -1
+        slot = self.count
+        offset = slot * _MAC_LEN
+        self.macs[offset:offset + _MAC_LEN] = mac
+        self.types[slot] = type
+        self.names[slot] = name
+        self.last_read[slot] = 0
+        for i in range(_HANDLES):
+            self.handles[_HANDLES * slot + i] = 0
+        self.topics[slot] = None
+        key = self._key(mac)
+        if key not in self._index:
+            self._index[key] = slot
+        self.count += 1
+        return slot
+
+    def mac(self, slot):
+        offset = slot * _MAC_LEN
+        return memoryview(self.macs)[offset:offset + _MAC_LEN]
+
+    def handle(self, slot, which):
+        return self.handles[_HANDLES * slot + which]
+
+    def set_handle(self, slot, which, value):
+        self.handles[_HANDLES * slot + which] = value
+
+    def topic(self, slot, prefix):
+        # <prefix>/<mac in hex>, cached
+        topic = self.topics[slot]
+        if topic is None:
+            topic = prefix + b'/' + binascii.hexlify(self.mac(slot))
+            self.topics[slot] = topic
+        return topic
+
+    def clear(self):
+        self.count = 0
+        self._index.clear()
@@ -0,0 +1,143 @@
+import array
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+try:
+    import urandom as random
+except ImportError:
+    import random
+import logging, logger
+logger.initLogging()
+
+
+class ScanScheduler:
+    # Decides when the next discovery scan is due.
+    # Scans are repeated every min_interval seconds while they keep finding new devices;
+    # after idle_rounds scans without new devices the interval doubles, up to max_interval.
+    def __init__(self, min_interval, max_interval, idle_rounds=3):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.idle_rounds = idle_rounds
+        self.interval = min_interval
+        self.idle = 0
+
+    def update(self, new_devices):
+        # Call after each scan with the number of devices it found. Returns the new interval.
+        if new_devices > 0:
+            self.idle = 0
+            self.interval = self.min_interval
+        else:
+            self.idle += 1
+            if self.idle >= self.idle_rounds:
+                self.interval = min(self.interval * 2, self.max_interval)
+        logging.debug('Next scan in {} seconds', self.interval)
+        return self.interval
+
+    def reset(self):
+        self.idle = 0
+        self.interval = self.min_interval
+
+
+class ReadScheduler:
+    # Decides when each device (registry slot) is read next.
+    # Due times are kept in a heap of (due, slot) entries, so finding the next device is O(log N);
+    # entries made stale by a reschedule are skipped when they reach the top.
+    #
+    # - interval: default read interval (seconds), set_interval() overrides it per device
+    # - retry_interval: delay before retrying a failed reading, doubled on every consecutive failure
+    #   up to max_backoff, so a dead sensor doesn't hold the radio at the expense of the others
+    # - jitter: fraction of the interval added or removed at random, to spread the readings over time
+    # - fast_interval: while the values keep changing by at least temperature_delta (C) or
+    #   humidity_delta (%), the interval is halved (down to fast_interval), then restored step by step
+    def __init__(self, capacity, interval, retry_interval=30, max_backoff=3600, jitter=0.1,
+                 fast_interval=60, temperature_delta=0.3, humidity_delta=2):
+        self.capacity = capacity
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_backoff = max(retry_interval, max_backoff)
+        self.jitter = jitter
+        self.fast_interval = fast_interval
+        self.temperature_delta = int(temperature_delta * 100)
+        self.humidity_delta = int(humidity_delta * 100)
+        self.due = array.array('i', [-1] * capacity)            # -1 = not scheduled
+        self.intervals = array.array('i', [interval] * capacity)
+        self.failures = array.array('H', [0] * capacity)
+        self.speedup = array.array('b', [0] * capacity)         # the interval is divided by 2**speedup
+        self.temperature = array.array('h', [-32768] * capacity)  # last values (0.01 C, 0.01 %)
+        self.humidity = array.array('h', [-1] * capacity)
+        self._heap = []
+
+    def _jitter(self, seconds):
+        # seconds +/- jitter, at random
+        spread = int(seconds * self.jitter)
+        if spread <= 0:
+            return seconds
+        return seconds - spread + random.getrandbits(16) % (2 * spread + 1)
+
+    def _schedule(self, slot, due):
+        self.due[slot] = due
+        heapq.heappush(self._heap, (due, slot))
+
+    def scheduled(self, slot):
+        return self.due[slot] >= 0
+
+    def set_interval(self, slot, seconds):
+        self.intervals[slot] = seconds
+
+    def add(self, slot, now):
+        # Schedules a new device, within the first <jitter> fraction of its interval.
+        # Does nothing if the device is already scheduled.
+        if self.due[slot] < 0:
+            self._schedule(slot, now + random.getrandbits(16) % (int(self.intervals[slot] * self.jitter) + 1))
+
+    def pop_due(self, now):
+        # Returns the slots due for a reading and unschedules them:
+        # each of them must then be passed to success() or failure()
+        slots = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            due, slot = heapq.heappop(heap)
+            if self.due[slot] == due:
+                self.due[slot] = -1
+                slots.append(slot)
+        return slots
+
+    def next_due(self, now):
+        # Seconds until the next reading (0 if one is due), None if nothing is scheduled
+        heap = self._heap
+        while heap and self.due[heap[0][1]] != heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(heap[0][0] - now, 0)
+
+    def success(self, slot, now, temperature=None, humidity=None):
+        self.failures[slot] = 0
+        interval = self.intervals[slot]
+        if temperature is not None and humidity is not None:
+            t = int(round(temperature * 100))
+            h = int(round(humidity * 100))
+            if (self.humidity[slot] >= 0 and (abs(t - self.temperature[slot]) >= self.temperature_delta
+                                              or abs(h - self.humidity[slot]) >= self.humidity_delta)):
+                if self.speedup[slot] < 4:
+                    self.speedup[slot] += 1
+            elif self.speedup[slot] > 0:
+                self.speedup[slot] -= 1
+            self.temperature[slot] = t
+            self.humidity[slot] = h
+            if self.speedup[slot]:
+                interval = max(interval >> self.speedup[slot], min(self.fast_interval, interval))
+        self._schedule(slot, now + self._jitter(interval))
+
+    def skip(self, slot, now, delay):
+        # Checks the device again after delay seconds, without reading it (e.g. read by another hub)
+        self._schedule(slot, now + self._jitter(delay))
+
+    def failure(self, slot, now):
+        failures = self.failures[slot]
+        if failures < 16:
+            self.failures[slot] = failures + 1
+        delay = min(self.retry_interval << failures, self.max_backoff)
+        logging.debug('Reading failed {} times, retry in {} seconds', failures + 1, delay)
+        self._schedule(slot, now + self._jitter(delay))
@@ -0,0 +1,87 @@
+from micropython import const
+import array
+
+_NO_TEMPERATURE = const(-32768)
+
+# Bytes per sample: time (4), temperature (2), humidity (2)
+SAMPLE_SIZE = const(8)
+
+
+class TimeSeries:
+    # Last readings of each device (registry slot), in fixed rings of length samples:
+    # time (seconds), temperature (0.01 C) and humidity (0.01 %).
+    # Memory: SAMPLE_SIZE * length bytes per device (e.g. 48 samples: 384 bytes, 7.5 kB for 20 devices),
+    # allocated once. add() doesn't allocate.
+    def __init__(self, capacity, length=48):
+        self.capacity = capacity
+        self.length = length
+        self.times = array.array('i', [0] * (capacity * length))
+        self.temperature = array.array('h', [_NO_TEMPERATURE] * (capacity * length))
+        self.humidity = array.array('H', [0] * (capacity * length))
+        self.head = array.array('H', [0] * capacity)       # next sample written
+        self.count = array.array('H', [0] * capacity)
+
+    def add(self, slot, timestamp, temperature, humidity):
+        if not 0 <= slot < self.capacity or temperature is None or humidity is None:
+            return
+        i = slot * self.length + self.head[slot]
+        self.times[i] = timestamp
+        self.temperature[i] = int(round(temperature * 100))
+        self.humidity[i] = int(round(humidity * 100))
+        self.head[slot] = (self.head[slot] + 1) % self.length
+        if self.count[slot] < self.length:
+            self.count[slot] += 1
+
+    def _indexes(self, slot):
+        # Indexes of the samples of a device, oldest first
+        n = self.count[slot]
+        base = slot * self.length
+        first = (self.head[slot] - n) % self.length
+        for k in range(n):
+            yield base + (first + k) % self.length
+
+    def samples(self, slot, since=0):
+        # [(time, temperature, humidity)] of the samples taken at since or later, oldest first
+        return [(self.times[i], self.temperature[i] / 100, self.humidity[i] / 100)
+                for i in self._indexes(slot) if self.times[i] >= since]
+
+    def aggregate(self, slot, now, window):
+        # Statistics of the samples of the last window seconds, None if there are none:
+        # {'samples': n, 'temperature': {'min', 'max', 'mean', 'trend'}, 'humidity': {...}}
+        # The trend is the least squares slope, per hour.
+        n = 0
+        t_min = h_min = 0x7fff
+        t_max = h_max = -0x7fff
+        t_sum = h_sum = 0
+        x_sum = xx_sum = xt_sum = xh_sum = 0
+        since = now - window
+        for i in self._indexes(slot):
+            timestamp = self.times[i]
+            if timestamp < since:
+                continue
+            t = self.temperature[i]
+            h = self.humidity[i]
+            x = (timestamp - since) / 3600
+            n += 1
+            t_min = min(t_min, t)
+            t_max = max(t_max, t)
+            h_min = min(h_min, h)
+            h_max = max(h_max, h)
+            t_sum += t
+            h_sum += h
+            x_sum += x
+            xx_sum += x * x
+            xt_sum += x * t
+            xh_sum += x * h
+        if not n:
+            return None
+        d = n * xx_sum - x_sum * x_sum
+        t_trend = (n * xt_sum - x_sum * t_sum) / d if d else 0
+        h_trend = (n * xh_sum - x_sum * h_sum) / d if d else 0
+        return {
+            'samples': n,
+            'temperature': {'min': t_min / 100, 'max': t_max / 100, 'mean': round(t_sum / n) / 100,
+                            'trend': round(t_trend) / 100},
+            'humidity': {'min': h_min / 100, 'max': h_max / 100, 'mean': round(h_sum / n) / 100,
+                         'trend': round(h_trend) / 100},
+        }
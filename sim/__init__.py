@@ -0,0 +1,96 @@
+# Host-side (CPython) simulator of the hub.
+#
+#     import sim
+#     sim.install(read_interval=10)     # before importing any module of the hub
+#     import ble, mqtt
+#
+# install() registers stand-ins for the MicroPython modules (see shims.py), a fake
+# ubluetooth radio with scripted peripherals (bluetooth.py), umqtt.simple backed by an
+# in-process broker (broker.py) and a config module built from config_example.py.
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _stdlib_asyncio():
+    # The repository's logging.py shadows the standard one when the repository root is on sys.path:
+    # import asyncio (and the standard logging it depends on) without it, then let the hub use its own.
+    saved = sys.path[:]
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or '.') != ROOT]
+    try:
+        sys.modules.pop('logging', None)
+        import asyncio
+    finally:
+        sys.path[:] = saved
+
+
+_stdlib_asyncio()
+
+from . import shims, bluetooth
+from . import broker as _broker
+
+radio = bluetooth.radio
+Peripheral = bluetooth.Peripheral
+broker = _broker.broker
+
+_installed = False
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install(**config):
+    # Registers the simulated modules. Keyword arguments override the settings of config_example.py.
+    global _installed
+    if not _installed:
+        sys.modules.update(shims.modules())
+        sys.modules['ubluetooth'] = bluetooth.module()
+        sys.modules.update(_broker.modules())
+        sys.modules.pop('logging', None)
+        _load('logging', 'logging.py')
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        _installed = True
+    settings = types.ModuleType('config')
+    with open(os.path.join(ROOT, 'config_example.py')) as f:
+        source = f.read()
+    exec(compile(source, 'config_example.py', 'exec'), settings.__dict__)
+    settings.__dict__.update(config)
+    sys.modules['config'] = settings
+    return settings
+
+
+def hub(name, unique_id):
+    # Loads an independent copy of mqtt.py (its own registry, scheduler, MQTT client...) as module <name>,
+    # with machine.unique_id() (hence client_id) returning unique_id: several hubs can run in one process.
+    shims.machine.unique_id = lambda: unique_id
+    try:
+        return _load(name, 'mqtt.py')
+    finally:
+        shims.machine.unique_id = lambda: b'\x24\x0a\xc4\x00\x00\x01'
+
+
+def sensors(n, prefix=b'\xa4\xc1\x38', **kwargs):
+    # Adds n simulated LYWSD03MMC sensors to the radio and returns them
+    added = []
+    for i in range(n):
+        p = Peripheral(prefix + bytes([0x10, i >> 8, i & 0xff]), temperature=20 + i / 10,
+                       humidity=40 + i % 20, **kwargs)
+        radio.peripherals.append(p)
+        added.append(p)
+    return added
+
+
+def reset():
+    # Forgets the simulated sensors, radio counters and broker state
+    radio.peripherals.clear()
+    radio.counters.clear()
+    broker.reset()
@@ -0,0 +1,276 @@
+# Benchmarks of the hub on the host simulator.
+#
+#     python -m sim.bench [--sensors 8] [--latency-ms 30] [--loss 0.0] [--seconds 10]
+#
+# Reports the per-sensor read latency, the cycle time for N sensors at different
+# concurrency levels, the allocations of a read cycle, of a publish (topic and payload),
+# of decoding and logging calls, and the throughput of the full mqtt.py loop.
+# Times are host times: compare runs with each other, not with the ESP32.
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sim
+
+
+# The hub prints a separator line for every read: the results are written to the original stdout
+_stdout = sys.stdout
+
+
+def _report(*args):
+    print(*args, file=_stdout)
+
+
+def _stats(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    if not n:
+        return 'no samples'
+    return 'n={} min={:.1f} p50={:.1f} p95={:.1f} max={:.1f} ms'.format(
+        n, samples[0], samples[n // 2], samples[min(n - 1, int(n * 0.95))], samples[-1])
+
+
+def _header(title):
+    _report()
+    _report(title)
+    _report('-' * len(title))
+
+
+async def _discover(ble, n):
+    b = ble.Ble(max(n, 1), 4)
+    await b.setup(True, [], 2000 + 50 * n, 30000, 30000)
+    return b
+
+
+def bench_reads(ble, n, rounds):
+    _header('Reads ({} sensors, latency {} ms, loss {:.0%})'.format(n, sim.radio.latency_ms, sim.radio.loss))
+
+    async def run():
+        b = await _discover(ble, n)
+        slots = [i for i in range(len(b.addresses)) if b.addresses.names[i] == 'LYWSD03MMC']
+        _report('discovered {}/{} sensors'.format(len(slots), n))
+        latencies = []
+        failures = 0
+        for r in range(rounds):
+            for slot in slots:
+                t = time.perf_counter()
+                if await b.get_reading(slot) is None:
+                    failures += 1
+                else:
+                    latencies.append((time.perf_counter() - t) * 1000)
+        _report('read latency: {} ({} failed)'.format(_stats(latencies), failures))
+        for concurrency in (1, 2, 3, 4):
+            cycles = []
+            for r in range(rounds):
+                t = time.perf_counter()
+                await b.read_devices(slots, lambda slot, reading: None, concurrency)
+                cycles.append((time.perf_counter() - t) * 1000)
+            _report('cycle time, concurrency {}: {}'.format(concurrency, _stats(cycles)))
+        return b, slots
+
+    return asyncio.run(run())
+
+
+def bench_read_allocations(ble, n):
+    _header('Allocations of a read cycle ({} sensors)'.format(n))
+
+    async def run():
+        b = await _discover(ble, n)
+        slots = list(range(len(b.addresses)))
+        await b.read_devices(slots, lambda slot, reading: None, 1)   # warm up
+        gc.collect()
+        collections = gc.get_stats()[0]['collections']
+        tracemalloc.start()
+        t = time.perf_counter()
+        await b.read_devices(slots, lambda slot, reading: None, 1)
+        elapsed = time.perf_counter() - t
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        _report('peak traced memory: {} bytes, {} bytes per sensor'.format(peak, peak // max(len(slots), 1)))
+        _report('gen0 collections: {} in {:.2f} s'.format(gc.get_stats()[0]['collections'] - collections, elapsed))
+
+    asyncio.run(run())
+
+
+def _measure(label, func, count):
+    # Calls func() <count> times and reports, per call: the memory blocks and bytes still allocated
+    # when the results are kept (a message queued or being sent stays alive that long), and the peak
+    # of the memory allocated during the call, temporary objects included. CPython frees most objects
+    # as soon as they are dropped, where MicroPython keeps them until the next collection: both numbers
+    # are what a call leaves to the ESP32 garbage collector.
+    results = [None] * count
+    func()
+    t = time.perf_counter()
+    for i in range(count):
+        func()
+    elapsed = time.perf_counter() - t
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        results[i] = func()
+    after = tracemalloc.take_snapshot()
+    peak = 0
+    for i in range(min(count, 100)):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        results[i] = func()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'filename')
+    blocks = sum(stat.count_diff for stat in diff) / count
+    size = sum(stat.size_diff for stat in diff) / count
+    _report('{:<32} {:>9.0f} calls/s  {:>4.1f} blocks {:>5.0f} bytes kept  peak {:>5} bytes'.format(
+        label, count / elapsed, blocks, size, peak))
+
+
+class _Client:
+    # MQTT client keeping the topic and message of every publish, so that _measure counts them
+    def __init__(self, count):
+        self.topics = [None] * count
+        self.messages = [None] * count
+        self.count = 0
+
+    def publish(self, topic, message):
+        i = self.count % len(self.topics)
+        self.topics[i] = topic
+        self.messages[i] = message
+        self.count += 1
+
+
+def _concat_publish(client, topic_pub, address, reading):
+    # Publish path before payload.Encoder: topic rebuilt and payload concatenated on every publish
+    temperature, humidity, battery_level, battery_voltage = reading
+    message = '{"temperature": "' + str(temperature) + '", '
+    message = message + '"humidity": "' + str(humidity) + '", '
+    message = message + '"batteryLevel": "' + str(battery_level) + '", '
+    message = message + '"batteryVoltage": "' + str(battery_voltage) + '"}'
+    topic = topic_pub + '/' + ''.join('{:02x}'.format(b) for b in address)
+    client.publish(topic, message)
+
+
+def bench_payload(count):
+    _header('Publish path: topic and payload ({} messages)'.format(count))
+    import payload
+    import registry
+    reading = (21.51, 45, 83, 2.932)
+    address = b'\xa4\xc1\x38\x10\x00\x00'
+    devices = registry.DeviceRegistry(4)
+    slot = devices.add(address)
+    encoder = payload.Encoder(2048)
+    batch = [(int(time.time()), address, reading)] * 10
+    client = _Client(count)
+    _measure('join + concatenation', lambda: _concat_publish(client, 'home/espble', address, reading), count)
+    _measure('registry.topic + Encoder JSON', lambda: client.publish(
+        devices.topic(slot, b'home/espble'), encoder.reading(payload.FORMAT_JSON, 0, reading)), count)
+    _measure('registry.topic + Encoder CBOR', lambda: client.publish(
+        devices.topic(slot, b'home/espble'), encoder.reading(payload.FORMAT_CBOR, 0, reading)), count)
+    _measure('Encoder JSON aggregate x10', lambda: client.publish(
+        b'home/espble/hub', encoder.aggregate(payload.FORMAT_JSON, batch)), count // 10)
+
+
+def bench_decoder(count):
+    _header('Decoding ({} frames)'.format(count))
+    import advertising
+    import decoder
+    reading = decoder.Reading()
+    notification = bytearray(30)
+    notification[:5] = b'\x18\xfc\x2d\x74\x0b'
+    mac = b'\xa4\xc1\x38\x10\x00\x01'
+    atc = b'\x10\x16\x1a\x18' + mac + b'\xff\x9f\x2d\x53\x0b\x74\x01'
+    pvvx = b'\x12\x16\x1a\x18' + mac[::-1] + b'\x18\xfc\x94\x11\x74\x0b\x53\x01\x04'
+    mibeacon = b'\x15\x16\x95\xfe\x50\x20\x5b\x05\x01' + mac[::-1] + b'\x0d\x10\x04\x9f\xff\xc2\x01'
+    _measure('int.from_bytes notification', lambda: (
+        int.from_bytes(notification[0:2], 'little') / 100, int.from_bytes(notification[2:3], 'little'),
+        int.from_bytes(notification[3:5], 'little') / 1000), count)
+    _measure('decoder.notification', lambda: decoder.notification(notification, reading, 5), count)
+    _measure('advertising.decode ATC', lambda: advertising.decode(atc, reading), count)
+    _measure('advertising.decode pvvx', lambda: advertising.decode(pvvx, reading), count)
+    _measure('advertising.decode MiBeacon', lambda: advertising.decode(mibeacon, reading), count)
+
+
+def bench_logging(count):
+    _header('Logging ({} calls)'.format(count))
+    import logging
+    root = logging.getLogger()
+    level = root.level
+    handlers = root.handlers
+    devnull = open(os.devnull, 'w')
+    root.handlers = [logging.StreamHandler(devnull)]
+    root.handlers[0].setFormatter(handlers[0].formatter if handlers else logging.Formatter())
+    try:
+        root.setLevel(logging.DEBUG)
+        _measure('debug(), enabled', lambda: logging.debug('Connection handle: {} - Value handle: {}', 1, 0x38), count)
+        _measure('info() without arguments', lambda: logging.info('Waiting for a notification...'), count)
+        root.setLevel(logging.WARNING)
+        _measure('debug(), disabled', lambda: logging.debug('Connection handle: {} - Value handle: {}', 1, 0x38), count)
+    finally:
+        root.handlers = handlers
+        root.setLevel(level)
+        devnull.close()
+
+
+def bench_loop(n, seconds):
+    _header('mqtt.py loop ({} sensors, {} s)'.format(n, seconds))
+    import mqtt
+    sim.broker.reset()
+    mqtt.myBLE = mqtt.ble.Ble(mqtt.device_capacity, mqtt.max_concurrent_reads, mqtt.device_cache)
+
+    async def run():
+        try:
+            await asyncio.wait_for(mqtt.main(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    t = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - t
+    # Readings only (<topic_pub>/<mac>), not the status, availability and discovery topics
+    published = [m for m in sim.broker.messages
+                 if m[1].startswith(mqtt.topic_pub + b'/') and len(m[1]) == len(mqtt.topic_pub) + 13]
+    sensors = set(m[1] for m in published)
+    _report('{} messages from {} sensors in {:.1f} s, {} readings queued'.format(
+        len(published), len(sensors), elapsed, len(mqtt.readings)))
+    _report('radio: {}'.format(sim.radio.counters))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=8)
+    parser.add_argument('--latency-ms', type=int, default=30)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    os.chdir(tempfile.mkdtemp(prefix='hub-sim-'))
+    sys.stdout = open(os.devnull, 'w')
+    sim.install(device_cache=None, read_interval=2, scan_duration_ms=3200, scan_interval_us=30000,
+                scan_window_us=30000, scan_min_interval=3600, log_level=30)
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    import ble
+
+    sim.radio.latency_ms = args.latency_ms
+    sim.radio.notify_delay_ms = 4 * args.latency_ms
+    sim.radio.loss = args.loss
+    sim.sensors(args.sensors)
+
+    bench_reads(ble, args.sensors, args.rounds)
+    bench_read_allocations(ble, args.sensors)
+    bench_payload(args.count)
+    bench_decoder(args.count)
+    bench_logging(args.count)
+    sim.radio.counters.clear()
+    bench_loop(args.sensors, args.seconds)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
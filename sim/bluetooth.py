@@ -0,0 +1,368 @@
+# Fake ubluetooth module: a BLE radio surrounded by scripted LYWSD03MMC peripherals.
+# Events are delivered to the IRQ handler from the asyncio loop, after the configured latency,
+# and each operation can be lost with the configured probability.
+import asyncio
+import random
+import struct
+import time
+
+_IRQ_SCAN_RESULT           = 1 << 4
+_IRQ_SCAN_COMPLETE         = 1 << 5
+_IRQ_PERIPHERAL_CONNECT    = 1 << 6
+_IRQ_PERIPHERAL_DISCONNECT = 1 << 7
+_IRQ_GATTC_CHARACTERISTIC_RESULT = 1 << 9
+_IRQ_GATTC_DESCRIPTOR_RESULT = 1 << 10
+_IRQ_GATTC_READ_RESULT     = 1 << 11
+_IRQ_GATTC_WRITE_STATUS    = 1 << 12
+_IRQ_GATTC_NOTIFY          = 1 << 13
+
+FLAG_READ = 0x0002
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+
+
+class UUID:
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return 'UUID({!r})'.format(self.value)
+
+
+_DATA_UUID = 'ebe0ccc1-7a0a-4b0c-8a1a-6ff2997da3a6'
+_ENERGY_UUID = 'ebe0ccd8-7a0a-4b0c-8a1a-6ff2997da3a6'
+_TIME_UUID = 'ebe0ccb7-7a0a-4b0c-8a1a-6ff2997da3a6'
+_INDEX_UUID = 'ebe0ccba-7a0a-4b0c-8a1a-6ff2997da3a6'
+_HISTORY_UUID = 'ebe0ccbc-7a0a-4b0c-8a1a-6ff2997da3a6'
+
+
+def record(index, timestamp, t_min, t_max, h_min, h_max):
+    # History record of the stock firmware (see decoder.record)
+    return struct.pack('<IIhBhB', index, timestamp, int(round(t_max * 10)), h_max, int(round(t_min * 10)), h_min)
+
+
+def layout(name_handle=0x0003, data_handle=0x0036, energy_handle=0x0046, history_handle=0x002e):
+    # Characteristics of a sensor: (definition handle, value handle, properties, UUID).
+    # The default is the stock LYWSD03MMC firmware, None leaves a characteristic out
+    # (history_handle: the whole history service).
+    characteristics = [(name_handle - 1, name_handle, FLAG_READ, UUID(0x2A00)), (0x0010, 0x0011, FLAG_READ, UUID(0x2A26))]
+    if history_handle is not None:
+        characteristics.append((0x0021, 0x0022, FLAG_READ | FLAG_WRITE, UUID(_TIME_UUID)))
+        characteristics.append((0x0027, 0x0028, FLAG_READ | FLAG_WRITE, UUID(_INDEX_UUID)))
+        characteristics.append((history_handle - 1, history_handle, FLAG_READ | FLAG_NOTIFY, UUID(_HISTORY_UUID)))
+    if data_handle is not None:
+        characteristics.append((data_handle - 1, data_handle, FLAG_READ | FLAG_NOTIFY, UUID(_DATA_UUID)))
+    if energy_handle is not None:
+        characteristics.append((energy_handle - 1, energy_handle, FLAG_READ | FLAG_WRITE, UUID(_ENERGY_UUID)))
+    characteristics.sort(key=lambda c: c[0])
+    return characteristics
+
+
+class Peripheral:
+    # A simulated sensor
+    def __init__(self, mac, name='LYWSD03MMC', temperature=21.5, humidity=45, voltage=2.932,
+                 rssi=-60, addr_type=0, adv_data=b'\x02\x01\x06', adv_interval_ms=1500, characteristics=None,
+                 cccd_offset=2, notify_interval_ms=6000, clock_offset=0):
+        self.mac = bytes(mac)
+        self.name = name
+        self.temperature = temperature
+        self.humidity = humidity
+        self.voltage = voltage
+        self.rssi = rssi
+        self.addr_type = addr_type
+        self.adv_data = adv_data
+        self.adv_interval_ms = adv_interval_ms
+        self.notify_interval_ms = notify_interval_ms  # while the notifications are enabled
+        self.characteristics = characteristics or layout()
+        # History stored by the sensor (records, see record()), its clock being clock_offset seconds ahead
+        self.history = []
+        self.clock_offset = clock_offset
+        self.history_handle = self.time_handle = self.index_handle = None
+        self.history_cccd = None
+        self.history_start = 0          # index written to the index characteristic
+        # GATT attributes: handle -> value
+        self.attributes = {}
+        for def_handle, value_handle, properties, uuid in self.characteristics:
+            if uuid == UUID(0x2A00):
+                self.attributes[value_handle] = name.encode() + b'\x00'
+            elif uuid == UUID(_DATA_UUID):
+                self.data_handle = value_handle
+            elif uuid == UUID(_HISTORY_UUID):
+                self.history_handle = value_handle
+            elif uuid == UUID(_TIME_UUID):
+                self.time_handle = value_handle
+            elif uuid == UUID(_INDEX_UUID):
+                self.index_handle = value_handle
+        # Descriptors of the data (and history) characteristic: (handle, UUID). On the stock firmware a user
+        # description comes first, the CCCD (written to enable the notifications) is 2 handles after the value.
+        self.cccd = self.data_handle + cccd_offset
+        self.descriptors = [(self.data_handle + i, UUID(0x2901)) for i in range(1, cccd_offset)]
+        self.descriptors.append((self.cccd, UUID(0x2902)))
+        if self.history_handle is not None:
+            self.history_cccd = self.history_handle + cccd_offset
+            self.descriptors += [(self.history_handle + i, UUID(0x2901)) for i in range(1, cccd_offset)]
+            self.descriptors.append((self.history_cccd, UUID(0x2902)))
+
+    def notification(self):
+        t = int(round(self.temperature * 100)) & 0xffff
+        v = int(round(self.voltage * 1000))
+        return bytes([t & 0xff, t >> 8, int(self.humidity), v & 0xff, v >> 8])
+
+    def clock(self):
+        return int(time.time()) + self.clock_offset
+
+    def log_hours(self, hours, now=None):
+        # Fills the history with one record per hour for the last <hours> hours (sensor clock),
+        # numbered after the existing ones
+        now = self.clock() if now is None else now
+        start = now - now % 3600 - hours * 3600
+        for h in range(hours):
+            t = self.temperature + (h % 5) / 10
+            self.history.append(record(len(self.history), start + h * 3600, t - 0.3, t + 0.2,
+                                       int(self.humidity) - 1, int(self.humidity) + 1))
+
+    def read(self, handle):
+        # Value of an attribute, None if there is none
+        if handle == self.history_handle:
+            return self.history[-1] if self.history else None
+        if handle == self.time_handle:
+            return struct.pack('<Ib', self.clock(), 0)
+        return self.attributes.get(handle)
+
+
+class Radio:
+    # Parameters and counters shared by all the BLE() instances
+    def __init__(self):
+        self.peripherals = []
+        self.latency_ms = 30            # delay of every GAP/GATT event
+        self.notify_delay_ms = 200      # delay between enabling notifications and the first notify
+        self.loss = 0.0                 # probability of losing an event
+        self.write_error_ms = 0         # delay of the error status of a write to an unknown handle
+        self.max_connections = 4
+        self.counters = {}
+        self.stacks = []                # BLE() instances
+
+    def drop(self, mac):
+        # Simulate a connection lost (out of range, ...): the centrals get a disconnect event
+        for stack in self.stacks:
+            for conn_handle, p in list(stack._connections.items()):
+                if p.mac == bytes(mac):
+                    stack._lost(conn_handle)
+
+    def count(self, name):
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def find(self, mac):
+        mac = bytes(mac)
+        for p in self.peripherals:
+            if p.mac == mac:
+                return p
+        return None
+
+
+radio = Radio()
+
+
+class BLE:
+    def __init__(self):
+        self._handler = None
+        self._active = False
+        self._scan = None
+        self._connecting = None
+        self._connections = {}          # conn_handle -> Peripheral
+        self._notifying = {}            # conn_handle -> timer of the next notification
+        self._next_handle = 0
+        self.rssi = {}                  # MAC -> RSSI heard by this stack (None: out of range), default Peripheral.rssi
+        self.connects = {}              # MAC -> connections made by this stack
+        radio.stacks.append(self)
+
+    def irq(self, handler):
+        self._handler = handler
+
+    def active(self, value=None):
+        if value is not None:
+            self._active = value
+        return self._active
+
+    def config(self, *args, **kwargs):
+        return None
+
+    def _later(self, delay_ms, event, data, lossy=True):
+        if lossy and random.random() < radio.loss:
+            radio.count('lost')
+            return None
+        return asyncio.get_running_loop().call_later(delay_ms / 1000, self._irq, event, data)
+
+    def _irq(self, event, data):
+        if self._handler is not None:
+            self._handler(event, data)
+
+    # GAP
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        if self._scan is not None:
+            for h in self._scan:
+                h.cancel()
+            self._scan = None
+            if duration_ms is None:
+                self._later(radio.latency_ms, _IRQ_SCAN_COMPLETE, (), False)
+        if duration_ms is None:
+            return
+        radio.count('scan')
+        duty = min(window_us / interval_us, 1.0)
+        horizon = duration_ms if duration_ms else 60000
+        handles = []
+        for p in radio.peripherals:
+            rssi = self.rssi.get(p.mac, p.rssi)
+            if rssi is None:
+                continue
+            t = random.uniform(0, p.adv_interval_ms)
+            while t < horizon:
+                if random.random() < duty:
+                    handles.append(self._later(t, _IRQ_SCAN_RESULT, (p.addr_type, memoryview(p.mac), True, rssi, memoryview(p.adv_data))))
+                t += p.adv_interval_ms
+        if duration_ms:
+            handles.append(self._later(duration_ms, _IRQ_SCAN_COMPLETE, (), False))
+        self._scan = [h for h in handles if h is not None]
+
+    def gap_connect(self, addr_type, addr=None, scan_duration_ms=2000):
+        if addr_type is None:
+            if self._connecting is not None:
+                self._connecting.cancel()
+                self._connecting = None
+            return
+        if self._connecting is not None:
+            raise OSError(114)          # EALREADY: a connection is already pending
+        if len(self._connections) >= radio.max_connections:
+            raise OSError(12)           # ENOMEM
+        radio.count('connect')
+        p = radio.find(addr)
+        if p is None or self.rssi.get(p.mac, p.rssi) is None:
+            return
+        self.connects[p.mac] = self.connects.get(p.mac, 0) + 1
+        handle = self._next_handle
+        self._next_handle += 1
+
+        def connected():
+            self._connecting = None
+            for stack in radio.stacks:
+                if p in stack._connections.values():
+                    # The sensor is busy with another central (several hubs reading it)
+                    radio.count('collision')
+            self._connections[handle] = p
+            self._irq(_IRQ_PERIPHERAL_CONNECT, (handle, p.addr_type, memoryview(p.mac)))
+
+        if random.random() < radio.loss:
+            radio.count('lost')
+            self._connecting = asyncio.get_running_loop().call_later(3600, connected)
+        else:
+            self._connecting = asyncio.get_running_loop().call_later(radio.latency_ms / 1000, connected)
+
+    def gap_disconnect(self, conn_handle):
+        p = self._connections.get(conn_handle)
+        if p is None:
+            return False
+        radio.count('disconnect')
+
+        asyncio.get_running_loop().call_later(radio.latency_ms / 1000, self._lost, conn_handle)
+        return True
+
+    def _lost(self, conn_handle):
+        p = self._connections.pop(conn_handle, None)
+        timer = self._notifying.pop(conn_handle, None)
+        if timer is not None:
+            timer.cancel()
+        if p is not None:
+            self._irq(_IRQ_PERIPHERAL_DISCONNECT, (conn_handle, p.addr_type, memoryview(p.mac)))
+
+    def _notify(self, conn_handle):
+        # Sends a notification, and the next one after notify_interval_ms
+        p = self._connections.get(conn_handle)
+        if p is None:
+            return
+        radio.count('notify')
+        self._irq(_IRQ_GATTC_NOTIFY, (conn_handle, p.data_handle, memoryview(p.notification())))
+        self._notifying[conn_handle] = asyncio.get_running_loop().call_later(p.notify_interval_ms / 1000, self._notify, conn_handle)
+
+    # GATT client
+
+    def _peripheral(self, conn_handle):
+        p = self._connections.get(conn_handle)
+        if p is None:
+            raise OSError(128)          # ENOTCONN
+        return p
+
+    def gattc_read(self, conn_handle, value_handle):
+        p = self._peripheral(conn_handle)
+        radio.count('read')
+        value = p.read(value_handle)
+        if value is None:
+            # Unknown handle: no read result (the caller times out)
+            radio.count('read_error')
+            return
+        self._later(radio.latency_ms, _IRQ_GATTC_READ_RESULT, (conn_handle, value_handle, memoryview(value)))
+
+    def gattc_discover_characteristics(self, conn_handle, start_handle, end_handle, uuid=None):
+        p = self._peripheral(conn_handle)
+        radio.count('discover')
+        delay = radio.latency_ms
+        for def_handle, value_handle, properties, char_uuid in p.characteristics:
+            if start_handle <= def_handle <= end_handle:
+                self._later(delay, _IRQ_GATTC_CHARACTERISTIC_RESULT, (conn_handle, def_handle, value_handle, properties, char_uuid))
+                delay += 5
+
+    def gattc_discover_descriptors(self, conn_handle, start_handle, end_handle):
+        p = self._peripheral(conn_handle)
+        radio.count('discover')
+        delay = radio.latency_ms
+        for handle, uuid in p.descriptors:
+            if start_handle <= handle <= end_handle:
+                self._later(delay, _IRQ_GATTC_DESCRIPTOR_RESULT, (conn_handle, handle, uuid))
+                delay += 5
+
+    def gattc_write(self, conn_handle, value_handle, data, mode=0):
+        p = self._peripheral(conn_handle)
+        radio.count('write')
+        writable = value_handle in (p.cccd, p.history_cccd)
+        for def_handle, handle, properties, uuid in p.characteristics:
+            if handle == value_handle and properties & FLAG_WRITE:
+                writable = True
+        if not writable:
+            # Unknown handle: the peripheral answers with an ATT error
+            radio.count('write_error')
+            if mode == 1:
+                self._later(radio.write_error_ms or radio.latency_ms, _IRQ_GATTC_WRITE_STATUS, (conn_handle, value_handle, 1))
+            return
+        p.attributes[value_handle] = bytes(data)
+        if mode == 1:
+            self._later(radio.latency_ms, _IRQ_GATTC_WRITE_STATUS, (conn_handle, value_handle, 0))
+        if value_handle == p.cccd and bytes(data) == b'\x01\x00' and conn_handle not in self._notifying:
+            self._notifying[conn_handle] = asyncio.get_running_loop().call_later(radio.notify_delay_ms / 1000, self._notify, conn_handle)
+        if value_handle == p.index_handle and len(data) >= 4:
+            p.history_start = struct.unpack_from('<I', bytes(data))[0]
+        if value_handle == p.history_cccd and bytes(data) == b'\x01\x00':
+            # Streams the records from the index written, one every 20 ms
+            delay = radio.latency_ms
+            for r in p.history[p.history_start:]:
+                self._later(delay, _IRQ_GATTC_NOTIFY, (conn_handle, p.history_handle, memoryview(r)))
+                delay += 20
+
+
+def module():
+    import types
+    m = types.ModuleType('ubluetooth')
+    m.BLE = BLE
+    m.UUID = UUID
+    m.FLAG_READ = FLAG_READ
+    m.FLAG_WRITE = FLAG_WRITE
+    m.FLAG_NOTIFY = FLAG_NOTIFY
+    m.radio = radio
+    m.Peripheral = Peripheral
+    m.layout = layout
+    return m
@@ -0,0 +1,143 @@
+# In-process MQTT broker and a umqtt.simple compatible client backed by it.
+import types
+
+
+def _bytes(s):
+    return s.encode() if isinstance(s, str) else bytes(s)
+
+
+def matches(pattern, topic):
+    # MQTT topic filter matching with the + and # wildcards
+    p = pattern.split(b'/')
+    t = topic.split(b'/')
+    for i, level in enumerate(p):
+        if level == b'#':
+            return True
+        if i >= len(t) or (level != b'+' and level != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+class Broker:
+    def __init__(self):
+        self.down = False           # set to simulate an unreachable broker
+        self.retained = {}          # topic -> message
+        self.messages = []          # (client_id, topic, message, retain) of every publish
+        self._clients = []
+
+    def attach(self, client):
+        if self.down:
+            raise OSError(113)      # EHOSTUNREACH
+        if client not in self._clients:
+            self._clients.append(client)
+
+    def detach(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+
+    def publish(self, sender, topic, msg, retain=False):
+        if self.down:
+            raise OSError(104)      # ECONNRESET
+        topic, msg = _bytes(topic), _bytes(msg)
+        self.messages.append((sender.client_id, topic, msg, retain))
+        if retain:
+            if msg:
+                self.retained[topic] = msg
+            else:
+                self.retained.pop(topic, None)
+        for client in self._clients:
+            if client.wants(topic):
+                client.pending.append((topic, msg))
+
+    def subscribe(self, client, pattern):
+        for topic, msg in self.retained.items():
+            if matches(pattern, topic):
+                client.pending.append((topic, msg))
+
+    def reset(self):
+        self.down = False
+        self.retained.clear()
+        self.messages.clear()
+        self._clients.clear()
+
+
+broker = Broker()
+
+
+class MQTTClient:
+    # Subset of umqtt.simple.MQTTClient used by the hub
+    def __init__(self, client_id, server=None, port=0, user=None, password=None, keepalive=0,
+                 ssl=False, ssl_params=None):
+        self.client_id = client_id
+        self.server = server
+        self.cb = None
+        self.lw = None
+        self.connected = False
+        self.subscriptions = []
+        self.pending = []
+
+    def _check(self):
+        if not self.connected or broker.down:
+            self.connected = False
+            raise OSError(104)
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self.lw = (topic, msg, retain)
+
+    def connect(self, clean_session=True):
+        broker.attach(self)
+        self.connected = True
+        return 0
+
+    def disconnect(self):
+        broker.detach(self)
+        self.connected = False
+
+    def ping(self):
+        self._check()
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check()
+        broker.publish(self, topic, msg, retain)
+
+    def subscribe(self, topic, qos=0):
+        self._check()
+        topic = _bytes(topic)
+        self.subscriptions.append(topic)
+        broker.subscribe(self, topic)
+
+    def wants(self, topic):
+        for pattern in self.subscriptions:
+            if matches(pattern, topic):
+                return True
+        return False
+
+    def check_msg(self):
+        self._check()
+        while self.pending:
+            topic, msg = self.pending.pop(0)
+            if self.cb is not None:
+                self.cb(topic, msg)
+        return None
+
+    def wait_msg(self):
+        return self.check_msg()
+
+    def drop(self):
+        # Simulate a lost connection: publishes the last will, like the broker would
+        broker.detach(self)
+        self.connected = False
+        if self.lw is not None:
+            broker.publish(self, *self.lw)
+
+
+def modules():
+    umqtt = types.ModuleType('umqtt')
+    simple = types.ModuleType('umqtt.simple')
+    simple.MQTTClient = MQTTClient
+    simple.MQTTException = type('MQTTException', (Exception,), {})
+    umqtt.simple = simple
+    return {'umqtt': umqtt, 'umqtt.simple': simple}
@@ -0,0 +1,52 @@
+# Decodes a capture of LYWSD03MMC history records with the hub's decoder, on the host.
+#
+#     python -m sim.capture FILE [--hex] [--clock-offset 0]
+#
+# FILE holds the notifications of the history characteristic (e.g. exported from a sniffer or
+# nRF Connect): raw bytes, or with --hex one notification per line in hexadecimal (spaces, colons
+# and dashes are ignored, # starts a comment). Prints one line per record, times in UTC.
+# --clock-offset is the number of seconds the sensor clock was ahead of the real time (subtracted
+# from the record times).
+import argparse
+import binascii
+import sys
+import time
+
+import sim
+
+
+def _load(filename, hex_lines):
+    if not hex_lines:
+        with open(filename, 'rb') as f:
+            return f.read()
+    data = bytearray()
+    with open(filename) as f:
+        for line in f:
+            line = ''.join(c for c in line.split('#')[0] if c not in ' :-\t\r\n')
+            if line:
+                data += binascii.unhexlify(line)
+    return bytes(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('file')
+    parser.add_argument('--hex', action='store_true', help='one notification per line, in hexadecimal')
+    parser.add_argument('--clock-offset', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sim.install()
+    import decoder
+
+    data = _load(args.file, args.hex)
+    records = decoder.records(data)
+    for index, timestamp, t_min, t_max, h_min, h_max in records:
+        print('{:>6}  {}  temperature {:.1f}..{:.1f} C  humidity {}..{} %'.format(
+            index, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp - args.clock_offset)),
+            t_min, t_max, h_min, h_max))
+    left = len(data) % decoder.RECORD_LEN
+    print('{} records{}'.format(len(records), ', {} bytes left over'.format(left) if left else ''))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+# Several hubs sharing the same sensors, on the host simulator.
+#
+#     python -m sim.hubs [--hubs 3] [--sensors 9] [--seconds 90] [--kill 45] [--no-claims]
+#
+# The hubs are placed on a line, 20 m apart, with the sensors spread between them: each hub hears
+# the sensors around it (the RSSI drops with the distance) and they all share the in-process broker.
+# Reports, for each sensor, the connections and readings of each hub and the radio collisions
+# (two hubs connected to the same sensor). With --kill, the first hub stops after that many seconds
+# (its MQTT connection drops, like a power cut) and the time until its sensors are read by
+# another hub is reported.
+import argparse
+import asyncio
+import calendar
+import json
+import os
+import sys
+import tempfile
+import time
+
+import sim
+
+_stdout = sys.stdout
+
+_SPACING = 20       # m between two hubs
+
+
+def _report(*args):
+    print(*args, file=_stdout)
+
+
+def _rssi(distance):
+    # dBm at distance (m), None when out of range
+    rssi = int(-40 - 2 * distance)
+    return rssi if rssi >= -90 else None
+
+
+def _timestamp(msg):
+    # Time of a JSON reading
+    try:
+        return calendar.timegm(time.strptime(json.loads(msg)['timestamp'], '%Y-%m-%dT%H:%M:%SZ'))
+    except (ValueError, KeyError):
+        return None
+
+
+async def _run(hubs, sensors, seconds, kill):
+    tasks = [asyncio.ensure_future(hub.main()) for hub in hubs]
+    killed = None
+    if kill:
+        await asyncio.sleep(kill)
+        victim = hubs[0]
+        tasks[0].cancel()
+        victim.mqtt_client.drop()
+        for conn_handle in list(victim.myBLE.bt._connections):
+            victim.myBLE.bt._lost(conn_handle)
+        sim.radio.stacks.remove(victim.myBLE.bt)
+        killed = int(time.time())
+        await asyncio.sleep(seconds - kill)
+    else:
+        await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return killed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hubs', type=int, default=3)
+    parser.add_argument('--sensors', type=int, default=9)
+    parser.add_argument('--seconds', type=float, default=90)
+    parser.add_argument('--kill', type=float, default=45, help='seconds before the first hub stops (0: never)')
+    parser.add_argument('--lease', type=int, default=15)
+    parser.add_argument('--no-claims', dest='claims', action='store_false')
+    args = parser.parse_args(argv)
+
+    os.chdir(tempfile.mkdtemp(prefix='hub-sim-'))
+    sys.stdout = open(os.devnull, 'w')
+    sim.install(device_cache=None, gatt_cache=None, read_interval=10, read_retry_interval=2, read_jitter=20,
+                scan_duration_ms=3200, scan_interval_us=30000, scan_window_us=30000, scan_min_interval=3600,
+                log_level=30, stats_interval=0, ha_discovery=False, publish_deadband_temperature=0,
+                publish_deadband_humidity=0, publish_deadband_battery=0,
+                hub_claims=args.claims, claim_lease=args.lease, claim_release_failures=3)
+    import logging
+    logging.getLogger().setLevel(logging.ERROR)
+
+    peripherals = sim.sensors(args.sensors)
+    width = _SPACING * (args.hubs - 1)
+    positions = [width * i / max(args.sensors - 1, 1) for i in range(args.sensors)]
+    hubs = []
+    for h in range(args.hubs):
+        hub = sim.hub('hub{}'.format(h), bytes([0x24, 0x0a, 0xc4, 0, 0, h + 1]))
+        hub.myBLE = hub.ble.Ble(hub.device_capacity, hub.max_concurrent_reads, None, None)
+        for p, x in zip(peripherals, positions):
+            hub.myBLE.bt.rssi[p.mac] = _rssi(abs(x - _SPACING * h))
+        hubs.append(hub)
+
+    _report('{} hubs, {} sensors, {} s, claims {}'.format(args.hubs, args.sensors, args.seconds,
+                                                          'on' if args.claims else 'off'))
+    killed = asyncio.run(_run(hubs, peripherals, args.seconds, args.kill))
+
+    # Readings published by each hub, per sensor
+    readings = {}
+    for client_id, topic, msg, retain in sim.broker.messages:
+        for p in peripherals:
+            if topic == hubs[0].topic_pub + b'/' + p.mac.hex().encode():
+                readings.setdefault(p.mac, []).append((client_id, _timestamp(msg)))
+    names = [hub.client_id for hub in hubs]
+    _report('{:<14} {}'.format('sensor', '  '.join('{:>16}'.format(n.decode()[-4:] + ' conn/reads') for n in names)))
+    for p in peripherals:
+        cells = []
+        for hub, name in zip(hubs, names):
+            heard = hub.myBLE.bt.rssi.get(p.mac)
+            reads = sum(1 for c, t in readings.get(p.mac, ()) if c == name)
+            cells.append('{:>16}'.format('-' if heard is None else '{}/{}'.format(hub.myBLE.bt.connects.get(p.mac, 0), reads)))
+        _report('{:<14} {}'.format(p.mac.hex(), '  '.join(cells)))
+    connects = sum(sum(hub.myBLE.bt.connects.values()) for hub in hubs)
+    published = sum(len(r) for r in readings.values())
+    _report('connections: {}, readings: {}, collisions: {}'.format(connects, published, sim.radio.counters.get('collision', 0)))
+
+    if killed:
+        victim = names[0]
+        delays = []
+        for p in peripherals:
+            entries = readings.get(p.mac, ())
+            if not any(c == victim for c, t in entries):
+                continue
+            after = [t for c, t in entries if c != victim and t is not None and t >= killed]
+            delays.append(min(after) - killed if after else None)
+        _report('after {} stopped: {} of its sensors read by another hub, failover delays {} s'.format(
+            victim.decode(), sum(1 for d in delays if d is not None), [d for d in delays]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
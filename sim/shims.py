@@ -0,0 +1,139 @@
+# CPython stand-ins for the MicroPython modules used by the hub:
+# micropython, utime, uio, uos, ubinascii, machine, network, ntptime, esp.
+import binascii
+import calendar
+import io
+import os
+import time
+import types
+
+
+def _module(name, **attrs):
+    m = types.ModuleType(name)
+    m.__dict__.update(attrs)
+    return m
+
+
+# micropython
+
+def _schedule(func, arg):
+    # Run in the main context, after the current callback (like the MicroPython scheduler)
+    try:
+        import asyncio
+        asyncio.get_running_loop().call_soon(func, arg)
+    except RuntimeError:
+        func(arg)
+
+
+micropython = _module(
+    'micropython',
+    const=lambda x: x,
+    schedule=_schedule,
+    alloc_emergency_exception_buf=lambda size: None,
+    opt_level=lambda level=None: 0,
+    mem_info=lambda *args: None,
+)
+
+
+# utime (time.time() returns an int on MicroPython)
+
+_start = time.monotonic()
+
+utime = _module(
+    'utime',
+    time=lambda: int(time.time()),
+    localtime=lambda secs=None: time.gmtime(secs)[:8],
+    gmtime=lambda secs=None: time.gmtime(secs)[:8],
+    mktime=lambda t: calendar.timegm(tuple(t[:6]) + (0, 0, 0)),
+    sleep=time.sleep,
+    sleep_ms=lambda ms: time.sleep(ms / 1000),
+    sleep_us=lambda us: time.sleep(us / 1000000),
+    ticks_ms=lambda: int((time.monotonic() - _start) * 1000),
+    ticks_us=lambda: int((time.monotonic() - _start) * 1000000),
+    ticks_diff=lambda a, b: a - b,
+    ticks_add=lambda a, b: a + b,
+)
+
+
+# uio, uos, ubinascii
+
+uio = _module('uio', StringIO=io.StringIO, BytesIO=io.BytesIO)
+uos = _module('uos', listdir=lambda path='.': os.listdir(path), remove=os.remove,
+              rename=os.replace, stat=os.stat, mkdir=os.mkdir, getcwd=os.getcwd)
+ubinascii = _module('ubinascii', hexlify=binascii.hexlify, unhexlify=binascii.unhexlify)
+
+
+# machine
+
+class RTC:
+    def datetime(self, value=None):
+        t = time.gmtime()
+        return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+
+
+class ResetError(SystemExit):
+    # Raised by machine.reset()
+    pass
+
+
+def _reset():
+    raise ResetError('machine.reset()')
+
+
+machine = _module(
+    'machine',
+    RTC=RTC,
+    unique_id=lambda: b'\x24\x0a\xc4\x00\x00\x01',
+    reset=_reset,
+    idle=lambda: None,
+    ResetError=ResetError,
+)
+
+
+# network
+
+class WLAN:
+    # Set WLAN.connected = False to simulate a WiFi outage
+    connected = True
+
+    def __init__(self, interface=0):
+        self._active = False
+
+    def active(self, value=None):
+        if value is not None:
+            self._active = value
+        return self._active
+
+    def connect(self, ssid=None, password=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def isconnected(self):
+        return self._active and WLAN.connected
+
+    def status(self, *args):
+        return 1010 if self.isconnected() else 1000
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+
+network = _module('network', WLAN=WLAN, STA_IF=0, AP_IF=1, STAT_GOT_IP=1010)
+ntptime = _module('ntptime', settime=lambda: None)
+esp = _module('esp', osdebug=lambda level: None)
+
+
+def modules():
+    return {
+        'micropython': micropython,
+        'utime': utime,
+        'uio': uio,
+        'uos': uos,
+        'ubinascii': ubinascii,
+        'machine': machine,
+        'network': network,
+        'ntptime': ntptime,
+        'esp': esp,
+    }
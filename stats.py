@@ -0,0 +1,143 @@
+from micropython import const
+import array
+import binascii
+import gc
+import utime as time
+
+# Upper bounds (ms) of the histogram buckets, the last bucket counts everything above
+STAGE_BOUNDS = (50, 100, 200, 500, 1000, 2000, 5000, 10000)
+CYCLE_BOUNDS = (1000, 2000, 5000, 10000, 20000, 60000, 120000, 300000)
+
+# Per-device stages of a reading
+STAGE_CONNECT = const(0)    # gap_connect() to connected
+STAGE_WRITE   = const(1)    # gattc_write() to write status
+STAGE_NOTIFY  = const(2)    # enabling notifications to first notify
+_STAGES       = const(3)
+_STAGE_NAMES = ('connect', 'write', 'notify')
+
+# Per-device counters
+COUNT_READS    = const(0)
+COUNT_FAILURES = const(1)
+COUNT_RETRIES  = const(2)
+COUNT_TIMEOUTS = const(3)
+COUNT_FILTERED = const(4)   # readings not published (unchanged, see deadband.py)
+_COUNTERS      = const(5)
+_COUNTER_NAMES = ('reads', 'failures', 'retries', 'timeouts', 'filtered')
+
+_NO_RSSI = const(-128)
+
+try:
+    _mem_free = gc.mem_free
+    _mem_alloc = gc.mem_alloc
+except AttributeError:
+    # CPython (host simulator)
+    _mem_free = _mem_alloc = lambda: 0
+
+
+class Histograms:
+    # n fixed-bucket histograms of millisecond durations, stored in flat arrays.
+    # record() doesn't allocate.
+    def __init__(self, n, bounds=STAGE_BOUNDS):
+        self.n = n
+        self.bounds = array.array('I', bounds)
+        self._width = len(bounds) + 1
+        self.buckets = array.array('I', [0] * (n * self._width))
+        self.count = array.array('I', [0] * n)
+        self.total = array.array('I', [0] * n)      # ms
+        self.max = array.array('I', [0] * n)        # ms
+
+    def record(self, i, ms):
+        if ms < 0:
+            ms = 0
+        bounds = self.bounds
+        b = 0
+        while b < len(bounds) and ms > bounds[b]:
+            b += 1
+        self.buckets[i * self._width + b] += 1
+        self.count[i] += 1
+        self.total[i] += ms
+        if ms > self.max[i]:
+            self.max[i] = ms
+
+    def clear(self, i):
+        for b in range(self._width):
+            self.buckets[i * self._width + b] = 0
+        self.count[i] = 0
+        self.total[i] = 0
+        self.max[i] = 0
+
+    def report(self, i):
+        n = self.count[i]
+        o = i * self._width
+        return {'n': n, 'avg': self.total[i] // n if n else 0, 'max': self.max[i],
+                'buckets': list(self.buckets[o:o + self._width])}
+
+
+class Stats:
+    # Instrumentation of the reading path, indexed by registry slot, and of the main loop.
+    # Everything is preallocated: the record_* methods can be called on every reading.
+    def __init__(self, capacity=20):
+        self.capacity = capacity
+        self.stages = [Histograms(capacity) for i in range(_STAGES)]
+        self.counters = array.array('I', [0] * (_COUNTERS * capacity))
+        self.rssi = array.array('b', [_NO_RSSI] * capacity)
+        self.cycles = Histograms(1, CYCLE_BOUNDS)
+        self.mem_free = 0
+        self.mem_free_min = 0
+        self.gc_count = 0       # drops of the allocated heap between two samples (a lower bound of the collections)
+        self._mem_alloc = 0
+        self.started = time.time()
+
+    def record_stage(self, slot, stage, start_ms):
+        # Duration of a stage, from its time.ticks_ms() start
+        if 0 <= slot < self.capacity:
+            self.stages[stage].record(slot, time.ticks_diff(time.ticks_ms(), start_ms))
+
+    def count(self, slot, counter, n=1):
+        if 0 <= slot < self.capacity:
+            self.counters[_COUNTERS * slot + counter] += n
+
+    def record_rssi(self, slot, rssi):
+        if 0 <= slot < self.capacity:
+            self.rssi[slot] = rssi
+
+    def record_cycle(self, start_ms):
+        self.cycles.record(0, time.ticks_diff(time.ticks_ms(), start_ms))
+        self.sample_heap()
+
+    def sample_heap(self):
+        free = _mem_free()
+        alloc = _mem_alloc()
+        if alloc < self._mem_alloc:
+            self.gc_count += 1
+        self._mem_alloc = alloc
+        self.mem_free = free
+        if free < self.mem_free_min or not self.mem_free_min:
+            self.mem_free_min = free
+
+    def report(self, devices):
+        # dict of the statistics since the previous report (histograms and counters are cleared),
+        # devices are keyed by MAC address
+        self.sample_heap()
+        report = {
+            'uptime': time.time() - self.started,
+            'mem_free': self.mem_free,
+            'mem_free_min': self.mem_free_min,
+            'gc': self.gc_count,
+            'cycle': self.cycles.report(0),
+        }
+        self.cycles.clear(0)
+        self.mem_free_min = self.mem_free
+        report['devices'] = stats = {}
+        for slot in range(min(len(devices), self.capacity)):
+            device = {}
+            for c in range(_COUNTERS):
+                device[_COUNTER_NAMES[c]] = self.counters[_COUNTERS * slot + c]
+                self.counters[_COUNTERS * slot + c] = 0
+            if self.rssi[slot] != _NO_RSSI:
+                device['rssi'] = self.rssi[slot]
+            for s in range(_STAGES):
+                device[_STAGE_NAMES[s]] = self.stages[s].report(slot)
+                self.stages[s].clear(slot)
+            stats[binascii.hexlify(devices.mac(slot)).decode()] = device
+        return report
@@ -0,0 +1,32 @@
+# Host-side (CPython) tests, run from the repository folder:
+#
+#     python -m unittest discover -s tests -t .
+#
+# The MicroPython modules are replaced by the simulator's stand-ins (see sim/__init__.py),
+# which must be installed before any module of the hub is imported.
+import os
+import tempfile
+import unittest
+
+import sim
+
+sim.install()
+
+import logging
+
+
+class HubTestCase(unittest.TestCase):
+    # Tests of the hub modules: run in a temporary folder, removed afterwards (error logs, caches
+    # and the other files of the hub are written there), with the log output turned off
+    @classmethod
+    def setUpClass(cls):
+        cls._cwd = os.getcwd()
+        cls._tmp = tempfile.TemporaryDirectory(prefix='hub-test-')
+        os.chdir(cls._tmp.name)
+        logging.getLogger().setLevel(logging.CRITICAL + 10)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger().setLevel(logging.NOTSET)
+        os.chdir(cls._cwd)
+        cls._tmp.cleanup()
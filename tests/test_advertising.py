@@ -0,0 +1,108 @@
+import binascii
+import unittest
+
+import advertising
+import decoder
+
+
+def frame(hex_string):
+    return binascii.unhexlify(hex_string.replace(' ', ''))
+
+
+# Advertisements (AD structures, flags first) of a sensor with MAC address A4:C1:38:12:34:56,
+# in the layouts of the ATC1441 and pvvx firmware and of the Xiaomi MiBeacon protocol
+FLAGS = '020106'
+# ATC1441: 22.5 C, 47 %, 95 %, 3000 mV, frame 12
+ATC = FLAGS + '10161a18 a4c138123456 00e1 2f 5f 0bb8 0c'
+# pvvx: 22.35 C, 47.10 %, 2950 mV, 85 %, frame 16, flags 4
+PVVX = FLAGS + '12161a18 563412 38c1a4 bb08 6612 860b 55 10 04'
+# MiBeacon, unencrypted, MAC included: temperature and humidity (22.0 C, 49.5 %)
+MIBEACON_TH = FLAGS + '1516 95fe 5050 7605 2a 563412 38c1a4 0d10 04 dc00 ef01'
+# MiBeacon: temperature only (-5.5 C), humidity only (60.3 %), battery only (93 %)
+MIBEACON_T = FLAGS + '1316 95fe 5050 7605 2b 563412 38c1a4 0410 02 c9ff'
+MIBEACON_H = FLAGS + '1316 95fe 5050 7605 2c 563412 38c1a4 0610 02 5b02'
+MIBEACON_B = FLAGS + '1216 95fe 5050 7605 2d 563412 38c1a4 0a10 01 5d'
+# MiBeacon with capability byte (IO capability flag set: 2 more bytes) before the object
+MIBEACON_CAP = FLAGS + '1816 95fe 7050 7605 2e 563412 38c1a4 20 0000 0d10 04 dc00 ef01'
+# Encrypted MiBeacon (stock LYWSD03MMC): not decoded
+MIBEACON_ENCRYPTED = FLAGS + '1516 95fe 5858 5b05 2f 563412 38c1a4 0d10 04 dc00 ef01'
+
+
+class AdvertisingTest(unittest.TestCase):
+    def decode(self, hex_string, reading=None):
+        return advertising.decode(frame(hex_string), reading)
+
+    def test_atc(self):
+        reading = self.decode(ATC)
+        self.assertEqual(reading.temperature, 22.5)
+        self.assertEqual(reading.humidity, 47)
+        # The level is computed from the voltage (battery curve), not taken from the frame
+        self.assertEqual(reading.battery_voltage, 3.0)
+        self.assertEqual(reading.battery_level, 100)
+
+    def test_atc_negative_temperature(self):
+        reading = self.decode(FLAGS + '10161a18 a4c138123456 ff9c 2f 5f 0a8c 0c')
+        self.assertEqual(reading.temperature, -10.0)
+        self.assertEqual(reading.battery_voltage, 2.7)
+        self.assertEqual(reading.battery_level, 40)
+
+    def test_pvvx(self):
+        reading = self.decode(PVVX)
+        self.assertEqual(reading.temperature, 22.35)
+        self.assertEqual(reading.humidity, 47.1)
+        self.assertEqual(reading.battery_voltage, 2.95)
+        self.assertEqual(reading.battery_level, 90)
+
+    def test_mibeacon_temperature_humidity(self):
+        reading = self.decode(MIBEACON_TH)
+        self.assertEqual(reading.values(), (22.0, 49.5, None, None))
+
+    def test_mibeacon_single_values(self):
+        self.assertEqual(self.decode(MIBEACON_T).values(), (-5.5, None, None, None))
+        self.assertEqual(self.decode(MIBEACON_H).values(), (None, 60.3, None, None))
+        self.assertEqual(self.decode(MIBEACON_B).values(), (None, None, 93, None))
+
+    def test_mibeacon_capability(self):
+        self.assertEqual(self.decode(MIBEACON_CAP).values(), (22.0, 49.5, None, None))
+
+    def test_mibeacon_encrypted(self):
+        self.assertIsNone(self.decode(MIBEACON_ENCRYPTED))
+
+    def test_reading_reused(self):
+        reading = decoder.Reading()
+        self.assertIs(self.decode(PVVX, reading), reading)
+        # The values of the previous frame are cleared
+        self.assertIs(self.decode(MIBEACON_B, reading), reading)
+        self.assertEqual(reading.values(), (None, None, 93, None))
+
+    def test_no_sensor_data(self):
+        self.assertIsNone(self.decode(FLAGS))
+        # Name only (LYWSD03MMC)
+        self.assertIsNone(self.decode(FLAGS + '0b09 4c5957534430334d4d43'))
+        self.assertIsNone(self.decode(''))
+
+    def test_wrong_length_frames(self):
+        # ATC frame one byte short, pvvx frame one byte short (14 bytes: neither layout)
+        self.assertIsNone(self.decode(FLAGS + '0f161a18 a4c138123456 00e1 2f 5f 0bb8'))
+        self.assertIsNone(self.decode(FLAGS + '11161a18 563412 38c1a4 bb08 6612 860b 55 10'))
+        # MiBeacon object length not matching its type
+        self.assertIsNone(self.decode(FLAGS + '1416 95fe 5050 7605 2a 563412 38c1a4 0410 03 c9ff00'))
+        # MiBeacon without object, or shorter than its header
+        self.assertIsNone(self.decode(FLAGS + '0e16 95fe 1050 7605 2a 563412 38c1a4'))
+        self.assertIsNone(self.decode(FLAGS + '0516 95fe 5050'))
+
+    def test_truncated_frames(self):
+        # AD structures running past the end of the advertisement
+        self.assertIsNone(advertising.decode(frame(ATC)[:-2]))
+        self.assertIsNone(advertising.decode(frame(PVVX)[:-1]))
+        # MiBeacon object running past the end of the service data
+        self.assertIsNone(self.decode(FLAGS + '1316 95fe 5050 7605 2a 563412 38c1a4 0d10 04 dc00'))
+
+    def test_service_data(self):
+        payload = advertising.service_data(frame(ATC), 0x181A)
+        self.assertEqual(bytes(payload), frame('a4c138123456 00e1 2f 5f 0bb8 0c'))
+        self.assertIsNone(advertising.service_data(frame(ATC), 0xFE95))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import array
+import struct
+import unittest
+
+import cache
+import registry
+from tests import HubTestCase
+
+
+def mac(i):
+    return b'\xa4\xc1\x38\x00' + struct.pack('>H', i)
+
+
+class CacheTest(HubTestCase):
+    def test_round_trip(self):
+        devices = registry.DeviceRegistry(300)
+        for i in range(300):
+            slot = devices.add(mac(i), 0, 'LYWSD03MMC' if i % 3 else 'Mi Band')
+            devices.set_handle(slot, registry.HANDLE_NOTIFY, 0x0036)
+        # More than 255 devices identified
+        self.assertEqual(cache.save(devices, 'devices.bin'), 300)
+
+        loaded = registry.DeviceRegistry(300)
+        self.assertEqual(cache.load(loaded, 'devices.bin'), 200)
+        self.assertEqual(len(loaded), 300)
+        slot = loaded.find(mac(297))
+        self.assertEqual(loaded.names[slot], 'Mi Band')
+        self.assertEqual(loaded.handle(slot, registry.HANDLE_NOTIFY), 0x0036)
+
+    def test_placeholder_not_saved(self):
+        devices = registry.DeviceRegistry(4)
+        devices.add(mac(1))
+        devices.add(mac(2), 0, 'LYWSD03MMC')
+        self.assertEqual(cache.save(devices, 'devices.bin'), 1)
+
+    def test_old_version_ignored(self):
+        with open('devices.bin', 'wb') as f:
+            f.write(struct.pack('<4sBB', b'LYWC', 1, 0))
+        devices = registry.DeviceRegistry(4)
+        self.assertEqual(cache.load(devices, 'devices.bin'), 0)
+        self.assertEqual(len(devices), 0)
+
+    def test_handles(self):
+        table = {'LYWSD03MMC': array.array('H', (0x0003, 0x0036, 0x0046))}
+        self.assertTrue(cache.save_handles(table, 'handles.bin'))
+        loaded = {}
+        self.assertEqual(cache.load_handles(loaded, 'handles.bin'), 1)
+        self.assertEqual(list(loaded['LYWSD03MMC']), [0x0003, 0x0036, 0x0046])
+
+
+if __name__ == '__main__':
+    unittest.main()
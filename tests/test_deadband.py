@@ -0,0 +1,26 @@
+import unittest
+
+import deadband
+
+
+class EwmaTest(unittest.TestCase):
+    def smoothed(self, values):
+        f = deadband.PublishFilter(1, smoothing=deadband.SMOOTHING_EWMA, alpha=0.3)
+        return [f.update(0, i + 1, (value, 50.0, 90, 2.9))[0] for i, value in enumerate(values)]
+
+    def test_small_rise(self):
+        # A rise of 0.03 C is followed instead of being truncated away at every step
+        self.assertEqual(self.smoothed([21.0, 21.03, 21.03, 21.03]), [21.0, 21.01, 21.02, 21.02])
+
+    def test_below_zero(self):
+        # Same behaviour on both sides of 0 (int() truncates toward zero)
+        self.assertEqual(self.smoothed([-21.0, -21.03, -21.03, -21.03]), [-21.0, -21.01, -21.02, -21.02])
+
+    def test_step(self):
+        values = self.smoothed([20.0] + [22.0] * 20)
+        self.assertEqual(values[1], 20.6)
+        self.assertAlmostEqual(values[-1], 22.0, delta=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import binascii
+import unittest
+
+import ble
+import decoder
+from tests import HubTestCase
+
+_IRQ_SCAN_RESULT = 1 << 4
+_IRQ_GATTC_NOTIFY = 1 << 13
+_IRQ_GATTC_INDICATE = 1 << 14
+
+MAC = b'\xa4\xc1\x38\x12\x34\x56'
+# pvvx advertisement: 22.35 C, 47.10 %, 2950 mV
+PVVX = binascii.unhexlify('020106' '12161a18' '56341238c1a4' 'bb08' '6612' '860b' '551004')
+
+
+class BatteryTest(unittest.TestCase):
+    def tearDown(self):
+        decoder.set_battery_curve(decoder.BATTERY_CURVE)
+
+    def test_default_curve(self):
+        self.assertEqual(decoder.battery_level(0), 0)
+        self.assertEqual(decoder.battery_level(2100), 0)
+        self.assertEqual(decoder.battery_level(2101), 0)
+        self.assertEqual(decoder.battery_level(2300), 5)
+        self.assertEqual(decoder.battery_level(2500), 10)
+        self.assertEqual(decoder.battery_level(2650), 30)
+        self.assertEqual(decoder.battery_level(2999), 99)
+        self.assertEqual(decoder.battery_level(3000), 100)
+        self.assertEqual(decoder.battery_level(3300), 100)
+
+    def test_custom_curve(self):
+        decoder.set_battery_curve([(2000, 0), (3000, 100)])
+        self.assertEqual(decoder.battery_level(1999), 0)
+        self.assertEqual(decoder.battery_level(2500), 50)
+        self.assertEqual(decoder.battery_level(3001), 100)
+
+
+class NotificationTest(unittest.TestCase):
+    def test_notification(self):
+        reading = decoder.Reading()
+        # 21.51 C, 45 %, 2932 mV
+        self.assertIs(decoder.notification(b'\x67\x08\x2d\x74\x0b', reading), reading)
+        self.assertEqual(reading.values(), (21.51, 45, 86, 2.932))
+
+    def test_negative_temperature(self):
+        reading = decoder.notification(b'\x0c\xfe\x50\x98\x08', decoder.Reading())
+        self.assertEqual(reading.values(), (-5.0, 80, 2, 2.2))
+
+    def test_buffer_length(self):
+        # Only the first <length> bytes of the connection buffer are valid
+        buf = bytearray(30)
+        n = decoder.copy(memoryview(buf), b'\x67\x08\x2d\x74\x0b')
+        self.assertEqual(n, 5)
+        self.assertEqual(decoder.notification(buf, decoder.Reading(), n).temperature, 21.51)
+        self.assertIsNone(decoder.notification(buf, decoder.Reading(), 4))
+
+    def test_short_payloads(self):
+        for data in (b'', b'\x67', b'\x67\x08\x2d\x74'):
+            self.assertIsNone(decoder.notification(data, decoder.Reading()))
+
+    def test_copy_truncated(self):
+        buf = bytearray(4)
+        self.assertEqual(decoder.copy(memoryview(buf), b'\x01\x02\x03\x04\x05\x06'), 4)
+        self.assertEqual(bytes(buf), b'\x01\x02\x03\x04')
+
+
+class BleDecodeTest(HubTestCase):
+    # The decoding paths of Ble: notifications of a connection, advertisements in passive mode
+    def setUp(self):
+        self.ble = ble.Ble(4, 1, None, None)
+        self.received = []
+        self.ble.on_advertisement = lambda address, reading: self.received.append((address, reading))
+
+    def connection(self, data):
+        conn = self.ble._acquire(self.ble.addresses.add(MAC))
+        conn.notify_len = decoder.copy(conn.notify_mv, data)
+        return conn
+
+    def test_notification(self):
+        conn = self.connection(b'\x67\x08\x2d\x74\x0b')
+        self.assertEqual(self.ble._decode(conn), (21.51, 45, 86, 2.932))
+        self.assertNotEqual(self.ble.addresses.last_read[conn.slot], 0)
+
+    def test_short_notification(self):
+        conn = self.connection(b'\x67\x08\x2d')
+        self.assertIsNone(self.ble._decode(conn))
+        self.assertEqual(self.ble.addresses.last_read[conn.slot], 0)
+
+    def test_stray_indication(self):
+        conn = self.connection(b'\x67\x08\x2d\x74\x0b')
+        conn.conn_handle = 1
+        self.ble.bt_irq(_IRQ_GATTC_INDICATE, (1, 0x0036, b'\x00\x00\x00\x00\x00'))
+        self.assertEqual(self.ble._decode(conn), (21.51, 45, 86, 2.932))
+        self.ble.bt_irq(_IRQ_GATTC_NOTIFY, (1, 0x0036, b'\x0c\xfe\x50\x98\x08'))
+        self.assertTrue(conn.notify_event.is_set())
+        self.assertEqual(self.ble._decode(conn), (-5.0, 80, 2, 2.2))
+
+    def test_advertisement(self):
+        self.ble.passive = True
+        self.ble._handle_event(_IRQ_SCAN_RESULT, 0, 0, 0, MAC, -60, PVVX)
+        self.assertEqual(self.received, [(MAC, (22.35, 47.1, 90, 2.95))])
+
+    def test_short_advertisement(self):
+        self.ble.passive = True
+        self.ble._handle_event(_IRQ_SCAN_RESULT, 0, 0, 0, MAC, -60, PVVX[:-1])
+        self.ble._handle_event(_IRQ_SCAN_RESULT, 0, 0, 0, MAC, -60, PVVX[:12])
+        self.assertEqual(self.received, [])
+
+    def test_advertisement_not_passive(self):
+        self.ble._handle_event(_IRQ_SCAN_RESULT, 0, 0, 0, MAC, -60, PVVX)
+        self.assertEqual(self.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import io
+import unittest
+
+import logging
+
+
+class ReentrantHandler(logging.StreamHandler):
+    # Logs through the same logger while formatting a record, like a callback run by
+    # micropython.schedule in the middle of a handler
+    def __init__(self, stream, logger):
+        super().__init__(stream)
+        self.logger = logger
+        self.nested = False
+
+    def emit(self, record):
+        if not self.nested:
+            self.nested = True
+            self.logger.warning('nested {}', 2)
+        super().emit(record)
+
+
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.logger = logging.Logger('test')
+        self.logger.setLevel(logging.DEBUG)
+
+    def lines(self):
+        return self.stream.getvalue().splitlines()
+
+    def test_record_reused(self):
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(logging.Formatter(fmt='{levelname} {message}', style='{'))
+        self.logger.addHandler(handler)
+        self.logger.info('first {}', 1)
+        record = self.logger._record
+        self.logger.error('second {}', 2)
+        self.assertIs(self.logger._record, record)
+        self.assertEqual(self.lines(), ['INFO first 1', 'ERROR second 2'])
+
+    def test_reentrant_call(self):
+        handler = ReentrantHandler(self.stream, self.logger)
+        handler.setFormatter(logging.Formatter(fmt='{levelname} {message}', style='{'))
+        self.logger.addHandler(handler)
+        self.logger.info('outer {}', 1)
+        self.assertEqual(self.lines(), ['WARNING nested 2', 'INFO outer 1'])
+        self.logger.info('next {}', 3)
+        self.assertEqual(self.lines()[-1], 'INFO next 3')
+
+
+
+class ModuleFunctionsTest(unittest.TestCase):
+    # The module-level functions don't reach the root logger below its level
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.level = self.root.level
+        self.calls = []
+        self.root.log = lambda level, msg, *args: self.calls.append(level)
+
+    def tearDown(self):
+        del self.root.log
+        self.root.setLevel(self.level)
+
+    def test_disabled(self):
+        self.root.setLevel(logging.CRITICAL + 10)
+        for log in (logging.debug, logging.info, logging.warning, logging.error, logging.critical):
+            log('message {}', 1)
+        self.assertEqual(self.calls, [])
+
+    def test_enabled(self):
+        self.root.setLevel(logging.WARNING)
+        for log in (logging.debug, logging.info, logging.warning, logging.error, logging.critical):
+            log('message {}', 1)
+        self.assertEqual(self.calls, [logging.WARNING, logging.ERROR, logging.CRITICAL])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import unittest
+
+import sim
+from tests import HubTestCase
+
+
+class MessagesTest(HubTestCase):
+    # Messages received on the subscriptions of the hub (claims, backfill requests):
+    # a message which can't be handled must not raise out of check_msg
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        sim.install(device_cache=None, gatt_cache=None, hub_claims=True)
+        cls.hub = sim.hub('hub_messages', b'\x24\x0a\xc4\x00\x00\x09')
+        cls.hub.myBLE = cls.hub.ble.Ble(4, 1, None, None)
+        cls.mac = b'\xa4\xc1\x38\x00\x00\x01'
+        cls.slot = cls.hub.myBLE.addresses.add(cls.mac, 0, 'LYWSD03MMC')
+        cls.hub.sensor_claims.track(cls.slot)
+
+    def setUp(self):
+        sim.broker.reset()
+        self.client = self.hub.connect_mqtt()
+        self.hub.mqtt_client = self.client
+
+    def tearDown(self):
+        self.hub.mqtt_client = None
+
+    def published(self, suffix):
+        return [msg for client_id, topic, msg, retain in sim.broker.messages if topic.endswith(suffix)]
+
+    def claim(self, mac_hex, msg):
+        self.hub.on_message(self.hub.claims_topic + b'/' + mac_hex, msg)
+
+    def test_valid_claim(self):
+        self.claim(b'a4c138000001', b'{"hub": "other", "rssi": -50}')
+        self.assertEqual(self.hub.sensor_claims.owner[self.slot], b'other')
+        self.assertEqual(self.hub.sensor_claims.rssi[self.slot], -50)
+
+    def test_invalid_claims(self):
+        claims = self.hub.sensor_claims
+        claims.owner[self.slot] = None
+        self.claim(b'a4c1', b'{"hub": "other", "rssi": -50}')
+        self.claim(b'zz', b'{"hub": "other", "rssi": -50}')
+        self.claim(b'a4c138000001', b'{"hub": "other", "rssi": 500}')
+        self.claim(b'a4c138000001', b'{"hub": "other", "rssi": "-50"}')
+        self.claim(b'a4c138000001', b'{"hub": "other", "rssi": -50.5}')
+        self.claim(b'a4c138000001', b'{"hub": 1, "rssi": -50}')
+        self.claim(b'a4c138000001', b'[1, 2]')
+        self.claim(b'a4c138000001', b'not json')
+        self.assertIsNone(claims.owner[self.slot])
+
+    def test_retained_invalid_claim_keeps_connection(self):
+        sim.broker.publish(self.client, self.hub.claims_topic + b'/a4c1', b'{"hub": "x", "rssi": -50}', True)
+        sim.broker.publish(self.client, self.hub.claims_topic + b'/a4c138000001', b'{"hub": "x", "rssi": 500}', True)
+        client = self.hub.connect_mqtt()
+        client.check_msg()
+        self.assertTrue(client.connected)
+
+    def test_backfill(self):
+        self.hub.history.add(self.slot, 1000, 21.5, 45)
+        self.hub.history.add(self.slot, 2000, 21.7, 46)
+        since = 1500 + self.hub.payload.EPOCH_OFFSET
+        self.hub.on_message(self.hub.backfill_topic, json.dumps({'mac': 'a4:c1:38:00:00:01', 'since': since}).encode())
+        replies = self.published(b'/history')
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(json.loads(replies[0])['samples'], [[2000 + self.hub.payload.EPOCH_OFFSET, 21.7, 46.0]])
+
+    def test_invalid_backfill_requests(self):
+        for request in (b'{"mac": "a4c1"}', b'{"mac": "a4c138000001", "since": "yesterday"}',
+                        b'{"mac": "a4c138000001", "since": [1]}', b'{"mac": 1}', b'{}', b'[]', b'garbage'):
+            self.hub.on_message(self.hub.backfill_topic, request)
+        self.hub.on_message(self.hub.backfill_topic, b'{"mac": "a4c138000002"}')
+        self.assertEqual(self.published(b'/history'), [])
+        self.assertTrue(self.client.connected)
+
+
+if __name__ == '__main__':
+    unittest.main()
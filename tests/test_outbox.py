@@ -0,0 +1,73 @@
+import os
+import unittest
+
+import outbox
+from tests import HubTestCase
+
+MAC = b'\xa4\xc1\x38\x00\x00\x01'
+
+
+def reading(i):
+    return (1000 + i, MAC, (20 + i / 100, 45.5, 80, 2.9))
+
+
+class OutboxTest(HubTestCase):
+    def tearDown(self):
+        if os.path.exists('outbox.bin'):
+            os.remove('outbox.bin')
+
+    def fill(self, box, n):
+        for i in range(n):
+            box.put(*reading(i))
+
+    def test_ram_only(self):
+        box = outbox.Outbox(4)
+        self.fill(box, 6)
+        self.assertEqual((len(box), box.dropped), (4, 2))
+        self.assertEqual(box.peek(10), [reading(i) for i in range(2, 6)])
+        box.commit(3)
+        self.assertEqual(box.peek(10), [reading(5)])
+
+    def test_spill_replayed_first(self):
+        box = outbox.Outbox(4, 'outbox.bin')
+        self.fill(box, 7)
+        self.assertEqual((len(box), box.dropped), (7, 0))
+        self.assertEqual(box.peek(2), [reading(0), reading(1)])
+        box.commit(3)
+        self.assertEqual(box.peek(10), [reading(3), reading(4), reading(5), reading(6)])
+        # The file is deleted once fully replayed
+        self.assertFalse(os.path.exists('outbox.bin'))
+
+    def test_restart_during_replay(self):
+        box = outbox.Outbox(2, 'outbox.bin')
+        self.fill(box, 7)
+        box.commit(2)
+        # After a reboot only the spilled readings not published yet are replayed
+        box = outbox.Outbox(2, 'outbox.bin')
+        self.assertEqual(len(box), 3)
+        self.assertEqual(box.peek(10), [reading(2), reading(3), reading(4)])
+        box.commit(3)
+        self.assertFalse(os.path.exists('outbox.bin'))
+        self.assertEqual(len(outbox.Outbox(2, 'outbox.bin')), 0)
+
+    def test_spill_max(self):
+        box = outbox.Outbox(2, 'outbox.bin', spill_max=3)
+        self.fill(box, 7)
+        self.assertEqual((len(box), box.dropped), (5, 2))
+        self.assertEqual(os.path.getsize('outbox.bin'), 8 + 3 * 17)
+        # The records already published still count until the file is deleted
+        box.commit(1)
+        box.put(*reading(7))
+        self.assertEqual((len(box), box.dropped), (4, 3))
+        self.assertEqual([r[0] for r in box.peek(10)], [1001, 1002])
+
+    def test_unknown_format(self):
+        # Spill file without header (or from another program): ignored and deleted
+        with open('outbox.bin', 'wb') as f:
+            f.write(bytes(3 * 17))
+        self.assertEqual(len(outbox.Outbox(2, 'outbox.bin')), 0)
+        self.assertFalse(os.path.exists('outbox.bin'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import sim
+from tests import HubTestCase
+
+
+class PublishTest(HubTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        sim.install(device_cache=None, gatt_cache=None, aggregate_readings=True)
+        cls.hub = sim.hub('hub_publish', b'\x24\x0a\xc4\x00\x00\x0a')
+        cls.hub.myBLE = cls.hub.ble.Ble(4, 1, None, None)
+
+    def setUp(self):
+        sim.broker.reset()
+        self.hub.mqtt_client = self.hub.connect_mqtt()
+
+    def tearDown(self):
+        self.hub.mqtt_client = None
+
+    def aggregates(self):
+        topic = self.hub.topic_pub + b'/' + self.hub.client_id
+        return [msg for client_id, t, msg, retain in sim.broker.messages if t == topic]
+
+    def test_empty_batch(self):
+        # Only discovery messages pending: no empty aggregate message
+        self.assertEqual(self.hub.publish_batch([]), 0)
+        self.assertEqual(self.aggregates(), [])
+
+    def test_aggregate(self):
+        batch = [(1000, b'\xa4\xc1\x38\x00\x00\x01', (21.5, 45, 80, 2.9))]
+        self.assertEqual(self.hub.publish_batch(batch), 1)
+        messages = self.aggregates()
+        self.assertEqual(len(messages), 1)
+        self.assertIn(b'"a4c138000001": {"temperature": 21.5', messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import asyncio
+import os
+import struct
+import unittest
+
+import sim
+import ble
+import decoder
+import records
+from sim import capture
+from tests import HubTestCase
+
+# Records 40 to 45 streamed by a LYWSD03MMC, one per hour from 2023-10-18 12:00 UTC (sensor clock)
+HISTORY = os.path.join(os.path.dirname(__file__), 'history.hex')
+START = 1697630400
+
+
+def history():
+    return capture._load(HISTORY, True)
+
+
+class RecordTest(unittest.TestCase):
+    def test_capture(self):
+        data = history()
+        self.assertEqual(len(data), 6 * decoder.RECORD_LEN)
+        fetched = decoder.records(data)
+        self.assertEqual([r[0] for r in fetched], list(range(40, 46)))
+        self.assertEqual([r[1] for r in fetched], [START + h * 3600 for h in range(6)])
+        self.assertEqual(fetched[0][2:], (21.4, 22.0, 44, 47))
+        # Temperatures below 0 (int16)
+        self.assertEqual(fetched[4][2:], (-0.4, 0.3, 88, 93))
+
+    def test_truncated(self):
+        data = history()
+        self.assertEqual(len(decoder.records(data[:-1])), 5)
+        self.assertEqual(decoder.records(data[:decoder.RECORD_LEN - 1]), [])
+        self.assertIsNone(decoder.record(data, 5 * decoder.RECORD_LEN + 1))
+        # Only the first <length> bytes of the buffer are valid
+        self.assertIsNone(decoder.record(data, 0, decoder.RECORD_LEN - 1))
+        self.assertEqual(decoder.record(data, decoder.RECORD_LEN, 2 * decoder.RECORD_LEN)[0], 41)
+
+    def test_device_time(self):
+        self.assertEqual(decoder.device_time(struct.pack('<Ib', START, 0)), START)
+        self.assertEqual(decoder.device_time(struct.pack('<I', START)), START)
+        self.assertIsNone(decoder.device_time(struct.pack('<I', START), 3))
+
+
+class RecordBufferTest(unittest.TestCase):
+    def test_append(self):
+        data = memoryview(history())
+        buf = records.RecordBuffer(4)
+        self.assertEqual(buf.last, -1)
+        for i in range(6):
+            buf.append(data[i * decoder.RECORD_LEN:(i + 1) * decoder.RECORD_LEN])
+        # The records beyond capacity are dropped
+        self.assertEqual(len(buf), 4)
+        self.assertEqual(buf.dropped, 2)
+        self.assertEqual(buf.last, 43)
+        self.assertEqual(buf.records(), decoder.records(data)[:4])
+        buf.clear()
+        self.assertEqual((len(buf), buf.last, buf.dropped), (0, -1, 0))
+
+    def test_long_notification(self):
+        # Only the record is kept, the bytes after it are ignored
+        buf = records.RecordBuffer(4)
+        buf.append(history()[:decoder.RECORD_LEN + 3])
+        self.assertEqual((len(buf), buf.last, buf.dropped), (1, 40, 0))
+        self.assertEqual(buf.records(), decoder.records(history())[:1])
+
+    def test_short_notification(self):
+        buf = records.RecordBuffer(4)
+        buf.append(history()[:decoder.RECORD_LEN - 1])
+        self.assertEqual((len(buf), buf.last, buf.dropped), (0, -1, 1))
+
+
+class HighWaterMarksTest(HubTestCase):
+    def setUp(self):
+        self.devices = ble.registry.DeviceRegistry(4)
+        self.devices.add(b'\xa4\xc1\x38\x00\x00\x01')
+        self.devices.add(b'\xa4\xc1\x38\x00\x00\x02')
+
+    def test_due(self):
+        marks = records.HighWaterMarks(4, interval=3600, gap=900)
+        now = 100000
+        # First reading since startup
+        self.assertTrue(marks.due(0, now, now - 60))
+        marks.fetched[0] = now
+        self.assertFalse(marks.due(0, now + 60, now))
+        # Gap in the readings, interval elapsed
+        self.assertTrue(marks.due(0, now + 1000, now))
+        self.assertTrue(marks.due(0, now + 3600, now + 3500))
+        self.assertFalse(marks.due(4, now, now))
+        # interval 0: only after a gap
+        marks = records.HighWaterMarks(4, interval=0, gap=900)
+        marks.fetched[0] = now
+        self.assertFalse(marks.due(0, now + 7200, now + 7100))
+
+    def test_save_load(self):
+        marks = records.HighWaterMarks(4)
+        self.assertEqual(marks.mark(self.devices, 0), -1)
+        marks.advance(0, 45)
+        self.assertTrue(marks.dirty)
+        self.assertTrue(marks.save(self.devices, 'records.bin'))
+        self.assertFalse(marks.dirty)
+
+        # After a restart, the devices get their mark back whatever their slot
+        loaded = records.HighWaterMarks(4)
+        self.assertEqual(loaded.load('records.bin'), 1)
+        devices = ble.registry.DeviceRegistry(4)
+        devices.add(b'\xa4\xc1\x38\x00\x00\x02')
+        devices.add(b'\xa4\xc1\x38\x00\x00\x01')
+        self.assertEqual(loaded.mark(devices, 0), -1)
+        self.assertEqual(loaded.mark(devices, 1), 45)
+        self.assertEqual(loaded.saved, {})
+
+    def test_unread_marks_kept(self):
+        # The marks of the devices not read since the restart are saved again
+        marks = records.HighWaterMarks(4)
+        marks.saved[b'\xa4\xc1\x38\x00\x00\x09'] = 7
+        marks.advance(1, 3)
+        marks.save(self.devices, 'records.bin')
+        loaded = records.HighWaterMarks(4)
+        self.assertEqual(loaded.load('records.bin'), 2)
+        self.assertEqual(loaded.saved[b'\xa4\xc1\x38\x00\x00\x09'], 7)
+
+    def test_missing_file(self):
+        self.assertEqual(records.HighWaterMarks(4).load('missing.bin'), 0)
+
+    def test_reset(self):
+        marks = records.HighWaterMarks(4)
+        marks.advance(0, 45)
+        marks.reset(0)
+        self.assertEqual(marks.mark(self.devices, 0), -1)
+
+
+class FetchTest(HubTestCase):
+    # Backfill from a simulated sensor: Ble.fetch_records on a connection
+    def setUp(self):
+        self.sensor = sim.sensors(1, clock_offset=5 * 3600)[0]
+        self.sensor.log_hours(6)
+        self.fetched = []
+        self.ble = ble.Ble(4, 1, None, None)
+        self.marks = records.HighWaterMarks(4)
+        self.ble.set_backfill(self.marks, 4, lambda slot, fetched: self.fetched.append((slot, fetched)))
+        self.slot = self.ble.addresses.add(self.sensor.mac, 0, 'LYWSD03MMC')
+
+    def tearDown(self):
+        sim.reset()
+
+    def fetch(self, *marks):
+        # Number of records fetched on each connection, the mark being set to marks[i] before (if not None)
+        async def run():
+            counts = []
+            for mark in marks or (None,):
+                if mark is not None:
+                    self.marks.advance(self.slot, mark)
+                conn = self.ble._acquire(self.slot)
+                self.assertTrue(await self.ble.connect(conn, timeout_ms=2000))
+                try:
+                    counts.append(await self.ble.fetch_records(conn))
+                finally:
+                    await self.ble.disconnect(conn)
+                    self.ble._release(conn)
+            return counts
+        return asyncio.run(run())
+
+    def indexes(self):
+        return [r[0] for slot, fetched in self.fetched for r in fetched]
+
+    def test_clock_offset(self):
+        # At most max_records: the last ones
+        self.assertEqual(self.fetch(), [4])
+        self.assertEqual(self.indexes(), [2, 3, 4, 5])
+        # The record times are converted from the sensor clock (5 h ahead) to the hub clock
+        stored = decoder.records(b''.join(self.sensor.history))
+        for (index, timestamp, t_min, t_max, h_min, h_max), r in zip(self.fetched[0][1], stored[2:]):
+            self.assertAlmostEqual(timestamp, r[1] - self.sensor.clock_offset, delta=2)
+            self.assertEqual((t_min, t_max, h_min, h_max), r[2:])
+
+    def test_mark(self):
+        # Then nothing new
+        self.assertEqual(self.fetch(3, 5), [2, 0])
+        self.assertEqual(self.indexes(), [4, 5])
+
+    def test_history_restarted(self):
+        # Battery changed: the sensor numbers its records from 0 again, below the mark
+        self.assertEqual(self.fetch(1000), [4])
+        self.assertEqual(self.marks.mark(self.ble.addresses, self.slot), -1)
+        self.assertEqual(self.indexes(), [2, 3, 4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
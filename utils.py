@@ -1,4 +1,5 @@
 import machine, ntptime
+import utime as time
 import binascii
 import logging, logger
 logger.initLogging()
@@ -25,12 +26,29 @@ def timestamp(type='timestamp'):
         return '{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(yy,mm,dd,hh,MM,ss)
 
 
-def log_error_to_file(message, fname ='ble.log'):
-    try:
-        f = open(timestamp(type='date') + fname, 'a')
-        f.write(timestamp() + ' ' + message + '\n')
-        f.close()
-    except Exception as e:
-        logging.error('ERROR: log_error_to_file - {}', str(e))
+def format_time(seconds):
+    # ISO 8601 representation of a time.time() value (the RTC is kept in UTC by ntptime)
+    yy,mm,dd,hh,MM,ss = time.localtime(seconds)[:6]
+    return '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z'.format(yy,mm,dd,hh,MM,ss)
 
-    logging.error(message)
\ No newline at end of file
+
+# Error log files: one logger (with a buffered, rotating file handler) per file name
+_error_loggers = {}
+
+
+def log_error_to_file(message, fname='ble.log', max_bytes=16384, backup_count=2):
+    l = _error_loggers.get(fname)
+    if l is None:
+        l = logging.getLogger(fname)
+        h = logging.RotatingFileHandler(fname, max_bytes, backup_count)
+        h.setFormatter(logging.Formatter(fmt='{asctime} {message}', style='{'))
+        l.addHandler(h)
+        _error_loggers[fname] = l
+    l.error(message)
+
+    logging.error(message)
+
+
+def flush_logs():
+    # Write the buffered log records to flash (call before a reset)
+    logging.shutdown()